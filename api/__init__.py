@@ -24,12 +24,22 @@ parser.add_argument('-l', '--log_level', dest='log_level', default='warning',
 parser.add_argument('-s', '--debug', dest='debug', action='store_true',
                     help='When bundling data, store additional information for\n' +
                     'debugging primitive / interval source files, etc.')
+parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help='Number of worker processes to use for the per-location\n' +
+                    'stages of OTF2 ingest (default: 1)')
+parser.add_argument('-c', '--cache_mb', dest='cacheMb', type=float, default=256,
+                    help='Memory budget, in MB, for caching computed histograms\n' +
+                    '(default: 256; 0 disables the cache)')
+parser.add_argument('--disk_cache_mb', dest='diskCacheMb', type=float, default=0,
+                    help='Size limit, in MB, of an additional on-disk histogram\n' +
+                    'cache inside each dataset directory (default: 0, disabled)')
 
 args = parser.parse_args()
 
 traveler_parse_levels = ['info', 'debug', 'trace']
 
-db = DataStore(args.dbDir, args.debug)
+db = DataStore(args.dbDir, args.debug, args.jobs,
+               int(args.cacheMb * 1024 * 1024), int(args.diskCacheMb * 1024 * 1024))
 
 def validateDataset(datasetId, requiredFiles=None, filesMustBeReady=None, allFilesMustBeReady=False):
     if datasetId not in db:
@@ -2,12 +2,15 @@ import bisect
 import copy
 import json
 import math
+from collections import deque
 
-from fastapi import APIRouter
+import numpy as np
+from fastapi import APIRouter, Header, HTTPException, Query
 from starlette.responses import StreamingResponse
 
 from data_store.dependencyTree import find_node_in_dependency_tree
 from . import db, validateDataset
+from .packing import wantsPacked, packIntervals, packedResponse
 
 router = APIRouter()
 
@@ -19,41 +22,34 @@ def get_intervals(datasetId: str, \
                   maxDuration: int = None, \
                   location: str = None, \
                   guid: int = None, \
-                  primitive: str = None):
+                  primitive: str = None, \
+                  responseFormat: str = Query(None, alias='format'), \
+                  accept: str = Header(None)):
     datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
+    packed = wantsPacked(responseFormat, accept)
 
     if begin is None:
         begin = db[datasetId]['info']['intervalDomain'][0]
     if end is None:
         end = db[datasetId]['info']['intervalDomain'][1]
 
+    # Apply the filters to the interval table's columns first, so that only
+    # matching intervals get fetched
+    intervals = db[datasetId]['intervals']
+    rows = intervals.selectRows(db[datasetId]['intervalIndex'].overlapRows(begin, end),
+                                location=location,
+                                primitive=primitive,
+                                guid=guid,
+                                minDuration=minDuration,
+                                maxDuration=maxDuration)
+
+    if packed:
+        return packIntervals(intervals, rows, {'begin': begin, 'end': end})
+
     def intervalGenerator():
         yield '['
         firstItem = True
-        for i in db[datasetId]['intervalIndex'].iterOverlap(begin, end):
-            intervalObj = db[datasetId]['intervals'][i.data]
-
-            # Filter by location
-            if location is not None and intervalObj['Location'] != location:
-                continue
-
-            # Filter by primitive
-            if primitive is not None and intervalObj['Primitive'] != primitive:
-                continue
-
-            # Filter by guid
-            if guid is not None and intervalObj['GUID'] != guid:
-                continue
-
-            # Filter by interval duration
-            if minDuration is not None or maxDuration is not None:
-                intervalLength = (intervalObj['leave']['Timestamp'] - intervalObj['enter']['Timestamp'])
-                if minDuration is not None and intervalLength < minDuration:
-                    continue
-                if maxDuration is not None and intervalLength > maxDuration:
-                    continue
-
-            # This interval has passed all filters; yield it
+        for intervalObj in intervals.iterRecords(rows):
             if not firstItem:
                 yield ','
             yield json.dumps(intervalObj)
@@ -63,6 +59,85 @@ def get_intervals(datasetId: str, \
     return StreamingResponse(intervalGenerator(), media_type='application/json')
 
 
+@router.get('/datasets/{datasetId}/ganttIntervals')
+def get_gantt_intervals(datasetId: str, \
+                        bins: int = 1000, \
+                        begin: int = None, \
+                        end: int = None, \
+                        locations: str = None, \
+                        responseFormat: str = Query(None, alias='format'), \
+                        accept: str = Header(None)):
+    # Level of detail version of /intervals for drawing a Gantt chart that's
+    # bins pixels wide: intervals that are longer than a pixel come back
+    # individually, and everything else is merged into one busy run per
+    # location per pixel (see IntervalTable.summarizeRows), so the size of the
+    # response depends on the screen, not on how dense the trace is
+    datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
+    packed = wantsPacked(responseFormat, accept)
+
+    if begin is None:
+        begin = db[datasetId]['info']['intervalDomain'][0]
+    if end is None:
+        end = db[datasetId]['info']['intervalDomain'][1]
+    if bins < 1 or end <= begin:
+        raise HTTPException(status_code=400, detail='bins must be positive, and end must be after begin')
+
+    intervals = db[datasetId]['intervals']
+    rows = db[datasetId]['intervalIndex'].overlapRows(begin, end)
+    # Intervals without a location can't be drawn
+    locationIds = intervals.columns['location'][rows]
+    if locations:
+        wantedIds = [intervals.stringIds[location] for location in locations.split(',') if location in intervals.stringIds]
+        rows = rows[np.isin(locationIds, wantedIds)]
+    else:
+        rows = rows[locationIds >= 0]
+    summary = intervals.summarizeRows(rows, begin, end, bins)
+    metadata = {'begin': begin, 'end': end, 'bins': bins, 'binWidth': (end - begin) / bins}
+
+    wideRows = summary['intervals']
+    runs = summary['runs']
+    if packed:
+        # location / primitive columns are indices into the string table
+        arrays = {
+            'intervals.intervalId': wideRows,
+            'intervals.enter': intervals.columns['enter'][wideRows],
+            'intervals.leave': intervals.columns['leave'][wideRows],
+            'intervals.location': intervals.columns['location'][wideRows],
+            'intervals.primitive': intervals.columns['primitive'][wideRows]
+        }
+        for name, column in runs.items():
+            arrays['runs.' + name] = column.astype(np.int32) if name in ['location', 'primitive'] else column
+        return packedResponse(arrays, metadata, intervals.strings)
+
+    ret = {'metadata': metadata, 'locations': {}}
+    def getLocation(locationId):
+        location = intervals.strings[locationId]
+        if location not in ret['locations']:
+            ret['locations'][location] = {'intervals': [], 'runs': []}
+        return ret['locations'][location]
+    for row, enter, leave, locationId, primitiveId in zip(wideRows.tolist(),
+                                                         intervals.columns['enter'][wideRows].tolist(),
+                                                         intervals.columns['leave'][wideRows].tolist(),
+                                                         intervals.columns['location'][wideRows].tolist(),
+                                                         intervals.columns['primitive'][wideRows].tolist()):
+        getLocation(locationId)['intervals'].append({
+            'intervalId': str(row),
+            'enter': enter,
+            'leave': leave,
+            'Primitive': None if primitiveId < 0 else intervals.strings[primitiveId]
+        })
+    for locationId, binId, runBegin, runEnd, count, duration, primitiveId in zip(*[runs[name].tolist() for name in ['location', 'bin', 'begin', 'end', 'count', 'duration', 'primitive']]):
+        getLocation(locationId)['runs'].append({
+            'bin': binId,
+            'begin': runBegin,
+            'end': runEnd,
+            'count': count,
+            'duration': duration,
+            'Primitive': None if primitiveId < 0 else intervals.strings[primitiveId]
+        })
+    return ret
+
+
 @router.get('/datasets/{datasetId}/intervals/{intervalId}')
 def get_interval(datasetId: str, \
                  intervalId: str):
@@ -107,88 +182,98 @@ def intervalTrace(datasetId: str,
     if end is None:
         end = db[datasetId]['info']['intervalDomain'][1]
 
-    def format_interval(intervalObj, childId=None):
+    # Everything below comes from the interval table's columns; the parent /
+    # child links are stored as CSR arrays (see IntervalTable.setLinks), so
+    # no interval records need to be fetched
+    intervals = db[datasetId]['intervals']
+    targetRow = intervals.getRow(intervalId)
+    if targetRow is None:
+        raise HTTPException(status_code=404, detail='Interval not found: %s' % intervalId)
+    enters = intervals.columns['enter']
+    leaves = intervals.columns['leave']
+    parents = intervals.columns['parent']
+    childOffsets = intervals.columns['childOffsets']
+    childIds = intervals.columns['childIds']
+
+    def getParent(row):
+        parent = int(parents[row])
+        return None if parent < 0 else parent
+
+    def format_interval(row, childRow=None):
         result = {
-            'enter': intervalObj['enter']['Timestamp'],
-            'leave': intervalObj['leave']['Timestamp'],
-            'location': intervalObj['Location']
+            'enter': int(enters[row]),
+            'leave': int(leaves[row]),
+            'location': intervals.getString('location', row)
         }
-        if childId is None:
-            result['parent'] = intervalObj['parent']
+        if childRow is None:
+            parent = getParent(row)
+            result['parent'] = None if parent is None else str(parent)
         else:
-            result['child'] = childId
-        return '"' + intervalObj['intervalId'] + '":' + json.dumps(result)
+            result['child'] = str(childRow)
+        return '"' + str(row) + '":' + json.dumps(result)
 
     def intervalGenerator():
         yield '{"ancestors":{'
 
-        lastInterval = None
+        lastRow = None
         yieldComma = False
-        intervalObj = targetInterval = db[datasetId]['intervals'][intervalId]
+        row = targetRow
 
-        # First phase: from the targetInterval, rewind until we encounter
+        # First phase: from the target interval, rewind until we encounter
         # an interval in the queried range (or we run out of intervals)
-        while intervalObj['parent'] is not None and intervalObj['enter']['Timestamp'] > end:
-            lastInterval = intervalObj
-            parentId = intervalObj['parent']
-            intervalObj = db[datasetId]['intervals'][parentId]
+        while getParent(row) is not None and enters[row] > end:
+            lastRow = row
+            row = getParent(row)
 
-        # Second phase: if we had to rewind, include the lastInterval to enable
+        # Second phase: if we had to rewind, include the lastRow to enable
         # drawing offscreen lines to the right
-        if intervalObj != targetInterval:
-            yield format_interval(lastInterval, None)
+        if row != targetRow:
+            yield format_interval(lastRow, None)
             yieldComma = True
 
         # Third phase: include intervals until we encounter one beyond
         # the queried range (or we run out)
-        while intervalObj is not None and intervalObj['leave']['Timestamp'] >= begin:
+        while row is not None and leaves[row] >= begin:
             if yieldComma:
                 yield ','
             yieldComma = True
-            childId = lastInterval['intervalId'] if lastInterval is not None else None
-            yield format_interval(intervalObj, childId)
-            lastInterval = intervalObj
-            parentId = intervalObj['parent']
-            intervalObj = db[datasetId]['intervals'][parentId] if parentId is not None else None
+            yield format_interval(row, lastRow)
+            lastRow = row
+            row = getParent(row)
 
-        # Fourth phase: if the last intervalObj was offscreen, we still want to
+        # Fourth phase: if the last interval was offscreen, we still want to
         # include it to enable drawing a line offscreen to the left
-        if intervalObj is not None:
+        if row is not None:
             if yieldComma:
                 yield ','
             yieldComma = True
-            childId = lastInterval['intervalId'] if lastInterval is not None else None
-            yield format_interval(intervalObj, childId)
+            yield format_interval(row, lastRow)
 
-        # Start on descendants
+        # Start on descendants (breadth first)
         yield '},"descendants":{'
-        childQueue = [intervalId]
+        childQueue = deque([targetRow])
+        # Only as big as the part of the graph that we actually visit
+        queued = {targetRow}
         yieldComma = False
 
         while len(childQueue) > 0:
-            intervalObj = db[datasetId]['intervals'][childQueue.pop(0)]
+            row = childQueue.popleft()
+            children = childIds[childOffsets[row]:childOffsets[row + 1]]
             # yield any interval where itself or its child (to allow offscreen
             # lines to the left) is in the queried range
-            yieldThisInterval = False
-            if intervalObj['leave']['Timestamp'] >= begin:
-                yieldThisInterval = True
-            else:
-                for childId in intervalObj['children']:
-                    if db[datasetId]['intervals'][childId]['enter']['Timestamp'] >= begin:
-                        yieldThisInterval = True
-
-            if yieldThisInterval:
+            if leaves[row] >= begin or (len(children) > 0 and enters[children].max() >= begin):
                 if yieldComma:
                     yield ','
                 yieldComma = True
-                yield format_interval(intervalObj)
+                yield format_interval(row)
 
             # Only add children to the queue if this interval ends before the
             # queried range does
-            if intervalObj['leave']['Timestamp'] <= end:
-                for childId in intervalObj['children']:
-                    if not childId in childQueue:
-                        childQueue.append(childId)
+            if leaves[row] <= end:
+                for childRow in children.tolist():
+                    if childRow not in queued:
+                        queued.add(childRow)
+                        childQueue.append(childRow)
 
         # Finished
         yield '}}'
@@ -234,9 +319,9 @@ def primitive_trace_forward(datasetId: str,
                 array = {}
                 for location in locations:
                     if location in sUtil.locationDict:
-                        array[location] = sUtil.calcUtilizationForLocation(sbin, st, en, location)
+                        array[location] = sUtil.calcUtilizationForLocation(sbin, st, en, location).tolist()
             else:
-                array = sUtil.calcUtilizationHistogram(sbin, st, en)
+                array = sUtil.calcUtilizationHistogram(sbin, st, en).tolist()
             return array
 
         binSize = (end - begin) / bins
@@ -246,7 +331,7 @@ def primitive_trace_forward(datasetId: str,
             allDummyLocations.append(dummy_location)
             if dLocations and str(dummy_location) not in dLocations:
                 continue
-            aggUtilValues = currentNode.aggregatedUtil.calcUtilizationForLocation(bins, begin, end, dummy_location, False)
+            aggUtilValues = currentNode.aggregatedUtil.calcUtilizationForLocation(bins, begin, end, dummy_location, False).tolist()
 
             last_id = -1
             each_bin = 0
@@ -288,6 +373,6 @@ def get_dependency_tree(datasetId: str):
     datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
 
     def generateTree():
-        yield json.dumps(db[datasetId]['dependencyTree'].getTheTree())
+        yield db[datasetId]['dependencyTree'].getSerializedTree()
 
     return StreamingResponse(generateTree(), media_type='application/json')
\ No newline at end of file
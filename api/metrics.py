@@ -1,9 +1,10 @@
 import json
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Query
 from starlette.responses import StreamingResponse
 
 from . import db, validateDataset
+from .packing import wantsPacked, packedResponse
 
 router = APIRouter()
 
@@ -16,7 +17,8 @@ def get_procMetrics(datasetId: str):
 def get_procMetric_values(datasetId: str,
                           metric: str,
                           begin: float = None,
-                          end: float = None):
+                          end: float = None,
+                          maxPoints: int = None):
     datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
 
     if begin is None:
@@ -24,15 +26,19 @@ def get_procMetric_values(datasetId: str,
     if end is None:
         end = db[datasetId]['info']['intervalDomain'][1]
 
+    if 'procMetrics' not in db[datasetId] or metric not in db[datasetId]['procMetrics']:
+        raise HTTPException(status_code=404, detail='No raw samples for metric: %s' % metric)
+    if maxPoints is not None and maxPoints < 2:
+        raise HTTPException(status_code=400, detail='maxPoints must be at least 2')
+    timestamps, values = db[datasetId]['procMetrics'].getRange(metric, begin, end, maxPoints)
+
     def procMetricGenerator():
         yield '['
         firstItem = True
-        for timestamp in db[datasetId]['procMetrics'][metric]:
-            if float(timestamp) < begin or float(timestamp) > end:
-                continue
+        for timestamp, value in zip(timestamps.tolist(), values.tolist()):
             if not firstItem:
                 yield ','
-            yield json.dumps(db[datasetId]['procMetrics'][metric][timestamp])
+            yield json.dumps({'Timestamp': timestamp, 'Value': value})
             firstItem = False
         yield ']'
 
@@ -44,19 +50,25 @@ def getMetricData(datasetId: str,
                   bins: int = 100,
                   begin: int = None,
                   end: int = None,
-                  location: str = None):
+                  location: str = None,
+                  responseFormat: str = Query(None, alias='format'),
+                  accept: str = Header(None)):
     datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
+    packed = wantsPacked(responseFormat, accept)
 
     if begin is None:
         begin = db[datasetId]['info']['intervalDomain'][0]
     if end is None:
         end = db[datasetId]['info']['intervalDomain'][1]
 
+    def computeHistogram():
+        return db[datasetId]['sparseUtilizationList']['metrics'][metric].calcMetricHistogram(bins, begin, end, location)
+
     ret = {}
-    if location is None:
-        ret['data'] = db[datasetId]['sparseUtilizationList']['metrics'][metric].calcMetricHistogram(bins, begin, end)
-    else:
-        ret['data'] = db[datasetId]['sparseUtilizationList']['metrics'][metric].calcMetricHistogram(bins, begin, end, location)
+    data = db.getCachedHistogram(datasetId, ('metricSummary', metric, bins, begin, end, location), computeHistogram)
+    if packed:
+        return packedResponse(data if location is None else {'data': data}, {'begin': begin, 'end': end, 'bins': bins})
+    ret['data'] = data if location is None else data.tolist()
     ret['metadata'] = {'begin': begin, 'end': end, 'bins': bins}
     return ret
 
@@ -66,8 +78,11 @@ def get_utilization_histogram(datasetId: str,
                               begin: int = None,
                               end: int = None,
                               locations: str = None,
-                              primitive: str = None):
+                              primitive: str = None,
+                              responseFormat: str = Query(None, alias='format'),
+                              accept: str = Header(None)):
     datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
+    packed = wantsPacked(responseFormat, accept)
 
     if begin is None:
         begin = db[datasetId]['info']['intervalDomain'][0]
@@ -82,18 +97,22 @@ def get_utilization_histogram(datasetId: str,
     if primitive is not None:
         if primitive not in db[datasetId]['sparseUtilizationList']['primitives']:
             raise HTTPException(status_code=404, detail='No utilization data for primitive: %s' % primitive)
-        if locations:
-            ret['locations'] = {}
-            for location in locations:
-                ret['locations'][location] = db[datasetId]['sparseUtilizationList']['primitives'][primitive].calcUtilizationForLocation(bins, begin, end, location)
-        else:
-            ret['data'] = db[datasetId]['sparseUtilizationList']['primitives'][primitive].calcUtilizationHistogram(bins, begin, end)
-    elif locations:
-        ret['locations'] = {}
-        for location in locations:
-            ret['locations'][location] = db[datasetId]['sparseUtilizationList']['intervals'].calcUtilizationForLocation(bins, begin, end, location)
+        sul = db[datasetId]['sparseUtilizationList']['primitives'][primitive]
+    else:
+        sul = db[datasetId]['sparseUtilizationList']['intervals']
+
+    cacheKey = ('utilizationHistogram', primitive, tuple(locations) if locations else None, bins, begin, end)
+    if locations:
+        matrix = db.getCachedHistogram(datasetId, cacheKey, lambda: sul.calcUtilizationMatrix(bins, begin, end, locations))
+        if packed:
+            # Row i of the matrix is the location at strings[i]
+            return packedResponse({'locations': matrix}, {'begin': begin, 'end': end, 'bins': bins}, locations)
+        ret['locations'] = {location: row.tolist() for location, row in zip(locations, matrix)}
     else:
-        ret['data'] = db[datasetId]['sparseUtilizationList']['intervals'].calcUtilizationHistogram(bins, begin, end)
+        data = db.getCachedHistogram(datasetId, cacheKey, lambda: sul.calcUtilizationHistogram(bins, begin, end))
+        if packed:
+            return packedResponse({'data': data}, {'begin': begin, 'end': end, 'bins': bins})
+        ret['data'] = data.tolist()
 
     ret['metadata'] = {'begin': begin, 'end': end, 'bins': bins}
     return ret
@@ -0,0 +1,104 @@
+import json
+import struct
+
+import numpy as np
+from fastapi import HTTPException
+from starlette.responses import Response
+
+# Binary alternative to JSON for the interval / histogram endpoints; clients
+# ask for it with ?format=packed, or with this media type in their Accept
+# header. Everything is little-endian:
+#
+#   bytes 0-3    magic: b'TRVP'
+#   bytes 4-7    uint32 format version (1)
+#   bytes 8-11   uint32 length of the JSON header (headerLength), in bytes
+#   bytes 12-... the JSON header (UTF-8), followed by zeros up to the next
+#                multiple of 8 bytes from the start of the response: the
+#                first array body starts at (12 + headerLength + 7) // 8 * 8
+#   ...          the array bodies, each starting on an 8-byte boundary
+#
+# The JSON header looks like:
+#   {
+#     "metadata": {...},          (whatever the JSON response's metadata is)
+#     "strings": ["...", ...],    (string table that int32 columns can refer to)
+#     "arrays": [{"name": "data", "dtype": "float64", "shape": [100],
+#                 "offset": 0, "byteLength": 800}, ...]
+#   }
+# where each offset is relative to the start of the first array body, and arrays
+# are stored in C (row-major) order. dtype is one of float64, int64, uint64,
+# int32, or uint8
+packedMediaType = 'application/x-traveler-packed'
+packedMagic = b'TRVP'
+packedVersion = 1
+packedDtypes = {
+    'float64': '<f8',
+    'int64': '<i8',
+    'uint64': '<u8',
+    'int32': '<i4',
+    'uint8': '|u1'
+}
+
+def wantsPacked(responseFormat=None, accept=None):
+    # ?format= wins over the Accept header; the endpoints can also be called
+    # directly (e.g. by the profiler), where neither argument is a string
+    if isinstance(responseFormat, str) and responseFormat != '':
+        if responseFormat == 'json':
+            return False
+        if responseFormat == 'packed':
+            return True
+        raise HTTPException(status_code=400, detail='Unknown format: %s (expected json or packed)' % responseFormat)
+    return isinstance(accept, str) and packedMediaType in accept
+
+def align(size):
+    return (size + 7) // 8 * 8
+
+def pack(arrays, metadata=None, strings=None):
+    # arrays: {name: array-like}; returns the encoded bytes
+    header = {'metadata': metadata or {}, 'strings': strings or [], 'arrays': []}
+    bodies = []
+    offset = 0
+    for name, values in arrays.items():
+        values = np.asarray(values)
+        dtype = 'float64' if values.dtype.kind == 'f' else values.dtype.name
+        if dtype not in packedDtypes:
+            raise ValueError('Unsupported dtype for %s: %s' % (name, values.dtype))
+        body = np.ascontiguousarray(values, dtype=packedDtypes[dtype]).tobytes()
+        header['arrays'].append({'name': name, 'dtype': dtype, 'shape': list(values.shape), 'offset': offset, 'byteLength': len(body)})
+        bodies.append(body)
+        bodies.append(b'\x00' * (align(len(body)) - len(body)))
+        offset += align(len(body))
+    headerBytes = json.dumps(header).encode('utf-8')
+    prefix = packedMagic + struct.pack('<II', packedVersion, len(headerBytes))
+    padding = b'\x00' * (align(len(prefix) + len(headerBytes)) - len(prefix) - len(headerBytes))
+    return b''.join([prefix, headerBytes, padding] + bodies)
+
+def packedResponse(arrays, metadata=None, strings=None):
+    return Response(content=pack(arrays, metadata, strings), media_type=packedMediaType)
+
+def packIntervals(intervals, rows, metadata=None):
+    # The interval table's columns for some of its rows; location / primitive
+    # are indices into the string table (or -1), parent is -1 for intervals
+    # without one, and guid / parentGuid are only meaningful when flags says so
+    # (see the flag bits in data_store/intervalTable.py). Metrics, children,
+    # and any other attributes (flag 4) need /intervals/{intervalId}
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = intervals.columns
+    locations = columns['location'][rows]
+    primitives = columns['primitive'][rows]
+    # Only send the strings that these intervals use
+    stringIds = np.unique(np.concatenate((locations, primitives)))
+    stringIds = stringIds[stringIds >= 0]
+    # (the extra entry at the end maps -1 to -1)
+    remap = np.full(len(intervals.strings) + 1, -1, dtype=np.int32)
+    remap[stringIds] = np.arange(len(stringIds), dtype=np.int32)
+    return packedResponse({
+        'intervalId': rows,
+        'enter': np.asarray(columns['enter'][rows], dtype=np.int64),
+        'leave': np.asarray(columns['leave'][rows], dtype=np.int64),
+        'location': remap[locations],
+        'primitive': remap[primitives],
+        'parent': np.asarray(columns['parent'][rows], dtype=np.int64),
+        'guid': np.asarray(columns['guid'][rows], dtype=np.uint64),
+        'parentGuid': np.asarray(columns['parentGuid'][rows], dtype=np.uint64),
+        'flags': np.asarray(columns['flags'][rows], dtype=np.uint8)
+    }, metadata, [intervals.strings[stringId] for stringId in stringIds.tolist()])
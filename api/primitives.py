@@ -1,6 +1,7 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, Query
 
 from . import db, validateDataset
+from .packing import wantsPacked, packedResponse
 
 router = APIRouter()
 
@@ -20,8 +21,11 @@ def getUtilizationForPrimitive(datasetId: str,
                                bins: int = 100,
                                begin: int = None,
                                end: int = None,
-                               duration_bins: int = 100):
+                               duration_bins: int = 100,
+                               responseFormat: str = Query(None, alias='format'),
+                               accept: str = Header(None)):
     datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
+    packed = wantsPacked(responseFormat, accept)
 
     if begin is None:
         begin = db[datasetId]['info']['intervalDomain'][0]
@@ -38,6 +42,8 @@ def getUtilizationForPrimitive(datasetId: str,
                                                                                                durationEnd,
                                                                                                duration_bins),
            'metadata': {'begin': begin, 'end': end, 'bins': bins}}
+    if packed:
+        return packedResponse({'data': ret['data']}, ret['metadata'])
     return ret
 
 # @router.get('/datasets/{datasetId}/primitives/{primitive}/intervalHistogram')
@@ -53,8 +59,10 @@ def getUtilizationForPrimitive(datasetId: str,
 #     return db[datasetId]['intervalHistograms'].get(primitive, {})
 
 @router.get('/datasets/{datasetId}/intervalHistograms')
-def getIntervalHistogram(datasetId: str, bins: int = 100, begin: int = None, end: int = None, primitive: str = None):
+def getIntervalHistogram(datasetId: str, bins: int = 100, begin: int = None, end: int = None, primitive: str = None,
+                         responseFormat: str = Query(None, alias='format'), accept: str = Header(None)):
     datasetId = validateDataset(datasetId, requiredFiles=['otf2'], filesMustBeReady=['otf2'])
+    packed = wantsPacked(responseFormat, accept)
     if primitive is None or primitive == '':
         primitive = 'all_primitives'
 
@@ -63,7 +71,13 @@ def getIntervalHistogram(datasetId: str, bins: int = 100, begin: int = None, end
     if end is None:
         end = int(db[datasetId]['info']['intervalDurationDomain'][primitive][1])
 
-    ret = {'data': db[datasetId]['sparseUtilizationList']['intervalHistograms'][primitive].calcIntervalHistogram(bins, begin, end),
+    def computeHistogram():
+        return db[datasetId]['sparseUtilizationList']['intervalHistograms'][primitive].calcIntervalHistogram(bins, begin, end)
+
+    data = db.getCachedHistogram(datasetId, ('intervalHistograms', primitive, bins, begin, end), computeHistogram)
+    if packed:
+        return packedResponse({'data': data}, {'begin': begin, 'end': end, 'bins': bins})
+    ret = {'data': data.tolist(),
            'metadata': {'begin': begin, 'end': end, 'bins': bins}}
     return ret
 
@@ -92,13 +106,18 @@ def getIntervalList(datasetId: str, \
     if end is None:
         end = db[datasetId]['info']['intervalDomain'][1]
 
+    # Only the columns are needed here; no need to build full interval records
+    intervals = db[datasetId]['intervals']
     for i in db[datasetId]['intervalIndex'].iterOverlap(begin, end):
-        cur = db[datasetId]['intervals'][i.data]
-        if cur['Location'] not in locations or (primitive != 'all_primitives' and primitive != cur['Primitive']):
+        row = int(i.data)
+        curLocation = intervals.getString('location', row)
+        if curLocation not in locations or (primitive != 'all_primitives' and primitive != intervals.getString('primitive', row)):
             continue
-        interval_length = (cur['leave']['Timestamp'] - cur['enter']['Timestamp'])
+        curEnter = int(intervals.columns['enter'][row])
+        curLeave = int(intervals.columns['leave'][row])
+        interval_length = (curLeave - curEnter)
         if enter <= interval_length <= leave:
-            if cur['Location'] not in locList:
-                locList[cur['Location']] = list()
-            locList[cur['Location']].append({'begin': cur['enter']['Timestamp'], 'end': cur['leave']['Timestamp']})
+            if curLocation not in locList:
+                locList[curLocation] = list()
+            locList[curLocation].append({'begin': curEnter, 'end': curLeave})
     return locList
\ No newline at end of file
@@ -4,6 +4,7 @@ import argparse
 import subprocess
 import asyncio
 from data_store import DataStore, logToConsole
+from data_store.eventColumns import EventColumnsFile
 
 parser = argparse.ArgumentParser( \
     description=('Bundle data directly from phylanx stdout, individual tree / '
@@ -31,7 +32,8 @@ parser.add_argument('-p', '--performance', dest='performance', type=str, metavar
 parser.add_argument('-g', '--graph', dest='graph', type=str, metavar='path', nargs='*', default=[],
                     help='Input DOT-formatted links as its own file')
 parser.add_argument('-o', '--otf2', dest='otf2', type=str, metavar='path', nargs='*', default=[],
-                    help='Input otf2 trace (e.g. OTF2_archive/APEX.otf2)')
+                    help=('Input otf2 trace (e.g. OTF2_archive/APEX.otf2), or a columnar '
+                          'event file (.npz) created by otf2_to_columns.py'))
 parser.add_argument('-y', '--physl', dest='physl', type=str, metavar='path', nargs='*', default=[],
                     help='Input physl source code file')
 parser.add_argument('-n', '--python', dest='python', type=str, metavar='path', nargs='*', default=[],
@@ -40,6 +42,9 @@ parser.add_argument('-c', '--cpp', dest='cpp', type=str, metavar='path', nargs='
                     help='Input C++ source code file')
 parser.add_argument('-s', '--debug', dest='debug', action='store_true',
                     help='Store additional information for debugging source files, etc.')
+parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help=('Number of worker processes to use for the per-location stages of '
+                          'OTF2 ingest (default: 1)'))
 parser.add_argument('-a', '--tags', dest='tags', type=str,
                     help=('Tags to be attached to the dataset (when bundling multiple '
                           'datasets, the same tags are attached to all datasets bundled '
@@ -66,7 +71,7 @@ async def main():
     args = vars(parser.parse_args())
     if 'folder' in args and args['folder'] is not None:
         args['folder'] = args['folder'].strip('/ ')
-    db = DataStore(args['dbDir'], args['debug'])
+    db = DataStore(args['dbDir'], args['debug'], args['jobs'])
     await db.load()
 
     inputs = {}
@@ -171,7 +176,10 @@ async def main():
             # Handle otf2
             if 'otf2' in paths:
                 db.addSourceFile(datasetId, paths['otf2'], 'otf2')
-                await db.processOtf2(datasetId, FakeFile(paths['otf2']))
+                if paths['otf2'].endswith('.npz'):
+                    await db.processOtf2(datasetId, EventColumnsFile(paths['otf2']))
+                else:
+                    await db.processOtf2(datasetId, FakeFile(paths['otf2']))
 
 
             # Save all the data
@@ -6,12 +6,34 @@ import errno
 import uuid
 from copy import deepcopy
 import diskcache
+from .procMetricColumns import ProcMetricColumns
+from .intervalTable import IntervalTable
+from .sparseUtilizationStore import SparseUtilizationStore
+from .intervalIndex import IntervalIndex
+from .histogramCache import HistogramCache
+from .lazyDataset import LazyDataset
 
 # Possible files / metadata structures that we create / open / update
-diskCacheIndices = ['info', 'primitives', 'primitiveLinks', 'intervals', 'guids', 'events', 'procMetrics']
+diskCacheIndices = ['info', 'primitives', 'primitiveLinks', 'guids', 'events']
 requiredDiskCacheIndices = ['info', 'primitives', 'primitiveLinks']
-pickles = ['trees', 'physl', 'python', 'cpp', 'sparseUtilizationList', 'intervalIndex', 'dependencyTree']
+pickles = ['trees', 'physl', 'python', 'cpp', 'dependencyTree']
 requiredPickleDicts = ['trees']
+# Directories of NumPy columns, and the classes that load / save them
+columnStores = {
+    'procMetrics': ProcMetricColumns,
+    'intervals': IntervalTable,
+    'sparseUtilizationList': SparseUtilizationStore,
+    'intervalIndex': IntervalIndex
+}
+# Files that older versions of traveler-integrated wrote instead of a column
+# store; there's no converter for these, so datasets that still have them need
+# to be bundled again
+legacyFiles = {
+    'procMetrics': 'procMetrics.diskCacheIndex',
+    'intervals': 'intervals.diskCacheIndex',
+    'sparseUtilizationList': 'sparseUtilizationList.pickle',
+    'intervalIndex': 'intervalIndex.pickle'
+}
 defaultInfo = {
     'sourceFiles': [],
     'tags': {},
@@ -19,38 +41,56 @@ defaultInfo = {
     'label': 'Untitled dataset'
 }
 
+def loadPickle(path):
+    with open(path, 'rb') as pickleFile:
+        return pickle.load(pickleFile)
+
 async def logToConsole(value, end='\n'):
     sys.stdout.write('\x1b[0;32;40m' + value + end + '\x1b[0m')
     sys.stdout.flush()
 
 class DataStore:
-    def __init__(self, dbDir='/tmp/traveler-integrated', debugSources=False):
+    def __init__(self, dbDir='/tmp/traveler-integrated', debugSources=False, ingestWorkers=1,
+                 histogramCacheBytes=256 * 1024 * 1024, histogramDiskCacheBytes=0):
         self.dbDir = dbDir
         self.debugSources = debugSources
+        # Number of processes to use for the per-location stages of OTF2 ingest
+        self.ingestWorkers = max(1, ingestWorkers)
         if not os.path.exists(self.dbDir):
             os.makedirs(self.dbDir)
 
         self.datasets = {}
+        # Histogram results that the API has already computed (see
+        # getCachedHistogram)
+        self.histogramCache = HistogramCache(self.dbDir, histogramCacheBytes, histogramDiskCacheBytes)
 
     async def load(self, log=logToConsole):
-        # Load any files that exist (or create missing required files)
+        # Register any files that exist (or complain about missing required
+        # files); apart from info, nothing is actually loaded until it's
+        # first accessed
         for datasetId in os.listdir(self.dbDir):
-            self.datasets[datasetId] = {}
             idDir = os.path.join(self.dbDir, datasetId)
+            for stype, legacyFile in legacyFiles.items():
+                if os.path.exists(os.path.join(idDir, legacyFile)) and not os.path.exists(os.path.join(idDir, stype + '.columns')):
+                    raise RuntimeError('%s was bundled by an older version of traveler-integrated (it has %s instead of %s.columns); '
+                                       'delete it and bundle the dataset again' % (idDir, legacyFile, stype))
+            self.datasets[datasetId] = LazyDataset()
             for ctype in diskCacheIndices:
                 cpath = os.path.join(idDir, ctype + '.diskCacheIndex')
                 if os.path.exists(cpath):
-                    await log('Loading %s %s...' % (datasetId, ctype))
-                    self[datasetId][ctype] = diskcache.Index(cpath)
+                    self[datasetId].register(ctype, lambda cpath=cpath: diskcache.Index(cpath))
                 elif ctype in requiredDiskCacheIndices:
                     raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), cpath)
             for ptype in pickles:
                 ppath = os.path.join(idDir, ptype + '.pickle')
                 if os.path.exists(ppath):
-                    await log('Loading %s %s...' % (datasetId, ptype))
-                    self[datasetId][ptype] = pickle.load(open(ppath, 'rb'))
+                    self[datasetId].register(ptype, lambda ppath=ppath: loadPickle(ppath))
                 elif ptype in requiredPickleDicts:
                     raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), ppath)
+            for stype, storeClass in columnStores.items():
+                spath = os.path.join(idDir, stype + '.columns')
+                if os.path.exists(spath):
+                    self[datasetId].register(stype, lambda spath=spath, storeClass=storeClass: storeClass.load(spath))
             for key, defaultValue in defaultInfo.items():
                 self[datasetId]['info'][key] = self[datasetId]['info'].get(key, deepcopy(defaultValue))
             self[datasetId]['info']['datasetId'] = datasetId
@@ -63,6 +103,7 @@ class DataStore:
         return datasetId in self.datasets
 
     def __delitem__(self, datasetId):
+        self.histogramCache.invalidate(datasetId, deleted=True)
         del self.datasets[datasetId]
         idDir = os.path.join(self.dbDir, datasetId)
         if os.path.exists(idDir):
@@ -82,7 +123,7 @@ class DataStore:
         idDir = os.path.join(self.dbDir, datasetId)
         if datasetId in self or os.path.exists(idDir):
             del self[datasetId]
-        self.datasets[datasetId] = {}
+        self.datasets[datasetId] = LazyDataset()
         os.makedirs(idDir)
         for ctype in requiredDiskCacheIndices:
             cpath = os.path.join(idDir, ctype + '.diskCacheIndex')
@@ -99,6 +140,7 @@ class DataStore:
         sourceFiles = self[datasetId]['info']['sourceFiles']
         sourceFiles.append({'fileName': fileName, 'fileType': fileType, 'stillLoading': True})
         self[datasetId]['info']['sourceFiles'] = sourceFiles
+        self.histogramCache.invalidate(datasetId)
 
     def finishLoadingSourceFile(self, datasetId, fileName):
         sourceFiles = self[datasetId]['info']['sourceFiles']
@@ -109,6 +151,13 @@ class DataStore:
             raise Exception("Can't finish unknown source file: " + fileName)
         # Tell the diskcache that something has been updated
         self[datasetId]['info']['sourceFiles'] = sourceFiles
+        # Anything computed while the file was loading is stale
+        self.histogramCache.invalidate(datasetId)
+
+    def getCachedHistogram(self, datasetId, key, compute):
+        # key should be a tuple of the endpoint's name + its parameters;
+        # compute() is only called if there isn't a cached result already
+        return self.histogramCache.get(datasetId, key, compute)
 
     def rename(self, datasetId, newLabel):
         # Remove any leading or trailing slashes or spaces
@@ -147,7 +196,8 @@ class DataStore:
 
     async def save(self, datasetId, log=logToConsole):
         idDir = os.path.join(self.dbDir, datasetId)
-        for ctype in self[datasetId].keys():
+        # Anything that was never loaded is still the same as it is on disk
+        for ctype in self[datasetId].loadedKeys():
             if ctype in diskCacheIndices:
                 await log('Saving %s diskCache.Index: %s' % (datasetId, ctype))
                 self[datasetId][ctype].cache.close()
@@ -155,6 +205,9 @@ class DataStore:
                 await log('Saving %s pickle: %s' % (datasetId, ctype))
                 with open(os.path.join(idDir, ctype + '.pickle'), 'wb') as pickleFile:
                     pickle.dump(self[datasetId][ctype], pickleFile)
+            if ctype in columnStores:
+                await log('Saving %s columns: %s' % (datasetId, ctype))
+                self[datasetId][ctype].save(os.path.join(idDir, ctype + '.columns'))
 
     def processPrimitive(self, datasetId, primitiveName, source=None):
         primitives = self[datasetId]['primitives']
@@ -217,4 +270,4 @@ class DataStore:
     from ._csv_functions import processCsvLine, processCsv, processCsvFile
     from ._code_functions import processCode, processCodeFile
     from ._log_functions import processPhylanxLog, processPhylanxLogFile
-    from ._otf2_functions import processEvent, processOtf2, processRawTrace, combineIntervals, buildIntervalTree, connectIntervals, buildSparseUtilizationLists, buildDependencyTree
+    from ._otf2_functions import processEvent, addInterval, processOtf2, processRawTrace, combineIntervals, buildIntervalTree, connectIntervals, buildSparseUtilizationLists, buildDependencyTree
@@ -1,13 +1,19 @@
-import copy
 import os
 import re
 import gc
-import diskcache
+import asyncio
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from sortedcontainers import SortedList
-from intervaltree import Interval, IntervalTree
+from .intervalBuilder import IntervalBuilder
+from .intervalIndex import IntervalIndex
+from .intervalTable import IntervalTable, parseGuid, hasGuid, hasParentGuid, hasAttrs, hasEnterGuid, hasEnterParentGuid
+from .guidIndex import GuidIndex
+from .otf2Tokenizer import tokenizeLine
+from .procMetricColumns import ProcMetricColumns
 from .sparseUtilizationList import SparseUtilizationList
-from .dependencyTree import DependencyTreeNode
+from .sparseUtilizationStore import SparseUtilizationStore
+from .dependencyTree import DependencyTreeNode, AggregatedBlock, get_primitive_pretty_name_with_prefix
 from . import logToConsole
 
 # Helper function from https://stackoverflow.com/a/4836734/1058935 for
@@ -17,18 +23,30 @@ def natural_sort(l):
     alphanum_key = lambda key: [ convert(c) for c in re.split('([0-9]+)', key) ]
     return sorted(l, key = alphanum_key)
 
-# Tools for handling OTF2 traces
-eventLineParser = re.compile(r'^((?:ENTER)|(?:LEAVE))\s+(\d+)\s+(\d+)\s+(.*)$')
-attrParsers = {
-    'ENTER': r'(Region): "([^"]*)"',
-    'LEAVE': r'(Region): "([^"]*)"'
-}
-addAttrLineParser = re.compile(r'^\s+ADDITIONAL ATTRIBUTES: (.*)$')
-addAttrSplitter = re.compile(r'\), \(')
-addAttrParser = re.compile(r'\(?"([^"]*)" <\d+>; [^;]*; ([^\)]*)')
-
-metricLineParser = re.compile(r'^METRIC\s+(\d+)\s+(\d+)\s+Metric:[\s\d,]+Values?: \("([^"]*)" <\d+>; [^;]*; ([^\)]*)')
-memInfoMetricParser = re.compile(r'^METRIC\s+(\d+)\s+(\d+)\s+Metric:[\s\d,]+Values?: \("meminfo:([^"]*)" <\d+>; [^;]*; ([^\)]*)')
+def shardLocations(locations, workers):
+    # Deal locations out round-robin so that each worker gets a similar mix of
+    # busy and idle threads
+    locations = list(locations)
+    workers = max(1, min(workers, len(locations)))
+    return [locations[i::workers] for i in range(workers)]
+
+async def iterTokens(file):
+    # Columnar event files (see eventColumns.py) come already tokenized;
+    # anything else is a stream of otf2-print lines
+    if hasattr(file, 'iterTokens'):
+        async for token in file.iterTokens():
+            yield None, token
+    else:
+        async for line in file:
+            yield line, tokenizeLine(line)
+
+async def mapShards(workers, func, shards):
+    # Run func once per shard, in a process pool if we have more than one worker
+    if workers <= 1 or len(shards) <= 1:
+        return [func(shard) for shard in shards]
+    loop = asyncio.get_event_loop()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return await asyncio.gather(*[loop.run_in_executor(pool, func, shard) for shard in shards])
 
 def processEvent(self, datasetId, event):
     newR = seenR = 0
@@ -45,15 +63,24 @@ def processEvent(self, datasetId, event):
                 primitive['eventCount'] = 0
             primitive['eventCount'] += 1
         self[datasetId]['primitives'][primitiveName] = primitive
-    # Add enter / leave events to per-location lists
+    # Stream enter / leave events into per-location interval builders
     if event['Event'] == 'ENTER' or event['Event'] == 'LEAVE':
-        if not event['Location'] in self.sortedEventsByLocation:
-            # TODO: use BPlusTree instead of blist? For big enough runs, piling
-            # all this up in memory could be a problem...
-            self.sortedEventsByLocation[event['Location']] = SortedList()
-        self.sortedEventsByLocation[event['Location']].add((event['Timestamp'], event))
+        if not event['Location'] in self.intervalBuilders:
+            self.intervalBuilders[event['Location']] = IntervalBuilder()
+        for intervalObj in self.intervalBuilders[event['Location']].addEvent(event):
+            self.addInterval(datasetId, event['Location'], intervalObj)
     return (newR, seenR)
 
+def addInterval(self, datasetId, location, intervalObj):
+    intervalId = self[datasetId]['intervals'].append(intervalObj)
+    # Update intervalDomain
+    self.intervalDomain[0] = min(self.intervalDomain[0], intervalObj['enter']['Timestamp'])
+    self.intervalDomain[1] = max(self.intervalDomain[1], intervalObj['leave']['Timestamp'])
+    # Later per-location stages look up each location's intervalIds
+    if location not in self.intervalIdsByLocation:
+        self.intervalIdsByLocation[location] = array('q')
+    self.intervalIdsByLocation[location].append(intervalId)
+
 async def processOtf2(self, datasetId, file, log=logToConsole):
     # Run each substep, with manual calls to python's garbage collector in
     # between
@@ -72,14 +99,21 @@ async def processOtf2(self, datasetId, file, log=logToConsole):
     self.finishLoadingSourceFile(datasetId, file.name)
 
 async def processRawTrace(self, datasetId, file, log):
-    # Set up database file for procMetrics
+    # procMetrics samples are collected in growable columns, and saved once
     idDir = os.path.join(self.dbDir, datasetId)
-    procMetrics = self[datasetId]['procMetrics'] = diskcache.Index(os.path.join(idDir, 'procMetrics.diskCacheIndex'))
+    procMetrics = self[datasetId]['procMetrics'] = ProcMetricColumns()
     procMetricList = self[datasetId]['info']['procMetricList'] = []
 
-    # Temporary counters / lists for sorting
+    # Set up the table of intervals, which are combined from enter / leave
+    # events as they stream in
+    self[datasetId]['intervals'] = IntervalTable(os.path.join(idDir, 'intervals.columns'))
+
+    # Temporary counters / per-location state
     numEvents = 0
-    self.sortedEventsByLocation = {}
+    self.intervalBuilders = {}
+    self.intervalIdsByLocation = {}
+    # Keep track of the earliest and latest timestamps we see
+    self.intervalDomain = [float('inf'), float('-inf')]
     await log('Parsing OTF2 events (.=2500 events)')
     newR = seenR = 0
     currentEvent = None
@@ -89,22 +123,15 @@ async def processRawTrace(self, datasetId, file, log):
     unsupportedSkippedLines = 0
     badAddAttrLines = 0
 
-    async for line in file:
-        eventLineMatch = eventLineParser.match(line)
-        addAttrLineMatch = addAttrLineParser.match(line)
-        metricLineMatch = metricLineParser.match(line)
-        if currentEvent is None and eventLineMatch is None and metricLineMatch is None:
+    async for line, token in iterTokens(file):
+        recordType = token[0] if token is not None else None
+        if currentEvent is None and recordType != 'ENTER' and recordType != 'LEAVE' and recordType != 'METRIC':
             # This is a blank / header line
             continue
 
-        if metricLineMatch is not None:
+        if recordType == 'METRIC':
             # This is a metric line
-            location = metricLineMatch.group(1)
-            timestamp = int(metricLineMatch.group(2))
-            metricType = metricLineMatch.group(3)
-            # Usually group(4) is just a number, but sometimes we can get input
-            # like "DOUBLE <2>; 1234.0000"... we want the last number
-            value = float(re.findall('[0-9.]+', metricLineMatch.group(4))[-1])
+            _, location, timestamp, metricType, value = token
 
             if metricType.startswith('PAPI'):
                 if currentEvent is None:
@@ -119,14 +146,10 @@ async def processRawTrace(self, datasetId, file, log):
                     self[datasetId]['info']['procMetricList'] = procMetricList
             else: # do the other meminfo status io parsing here
                 if metricType not in procMetrics:
-                    cMetric = dict()
                     procMetricList.append(metricType)
                     self[datasetId]['info']['procMetricList'] = procMetricList
-                else:
-                    cMetric = procMetrics[metricType]
-                cMetric[str(timestamp)] = {'Timestamp': timestamp, 'Value':  value}
-                procMetrics[metricType] = cMetric
-        elif eventLineMatch is not None:
+                procMetrics.append(metricType, timestamp, value)
+        elif recordType == 'ENTER' or recordType == 'LEAVE':
             # This is the beginning of a new event; process the previous one
             if currentEvent is not None:
                 counts = self.processEvent(datasetId, currentEvent)
@@ -139,23 +162,19 @@ async def processRawTrace(self, datasetId, file, log):
                 # Add to primitive / guid counts
                 newR += counts[0]
                 seenR += counts[1]
-            currentEvent = {'metrics': {}}
-            currentEvent['Event'] = eventLineMatch.group(1)
-            currentEvent['Location'] = eventLineMatch.group(2)
-            currentEvent['Timestamp'] = int(eventLineMatch.group(3))
-            attrs = eventLineMatch.group(4)
-            for attrMatch in re.finditer(attrParsers[currentEvent['Event']], attrs):
-                currentEvent[attrMatch.group(1)] = attrMatch.group(2)
-        elif currentEvent is not None and addAttrLineMatch is not None:
+            _, location, timestamp, region = token
+            currentEvent = {'metrics': {}, 'Event': recordType, 'Location': location, 'Timestamp': timestamp}
+            if region is not None:
+                currentEvent['Region'] = region
+        elif recordType == 'ATTRS':
             # This line contains additional event attributes
-            attrList = addAttrSplitter.split(addAttrLineMatch.group(1))
-            for attrStr in attrList:
-                attr = addAttrParser.match(attrStr)
+            for attr in token[1]:
                 if attr is None:
                     badAddAttrLines += 1
-                    await log('\nWARNING: omitting data from bad ADDITIONAL ATTRIBUTES line:\n%s' % line)
+                    # (columnar event files don't have lines; show the token instead)
+                    await log('\nWARNING: omitting data from bad ADDITIONAL ATTRIBUTES line:\n%s' % (line if line is not None else repr(token)))
                     continue
-                currentEvent[attr.group(1)] = attr.group(2) #pylint: disable=unsupported-assignment-operation
+                currentEvent[attr[0]] = attr[1] #pylint: disable=unsupported-assignment-operation
         else:
             # This is a line that we aren't capturing (yet), e.g. MPI_SEND
             unsupportedSkippedLines += 1
@@ -164,6 +183,7 @@ async def processRawTrace(self, datasetId, file, log):
         counts = self.processEvent(datasetId, currentEvent)
         newR += counts[0]
         seenR += counts[1]
+    procMetrics.finalize()
     await log('')
     await log('Finished processing %i events' % numEvents)
     await log('New primitives: %d, References to existing primitives: %d' % (newR, seenR))
@@ -172,195 +192,119 @@ async def processRawTrace(self, datasetId, file, log):
     await log('Lines skipped because they are not yet supported: %d' % unsupportedSkippedLines)
 
     # Now that we've seen all the locations, store that list in our info
-    self[datasetId]['info']['locationNames'] = natural_sort(self.sortedEventsByLocation.keys())
+    self[datasetId]['info']['locationNames'] = natural_sort(self.intervalBuilders.keys())
 
 async def combineIntervals(self, datasetId, log):
-    # Set up database file
-    idDir = os.path.join(self.dbDir, datasetId)
-    intervals = self[datasetId]['intervals'] = diskcache.Index(os.path.join(idDir, 'intervals.diskCacheIndex'))
-
-    # Helper function for creating interval objects
-    async def createNewInterval(event, lastEvent, intervalId):
-        newInterval = {'enter': {}, 'leave': {}, 'intervalId': intervalId, 'parent': None, 'children': []}
-        # Copy all of the attributes from the OTF2 events into the interval object. If the values
-        # differ (or it's the timestamp), put them in nested enter / leave objects. Otherwise, put
-        # them directly in the interval object
-        for attr in set(event.keys()).union(lastEvent.keys()):
-            if attr not in event:
-                newInterval['enter'][attr] = lastEvent[attr]  # pylint: disable=unsubscriptable-object
-            elif attr not in lastEvent:  # pylint: disable=E1135
-                newInterval['leave'][attr] = event[attr]
-            elif attr != 'Timestamp' and attr != 'metrics' and event[attr] == lastEvent[attr]:  # pylint: disable=unsubscriptable-object
-                newInterval[attr] = event[attr]
-            else:
-                if attr == 'Location':
-                    await log('')
-                    await log('\nWARNING: ENTER and LEAVE have different locations')
-                newInterval['enter'][attr] = lastEvent[attr]  # pylint: disable=unsubscriptable-object
-                newInterval['leave'][attr] = event[attr]
-        return newInterval
-
-    await log('Combining enter / leave events into intervals (.=2500 intervals)')
-    numIntervals = mismatchedIntervals = missingPrimitives = 0
-
-    # Keep track of the earliest and latest timestamps we see
-    intervalDomain = [float('inf'), float('-inf')]
-
-    # Combine the sorted enter / leave events into intervals
-    for eventList in self.sortedEventsByLocation.values():
-        lastEventStack = []
-        currentInterval = None
-        for _, event in eventList:
-            assert event is not None
-            intervalId = str(numIntervals)
-            if event['Event'] == 'ENTER':
-                # check if there is an enter event in the stack, push a dummy leave event
-                if len(lastEventStack) > 0:
-                    dummyEvent = copy.deepcopy(lastEventStack[-1])
-                    dummyEvent['Event'] = 'LEAVE'
-                    dummyEvent['Timestamp'] = event['Timestamp'] - 1  # add a new dummy leave event in 1 time unit ago
-                    if 'metrics' in event:
-                        dummyEvent['metrics'] = copy.deepcopy(event['metrics'])
-                    currentInterval = await createNewInterval(dummyEvent, lastEventStack[-1], intervalId)
-                lastEventStack.append(event)
-            elif event['Event'] == 'LEAVE':
-                # Finish a interval
-                if len(lastEventStack) == 0:
-                    # TODO: factorial data used to trigger this... why?
-                    await log('')
-                    await log('\nWARNING: omitting LEAVE event without a prior ENTER event (%s)' % event['Primitive'])
-                    continue
-                lastEvent = lastEventStack.pop()
-                currentInterval = await createNewInterval(event, lastEvent, intervalId)
-                if len(lastEventStack) > 0:
-                    lastEventStack[-1]['Timestamp'] = event['Timestamp'] + 1  # move the enter event to after 1 time unit
-            if currentInterval is not None:
-                # Count whether the primitive attribute is missing or differed between enter / leave
-                if 'Primitive' not in currentInterval:
-                    if 'Primitive' not in currentInterval['enter'] or 'Primitive' not in currentInterval['leave']:
-                        missingPrimitives += 1
-                        currentInterval['Primitive'] = '(primitive name missing)'
-                    else:
-                        mismatchedIntervals += 1
-                        # Use the enter event's primitive name
-                        currentInterval['Primitive'] = currentInterval['enter']['Primitive']
-                intervals[intervalId] = currentInterval
-                # Update intervalDomain
-                intervalDomain[0] = min(intervalDomain[0], currentInterval['enter']['Timestamp'])
-                intervalDomain[1] = max(intervalDomain[1], currentInterval['leave']['Timestamp'])
-                # Log that we've finished the finished interval
-                numIntervals += 1
-                if numIntervals % 2500 == 0:
-                    await log('.', end='')
-                if numIntervals % 100000 == 0:
-                    await log('processed %i intervals' % numIntervals)
-            currentInterval = None
-        # Make sure there are no trailing ENTER events
-        if len(lastEventStack) > 0:
-            # TODO: this seems to be triggered by recent distributed runs;
-            # probably not a big deal as they're usually shudown_action events?
+    # Most intervals were already combined while the raw trace streamed in;
+    # flush each location's reorder window to finish the rest
+    await log('Finishing intervals from the remaining enter / leave events')
+    mismatchedIntervals = missingPrimitives = lateEvents = 0
+    for location, builder in self.intervalBuilders.items():
+        for intervalObj in builder.finish():
+            self.addInterval(datasetId, location, intervalObj)
+        for warning in builder.warnings:
             await log('')
-            await log('\nWARNING: omitting trailing ENTER event (%s)' % lastEvent['Primitive'])
-
-    # Clean up temporary lists
-    del self.sortedEventsByLocation
+            await log('\n' + warning)
+        missingPrimitives += builder.missingPrimitives
+        mismatchedIntervals += builder.mismatchedIntervals
+        lateEvents += builder.lateEvents
+    self[datasetId]['intervals'].finalize()
+    if lateEvents > 0:
+        await log('\nWARNING: %i events arrived too far out of order to be sorted, and were combined in arrival order' % lateEvents)
 
     # Store the full domain of the data in the datasets' info
-    self[datasetId]['info']['intervalDomain'] = intervalDomain
+    self[datasetId]['info']['intervalDomain'] = self.intervalDomain
 
     await log('')
-    await log('Finished creating %i intervals; %i had no primitive name; %i had mismatching primitives (ENTER primitive used)' % (numIntervals, missingPrimitives, mismatchedIntervals))
+    await log('Finished creating %i intervals; %i had no primitive name; %i had mismatching primitives (ENTER primitive used)' % (len(self[datasetId]['intervals']), missingPrimitives, mismatchedIntervals))
 
-async def buildIntervalTree(self, datasetId, log):
-    await log('Building IntervalTree index of intervals (.=2500 intervals)')
-    count = 0
-    async def intervalIterator():
-        nonlocal count
-        for intervalId, intervalObj in self[datasetId]['intervals'].items():
-            enter = intervalObj['enter']['Timestamp']
-            leave = intervalObj['leave']['Timestamp'] + 1
-            # Need to add one because IntervalTree can't handle zero-length intervals
-            # (and because IntervalTree is not inclusive of upper bounds in queries)
-
-            iTreeInterval = Interval(enter, leave, intervalId)
+    # Clean up temporary state
+    del self.intervalBuilders
+    del self.intervalDomain
 
-            count += 1
-            if count % 2500 == 0:
-                await log('.', end='')
-            if count % 100000 == 0:
-                await log('processed %i intervals' % count)
-
-            yield iTreeInterval
-    # Iterate through all intervals to construct the main index:
-    # (TODO: temporarily disabling the garbage collector helps speed this up,
-    # but that's a hacky fix...)
-    gc.disable()
-    self[datasetId]['intervalIndex'] = IntervalTree([iTreeInterval async for iTreeInterval in intervalIterator()])
-    gc.enable()
-    gc.collect()
-    await log('')
-    await log('Finished indexing %i intervals' % count)
+async def buildIntervalTree(self, datasetId, log):
+    await log('Building index of intervals')
+    intervals = self[datasetId]['intervals']
+    self[datasetId]['intervalIndex'] = IntervalIndex.build(intervals.columns['enter'], intervals.columns['leave'])
+    await log('Finished indexing %i intervals' % len(self[datasetId]['intervalIndex']))
 
 async def connectIntervals(self, datasetId, log=logToConsole):
     await log('Connecting intervals with the same GUID (.=2500 intervals)')
 
-    guids = {}
-    # TODO: using a simple dict piles up GUIDs and intervalIds in memory... if
-    # this gets too big, a (REALLY slow) alternative to guids = {}:
-    #
-    # idDir = os.path.join(self.dbDir, datasetId)
-    # guids = self.datasets[datasetId]['guids'] = diskcache.Index(os.path.join(idDir, 'guids.diskCacheIndex'))
-    #
-    # ... also, I'm not totally sure that guids[guid].append(intervalId) below
-    # even works correctly with a diskcache.Index; it might need the slower
-    # guids[guid] = guids[guid] + [intervalId]
-
     intervals = self[datasetId]['intervals']
     intervalCount = missingCount = newLinks = seenLinks = 0
+    # Collect the links, and store them in the table's parent / child columns
+    # at the end
+    childRows = array('q')
+    parentRows = array('q')
+    # Each GUID's intervals, in the order that they're visited below
+    guidIndex = GuidIndex()
+
+    # Most intervals' GUIDs / primitives can be read straight from the
+    # columns; only intervals with extra attributes need their full records
+    enters = intervals.columns['enter'].tolist()
+    flags = intervals.columns['flags'].tolist()
+    guidColumn = intervals.columns['guid'].tolist()
+    parentGuidColumn = intervals.columns['parentGuid'].tolist()
+    primitiveColumn = intervals.columns['primitive'].tolist()
+
+    def getGuidKey(value):
+        parsed = parseGuid(value)
+        return value if parsed is None else parsed
+
+    def getPrimitive(row):
+        # The interval's own Primitive (not its enter / leave event's)
+        if flags[row] & hasAttrs:
+            return intervals[str(row)].get('Primitive', None)
+        primitive = primitiveColumn[row]
+        return None if primitive < 0 else intervals.strings[primitive]
+
+    def getLinkAttributes(row):
+        # Returns the interval's GUID, Parent GUID, Primitive, and its leave
+        # event's Primitive
+        if flags[row] & hasAttrs:
+            intervalObj = intervals[str(row)]
+            # Parent GUIDs refer to the one in the enter event, not the leave event
+            guid = intervalObj.get('GUID', intervalObj['enter'].get('GUID', None))
+            parentGuid = intervalObj.get('Parent GUID', intervalObj['enter'].get('Parent GUID', None))
+            return (None if guid is None else getGuidKey(guid),
+                    None if parentGuid is None else getGuidKey(parentGuid),
+                    intervalObj.get('Primitive', intervalObj['enter'].get('Primitive', None)),
+                    intervalObj['leave'].get('Primitive', None))
+        return (guidColumn[row] if flags[row] & (hasGuid | hasEnterGuid) else None,
+                parentGuidColumn[row] if flags[row] & (hasParentGuid | hasEnterParentGuid) else None,
+                getPrimitive(row),
+                None)
 
     for iv in self[datasetId]['intervalIndex'].iterOverlap(endOrder=True):
-        intervalId = iv.data
-        intervalObj = intervals[intervalId]
-
-        # Parent GUIDs refer to the one in the enter event, not the leave event
-        guid = intervalObj.get('GUID', intervalObj['enter'].get('GUID', None))
+        row = int(iv.data)
+        guid, parentGuid, childPrimitive, leavePrimitive = getLinkAttributes(row)
 
         if guid is None:
             missingCount += 1
         else:
-            if not guid in guids:
-                guids[guid] = []
-            guids[guid].append(intervalId)
+            guidIndex.add(guid, row, enters[row])
 
         # Connect to most recent interval with the parent GUID
-        parentGuid = intervalObj.get('Parent GUID', intervalObj['enter'].get('Parent GUID', None))
-
-        if parentGuid is not None and parentGuid in guids:
-            foundPrior = False
-            for parentIntervalId in reversed(guids[parentGuid]):
-                parentInterval = intervals[parentIntervalId]
-                if parentInterval['enter']['Timestamp'] <= intervalObj['enter']['Timestamp']:
-                    foundPrior = True
-                    intervalCount += 1
-                    # Store the id of the most recent interval
-                    intervalObj['parent'] = parentIntervalId
-                    # add our id to the parent interval
-                    parentInterval['children'].append(intervalId)
-                    # Because intervals is a diskcache.Index, it needs to know that something changed
-                    intervals[intervalId] = intervalObj
-                    intervals[parentIntervalId] = parentInterval
-
-                    # While we're here, note the parent-child link in the primitive graph
-                    # (for now, only assume links from the parent's leave interval to the
-                    # child's enter when primitive names are mismatched)
-                    childPrimitive = intervalObj.get('Primitive', intervalObj['enter'].get('Primitive', None))
-                    parentPrimitive = parentInterval.get('Primitive', intervalObj['leave'].get('Primitive', None))
-                    if childPrimitive is not None and parentPrimitive is not None:
-                        l = self.addPrimitiveChild(datasetId, parentPrimitive, childPrimitive, 'otf2')[1]
-                        newLinks += l
-                        seenLinks += 1 if l == 0 else 0
-                    break
-            if not foundPrior:
+        if parentGuid is not None and parentGuid in guidIndex:
+            parentRow = guidIndex.latestBefore(parentGuid, enters[row])
+            if parentRow is not None:
+                intervalCount += 1
+                # Link to the most recent interval
+                childRows.append(row)
+                parentRows.append(parentRow)
+
+                # While we're here, note the parent-child link in the primitive graph
+                # (for now, only assume links from the parent's leave interval to the
+                # child's enter when primitive names are mismatched)
+                parentPrimitive = getPrimitive(parentRow)
+                if parentPrimitive is None:
+                    parentPrimitive = leavePrimitive
+                if childPrimitive is not None and parentPrimitive is not None:
+                    l = self.addPrimitiveChild(datasetId, parentPrimitive, childPrimitive, 'otf2')[1]
+                    newLinks += l
+                    seenLinks += 1 if l == 0 else 0
+            else:
                 missingCount += 1
         else:
             missingCount += 1
@@ -370,67 +314,113 @@ async def connectIntervals(self, datasetId, log=logToConsole):
         if (missingCount + intervalCount) % 100000 == 0:
             await log('processed %i intervals' % (missingCount + intervalCount))
 
+    intervals.setLinks(childRows, parentRows)
+
+    await log('')
     await log('Finished connecting intervals')
     await log('Interval links created: %i, Intervals without prior parent GUIDs: %i' % (intervalCount, missingCount))
     await log('New primitive links based on GUIDs: %d, Observed existing links: %d' % (newLinks, seenLinks))
 
+def buildLocationUtilization(shard):
+    # Build (and finalize) the per-location parts of the SparseUtilizationLists,
+    # as well as the interval duration counts, for one shard of locations. This
+    # memory-maps its own copy of the interval table's columns, so it's safe to
+    # run in a worker process
+    intervalsPath, locationRanges = shard
+    intervals = IntervalTable.load(intervalsPath)
+    suls = {'intervals': SparseUtilizationList(), 'metrics': dict(), 'primitives': dict()}
+    intervalHistograms = dict()
+    seenLocations = set()
+    count = 0
+
+    def updateSULForInterval(loc, preMetricValue, timestamp, metricValues, i):
+        # preMetricValue holds loc's previous sample of each metric
+        for k, values in metricValues.items():
+            value = values[i]
+            if value != value:
+                # NaN; this event didn't have a value for this metric
+                continue
+            if k not in suls['metrics']:
+                suls['metrics'][k] = SparseUtilizationList(False)
+            if k not in preMetricValue:
+                preMetricValue[k] = {'Timestamp': 0, 'Value': 0}
+            current_rate = (value - preMetricValue[k]['Value']) / (timestamp - preMetricValue[k]['Timestamp'])
+            suls['metrics'][k].setIntervalAtLocation({'index': int(timestamp), 'counter': 0, 'util': current_rate}, loc)
+            preMetricValue[k]['Timestamp'] = timestamp
+            preMetricValue[k]['Value'] = value
+
+    for loc, idRange in locationRanges:
+        # Metric rates are relative to the previous sample on the same location
+        preMetricValue = dict()
+
+        # Read this location's columns in bulk
+        rows = np.asarray(idRange, dtype=np.int64)
+        enters = intervals.columns['enter'][rows].tolist()
+        leaves = intervals.columns['leave'][rows].tolist()
+        primitiveNames = [intervals.strings[p] for p in intervals.columns['primitive'][rows].tolist()]
+        enterMetrics = {k: column[rows].tolist() for k, column in intervals.metrics['enter'].items()}
+        leaveMetrics = {k: column[rows].tolist() for k, column in intervals.metrics['leave'].items()}
+
+        for i, primitive_name in enumerate(primitiveNames):
+            seenLocations.add(loc)
+            enter = enters[i]
+            leave = leaves[i]
+
+            # Update the full SparseUtilizationList
+            suls['intervals'].setIntervalAtLocation({'index': int(enter), 'counter': 1, 'util': 0, 'primitive': primitive_name}, loc)
+            suls['intervals'].setIntervalAtLocation({'index': int(leave), 'counter': -1, 'util': 0, 'primitive': primitive_name}, loc)
+
+            # Create a SparseUtilizationList for the primitive if we haven't yet
+            if primitive_name not in suls['primitives']:
+                suls['primitives'][primitive_name] = SparseUtilizationList()
+            # ... and update it
+            suls['primitives'][primitive_name].setIntervalAtLocation({'index': int(enter), 'counter': 1, 'util': 0, 'primitive': primitive_name}, loc)
+            suls['primitives'][primitive_name].setIntervalAtLocation({'index': int(leave), 'counter': -1, 'util': 0, 'primitive': primitive_name}, loc)
+
+            # Create / update SparseUtilizationLists for any metrics
+            updateSULForInterval(loc, preMetricValue, enter, enterMetrics, i)
+            updateSULForInterval(loc, preMetricValue, leave, leaveMetrics, i)
+
+            # Update the duration histogram
+            duration = leave - enter
+            for primitive in [primitive_name, 'all_primitives']:
+                durationCounts = intervalHistograms[primitive] = intervalHistograms.get(primitive, dict())
+                durationCounts[duration] = durationCounts.get(duration, 0) + 1
+            count += 1
+
+    # Finish this shard's slice of each SparseUtilizationList
+    flatSulList = [suls['intervals']] + list(suls['primitives'].values()) + list(suls['metrics'].values())
+    for sul in flatSulList:
+        sul.finalize(seenLocations)
+    return suls, intervalHistograms, seenLocations, count
+
 async def buildSparseUtilizationLists(self, datasetId, log=logToConsole):
     # create allSuls obj
     allSuls = {'intervals': SparseUtilizationList(), 'metrics': dict(), 'primitives': dict(), 'intervalHistograms': dict()}
     intervalHistograms = dict()
-    preMetricValue = dict()
     allLocations = set()
 
-    def updateSULForInterval(event, cur_location):
-        if 'metrics' in event:
-            for k, value in event['metrics'].items():
-                if k not in allSuls['metrics']:
-                    allSuls['metrics'][k] = SparseUtilizationList(False)
-                    preMetricValue[k] = {'Timestamp': 0, 'Value': 0}
-                current_rate = (value - preMetricValue[k]['Value']) / (event['Timestamp'] - preMetricValue[k]['Timestamp'])
-                allSuls['metrics'][k].setIntervalAtLocation({'index': int(event['Timestamp']), 'counter': 0, 'util': current_rate}, cur_location)
-                preMetricValue[k]['Timestamp'] = event['Timestamp']
-                preMetricValue[k]['Value'] = value
-
-    def updateIntervalDuration(event):
-        duration = event['leave']['Timestamp'] - event['enter']['Timestamp']
-        if 'Primitive' in event:
-            durationCounts = intervalHistograms[event['Primitive']] = intervalHistograms.get(event['Primitive'], dict())
-            durationCounts[duration] = durationCounts.get(duration, 0) + 1
-            allDurationCounts = intervalHistograms['all_primitives'] = intervalHistograms.get('all_primitives', dict())
-            allDurationCounts[duration] = allDurationCounts.get(duration, 0) + 1
-
-    # First pass through all the intervals
+    # Each shard of locations is indexed and finalized independently
     count = 0
-    await log('Building SparseUtilizationList indexes (.=2500 intervals)')
-    for intervalObj in self[datasetId]['intervals'].values():
-        loc = intervalObj['Location']
-        allLocations.add(loc)
-        primitive_name = intervalObj['Primitive']
-
-        # Update the full SparseUtilizationList
-        allSuls['intervals'].setIntervalAtLocation({'index': int(intervalObj['enter']['Timestamp']), 'counter': 1, 'util': 0, 'primitive': primitive_name}, loc)
-        allSuls['intervals'].setIntervalAtLocation({'index': int(intervalObj['leave']['Timestamp']), 'counter': -1, 'util': 0, 'primitive': primitive_name}, loc)
-
-        # Create a SparseUtilizationList for the primitive if we haven't yet
-        if primitive_name not in allSuls['primitives']:
-            allSuls['primitives'][primitive_name] = SparseUtilizationList()
-        # ... and update it
-        allSuls['primitives'][primitive_name].setIntervalAtLocation({'index': int(intervalObj['enter']['Timestamp']), 'counter': 1, 'util': 0, 'primitive': primitive_name}, loc)
-        allSuls['primitives'][primitive_name].setIntervalAtLocation({'index': int(intervalObj['leave']['Timestamp']), 'counter': -1, 'util': 0, 'primitive': primitive_name}, loc)
-
-        # Create / update SparseUtilizationLists for any metrics
-        updateSULForInterval(intervalObj['enter'], loc)
-        updateSULForInterval(intervalObj['leave'], loc)
-
-        # Update the duration histogram
-        updateIntervalDuration(intervalObj)
-
-        count += 1
-        if count % 2500 == 0:
-            await log('.', end='')
-        if count % 100000 == 0:
-            await log('processed %i intervals' % count)
+    await log('Building SparseUtilizationList indexes across %i worker(s) (.=1 shard)' % self.ingestWorkers)
+    intervalsPath = os.path.join(self.dbDir, datasetId, 'intervals.columns')
+    shards = [(intervalsPath, shard) for shard in shardLocations(self.intervalIdsByLocation.items(), self.ingestWorkers)]
+    for suls, shardHistograms, seenLocations, shardCount in await mapShards(self.ingestWorkers, buildLocationUtilization, shards):
+        allSuls['intervals'].update(suls['intervals'])
+        for kind in ['primitives', 'metrics']:
+            for name, sul in suls[kind].items():
+                if name not in allSuls[kind]:
+                    allSuls[kind][name] = sul
+                else:
+                    allSuls[kind][name].update(sul)
+        for primitive, durationCounts in shardHistograms.items():
+            allDurationCounts = intervalHistograms[primitive] = intervalHistograms.get(primitive, dict())
+            for duration, value in durationCounts.items():
+                allDurationCounts[duration] = allDurationCounts.get(duration, 0) + value
+        allLocations |= seenLocations
+        count += shardCount
+        await log('.', end='')
+    del self.intervalIdsByLocation
 
     await log('')
     await log('Finished indexing %s intervals' % count)
@@ -446,11 +436,21 @@ async def buildSparseUtilizationLists(self, datasetId, log=logToConsole):
     if len(extraObserved) > 0:
         await log('\nWARNING: Observed intervals for unknown primitives: ' + ', '.join(extraObserved))
 
-    # Second pass to finish each SparseUtilizationList
+    # Fill in empty entries for locations that a shard never saw
     await log('Finalizing indexes')
     flatSulList = [allSuls['intervals']] + list(allSuls['primitives'].values()) + list(allSuls['metrics'].values())
     for sul in flatSulList:
-        sul.finalize(allLocations)
+        sul.finalize(allLocations - sul.locationDict.keys())
+        await log('.', end='')
+    await log('')
+
+    # Pre-bin utilization for zoomed-out views
+    await log('Building utilization pyramids')
+    for sul in [allSuls['intervals']] + list(allSuls['primitives'].values()):
+        sul.buildPyramid()
+        await log('.', end='')
+    for sul in allSuls['metrics'].values():
+        sul.buildEnvelope()
         await log('.', end='')
     await log('')
 
@@ -486,7 +486,7 @@ async def buildSparseUtilizationLists(self, datasetId, log=logToConsole):
         await log('.', end='')
     await log('')
 
-    self[datasetId]['sparseUtilizationList'] = allSuls
+    self[datasetId]['sparseUtilizationList'] = SparseUtilizationStore(allSuls)
     self[datasetId]['info']['intervalDurationDomain'] = intervalDurationDomainDict
 
 
@@ -500,57 +500,100 @@ async def buildDependencyTree(self, datasetId, log=logToConsole):
             return False
         return True
     await log('Building dependency tree')
+    intervals = self[datasetId]['intervals']
+    columns = intervals.columns
+    enters = columns['enter'].tolist()
+    leaves = columns['leave'].tolist()
+    primitiveIds = columns['primitive'].tolist()
+    childOffsets = columns['childOffsets'].tolist()
+    childIds = columns['childIds'].tolist()
+    # Whether each primitive (by string id) belongs in the tree; intervals
+    # without a primitive (-1, i.e. the last entry) don't
+    includedPrimitives = [is_include_primitive_name(value) for value in intervals.strings] + [False]
+    names = [get_primitive_pretty_name_with_prefix(value)[1] for value in intervals.strings] + [None]
+
+    def getChildren(row):
+        return [childId for childId in childIds[childOffsets[row]:childOffsets[row + 1]] if includedPrimitives[primitiveIds[childId]]]
+
+    def getGroupedChildren(row):
+        # Children with the same name next to each other, in the order that
+        # each name first appears
+        groups = dict()
+        for childId in getChildren(row):
+            groups.setdefault(names[primitiveIds[childId]], []).append(childId)
+        return [childId for group in groups.values() for childId in group]
+
+    # Top-level intervals, grouped by primitive (in the order that each
+    # primitive first appears)
     primitive_set = dict()
-    dId = 0
-    while str(dId) in self[datasetId]['intervals']:
-        intervalObj = self[datasetId]['intervals'][str(dId)]
-        if intervalObj['parent'] is None:
-            if is_include_primitive_name(intervalObj['Primitive']):
-                if intervalObj['Primitive'] not in primitive_set:
-                    primitive_set[intervalObj['Primitive']] = list()
-                primitive_set[intervalObj['Primitive']].append(str(dId))
-        dId = dId + 1
-
-    def getChildren(cId):
-        currentNode = DependencyTreeNode()
-        intObj = self[datasetId]['intervals'][cId]
-        currentNode.setName(intObj['Primitive'])
-        for childId in intObj['children']:
-            if is_include_primitive_name(self[datasetId]['intervals'][childId]['Primitive']):
-                currentNode.addChildren(getChildren(childId))
-        currentNode.addIntervalToAggregatedList(intObj)
-        return currentNode
-
-    def mergeTwoTrees(tree1, tree2):
-        if tree1.name != tree2.name:
-            return
-        for eachTree2Child in tree2.children:
-            tree1.addChildren(eachTree2Child)  # call add children instead of list.append to merge safely
-        tree1.intervalList.extend(tree2.intervalList)
-        tree1.aggregatedBlockList.extend(tree2.aggregatedBlockList)
-
+    for row in np.flatnonzero(columns['parent'] < 0).tolist():
+        if includedPrimitives[primitiveIds[row]]:
+            primitive_set.setdefault(primitiveIds[row], []).append(row)
+    roots = [row for rows in primitive_set.values() for row in rows]
+    if len(roots) == 0:
+        self[datasetId]['dependencyTree'] = None
+        return
+
+    # Each aggregated block covers an interval and all of its descendants; lay
+    # the intervals out so that every block is one contiguous range (each
+    # interval's children, grouped by name, followed by the interval itself)
+    # that all the blocks can share
+    layoutRows = array('q')
+    layoutStarts = [0] * len(enters)
+    blockEnds = [0] * len(enters)
+    for root in roots:
+        layoutStarts[root] = len(layoutRows)
+        stack = [(root, iter(getGroupedChildren(root)))]
+        while len(stack) > 0:
+            row, remainingChildren = stack[-1]
+            childId = next(remainingChildren, None)
+            if childId is not None:
+                layoutStarts[childId] = len(layoutRows)
+                stack.append((childId, iter(getGroupedChildren(childId))))
+                continue
+            stack.pop()
+            layoutRows.append(row)
+            # A block lasts until its last descendant finishes
+            blockEnds[row] = max(blockEnds[row], leaves[row])
+            if len(stack) > 0:
+                parentRow = stack[-1][0]
+                blockEnds[parentRow] = max(blockEnds[parentRow], blockEnds[row])
+    layoutRows = np.frombuffer(layoutRows, dtype=np.int64)
+    layoutPositions = np.empty(len(enters), dtype=np.int64)
+    layoutPositions[layoutRows] = np.arange(len(layoutRows))
+    layoutPositions = layoutPositions.tolist()
+    layout = {
+        'enter': columns['enter'][layoutRows],
+        'leave': columns['leave'][layoutRows],
+        'location': columns['location'][layoutRows],
+        'strings': intervals.strings
+    }
+
+    # Walk the intervals depth first, merging intervals with the same
+    # sequence of (pretty) primitive names into the same tree node
+    results = DependencyTreeNode()
     count = 0
-    pre_c = None
-    for prim in primitive_set:
-        for each_interval_id in primitive_set[prim]:
-            thisNode = DependencyTreeNode()
-            newChild = getChildren(each_interval_id)
-            thisNode.addChildren(newChild)
-            thisNode.aggregatedBlockList.extend(newChild.aggregatedBlockList)
-            thisNode.intervalList.extend(newChild.intervalList)
-            current_c = thisNode
-            if pre_c is None:
-                pre_c = current_c
-            else:
-                mergeTwoTrees(pre_c, current_c)
-            count += 1
-            if count % 2500 == 0:
-                await log('.', end='')
-            if count % 100000 == 0:
-                await log('processed %i primitives' % count)
+    stack = [(row, results) for row in reversed(roots)]
+    for row in roots:
+        # The root node gets each top-level interval as well
+        results.addIntervalToIntervalList(enters[row], leaves[row])
+    while len(stack) > 0:
+        row, parentNode = stack.pop()
+        primitive = intervals.strings[primitiveIds[row]]
+        block = AggregatedBlock(enters[row], blockEnds[row], layout, layoutStarts[row], layoutPositions[row] + 1)
+        block.firstPrimitiveName = primitive
+        if parentNode is results:
+            results.addAggregatedBlock(block)
+        node = parentNode.getOrAddChild(primitive)
+        node.addIntervalToIntervalList(enters[row], leaves[row])
+        node.addAggregatedBlock(block)
+        stack.extend((childId, node) for childId in reversed(getChildren(row)))
+        count += 1
+        if count % 2500 == 0:
+            await log('.', end='')
+        if count % 100000 == 0:
+            await log('processed %i intervals' % count)
     await log('')
 
-    results = pre_c
-    if results:
-        results.finalizeTreeNode()
+    results.finalizeTreeNode()
     self[datasetId]['dependencyTree'] = results
@@ -0,0 +1,16 @@
+import os
+import numpy as np
+
+# Helpers for the directories of .npy columns that DataStore's columnStores
+# save and load
+
+def saveColumn(path, fileName, column):
+    # Write to a temporary file first; the file that we're replacing might
+    # still be memory-mapped
+    tempPath = os.path.join(path, fileName + '.tmp')
+    with open(tempPath, 'wb') as npyFile:
+        np.save(npyFile, np.asarray(column))
+    os.replace(tempPath, os.path.join(path, fileName))
+
+def loadColumn(path, fileName):
+    return np.load(os.path.join(path, fileName), mmap_mode='r')
@@ -1,6 +1,8 @@
-import copy
+import json
+import heapq
 import uuid
 
+import numpy as np
 from .sparseUtilizationList import SparseUtilizationList
 
 
@@ -12,13 +14,49 @@ def get_primitive_pretty_name_with_prefix(primitive: str):
 
 
 class AggregatedBlock:
-    def __init__(self, start, end):
-        self.utilization = SparseUtilizationList()  # this is util for intervals
-        self.isFinalized = False
+    # One interval, plus everything that it (indirectly) called. The intervals
+    # of the whole subtree are a contiguous range of a layout that the blocks
+    # of a dependency tree share (see buildDependencyTree): enter / leave /
+    # location arrays, ordered so that each block's descendants come right
+    # before it
+    def __init__(self, start, end, layout=None, layoutStart=0, layoutEnd=0):
         self.startTime = start
         self.endTime = end
         self.firstPrimitiveName = ''
-        self.allLocations = None
+        self.layout = layout
+        self.layoutStart = layoutStart
+        self.layoutEnd = layoutEnd
+
+    def __getattr__(self, name):
+        # The block's utilization is only built the first time that it's needed
+        if name != 'utilization' or 'layout' not in self.__dict__:
+            raise AttributeError(name)
+        self.utilization = self.buildUtilization()
+        return self.utilization
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('utilization', None)
+        return state
+
+    def buildUtilization(self):
+        utilization = SparseUtilizationList()  # this is util for intervals
+        layout = self.layout
+        locations = layout['location'][self.layoutStart:self.layoutEnd]
+        enters = layout['enter'][self.layoutStart:self.layoutEnd]
+        leaves = layout['leave'][self.layoutStart:self.layoutEnd]
+        # Locations are added in the order that they first appear
+        uniqueLocations, firstIndices, inverse = np.unique(locations, return_index=True, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        splits = np.cumsum(np.bincount(inverse, minlength=len(uniqueLocations)))[:-1]
+        rowsByLocation = np.split(order, splits)
+        for k in np.argsort(firstIndices).tolist():
+            rows = rowsByLocation[k]
+            index = np.column_stack((enters[rows], leaves[rows])).ravel()
+            counter = np.tile(np.array([1, -1], dtype=np.int64), len(rows))
+            location = layout['strings'][uniqueLocations[k]] if uniqueLocations[k] >= 0 else None
+            utilization.setLocationEdges(location, index, counter)
+        return utilization
 
     def updateStartTime(self, start):
         self.startTime = start
@@ -32,6 +70,7 @@ class DependencyTreeNode:
         self.nodeId = str(uuid.uuid4())
         self.name = 'root'
         self.children = list()  # list of DependencyTreeNode
+        self.childrenByName = dict()  # name -> DependencyTreeNode in children
         self.prefixList = list()  # list of string
         self.intervalList = list()  # containing just the enter and leave time of this interval, helper for creating aggreatedBlockList
 
@@ -46,36 +85,50 @@ class DependencyTreeNode:
         self.prefixList.append(pref)
 
     def addChildren(self, child):
-        notFound = True
-        for myChild in self.children:
-            if myChild.name == child.name:
-                notFound = False
-                # update the children
-                for otherSubChild in child.children:
-                    myChild.addChildren(otherSubChild)
-                # update prefixList
-                for pre in child.prefixList:
-                    if pre not in myChild.prefixList:
-                        myChild.prefixList.append(pre)
-                # update aggregatedBlockList
-                myChild.aggregatedBlockList.extend(child.aggregatedBlockList)
-                myChild.intervalList.extend(child.intervalList)
-                break
-
-        if notFound:
+        myChild = self.childrenByName.get(child.name, None)
+        if myChild is None:
             self.children.append(child)
+            self.childrenByName[child.name] = child
+            return
+        # update the children
+        for otherSubChild in child.children:
+            myChild.addChildren(otherSubChild)
+        # update prefixList
+        for pre in child.prefixList:
+            if pre not in myChild.prefixList:
+                myChild.prefixList.append(pre)
+        # update aggregatedBlockList
+        myChild.aggregatedBlockList.extend(child.aggregatedBlockList)
+        myChild.intervalList.extend(child.intervalList)
+
+    def getOrAddChild(self, primitiveName):
+        # Returns the child for this primitive's (pretty) name, creating it if
+        # it doesn't exist yet
+        pref, name = get_primitive_pretty_name_with_prefix(primitiveName)
+        child = self.childrenByName.get(name, None)
+        if child is None:
+            child = DependencyTreeNode()
+            child.setName(primitiveName)
+            self.children.append(child)
+            self.childrenByName[name] = child
+        elif pref not in child.prefixList:
+            child.prefixList.append(pref)
+        return child
 
     def addChildrenList(self, childrenList):
-        self.children.extend(childrenList)
+        for child in childrenList:
+            self.addChildren(child)
 
     def resetChildrenList(self, childrenList):
-        self.children.clear()
-        self.children = childrenList
+        self.children = list()
+        self.childrenByName = dict()
+        self.addChildrenList(childrenList)
 
     def addPrefixList(self, pl):
         self.prefixList.extend(pl)
 
-    def getTheTree(self):
+    def describe(self):
+        # This node's part of getTheTree, without children
         thisNode = dict()
         thisNode['nodeId'] = self.nodeId
         thisNode['name'] = self.name
@@ -84,90 +137,98 @@ class DependencyTreeNode:
         for ei in self.intervalList:
             cnt = cnt + (ei['leave'] - ei['enter'])
         thisNode['totalUtil'] = cnt
-        cList = list()
-        for child in self.children:
-            cList.append(child.getTheTree())
-        thisNode['children'] = cList
         return thisNode
 
+    def getTheTree(self):
+        tree = self.describe()
+        tree['children'] = list()
+        stack = [(self, tree)]
+        while len(stack) > 0:
+            node, thisNode = stack.pop()
+            for child in node.children:
+                childNode = child.describe()
+                childNode['children'] = list()
+                thisNode['children'].append(childNode)
+                stack.append((child, childNode))
+        return tree
+
+    def serializeTree(self):
+        # Same as json.dumps(self.getTheTree()), but without recursing, as deep
+        # trees would exceed the recursion limit
+        parts = list()
+        stack = [self]
+        while len(stack) > 0:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            parts.append(json.dumps(item.describe())[:-1] + ', "children": [')
+            stack.append(']}')
+            for i in range(len(item.children) - 1, -1, -1):
+                stack.append(item.children[i])
+                if i > 0:
+                    stack.append(', ')
+        return ''.join(parts)
+
+    def getSerializedTree(self):
+        # finalizeTreeNode caches this on the root of the tree
+        if getattr(self, 'serializedTree', None) is None:
+            self.serializedTree = self.serializeTree()
+        return self.serializedTree
+
     def addIntervalToIntervalList(self, startTime, endTime):
         self.intervalList.append({'enter': startTime, 'leave': endTime})
 
-    def addIntervalToAggregatedList(self, intervalObj):
-        startTime = intervalObj['enter']['Timestamp']
-        endTime = intervalObj['leave']['Timestamp']
-        primitive_name = intervalObj['Primitive']
-        loc = intervalObj['Location']
-        allLocations = set()
-        allLocations.add(loc)
-        ab = AggregatedBlock(startTime, endTime)
-
-        self.intervalList.append({'enter': startTime, 'leave': endTime})
-        maxTime = endTime
-        for eachChild in self.children:
-            aggMaxTime = endTime
-            for eachAgg in eachChild.aggregatedBlockList:
-                if eachAgg.endTime > aggMaxTime:
-                    aggMaxTime = eachAgg.endTime
-                for location, utilObj in eachAgg.utilization.locationDict.items():
-                    if location not in ab.utilization.locationDict:
-                        ab.utilization.locationDict[location] = list()
-                    ab.utilization.locationDict[location].extend(copy.deepcopy(utilObj))
-                    allLocations.add(location)
-            maxTime = max(maxTime, aggMaxTime)
-
-        ab.updateEndTime(maxTime)
-        ab.firstPrimitiveName = primitive_name
-        ab.utilization.setIntervalAtLocation({'index': int(startTime), 'counter': 1, 'util': 0, 'primitive': primitive_name}, loc)
-        ab.utilization.setIntervalAtLocation({'index': int(endTime), 'counter': -1, 'util': 0, 'primitive': primitive_name}, loc)
-        ab.allLocations = list(allLocations)
-        self.aggregatedBlockList.append(ab)
+    def addAggregatedBlock(self, block):
+        self.aggregatedBlockList.append(block)
 
     def finalizeTreeNode(self):
-        locationEndTime = dict()
+        # Lays out the aggregated blocks of this node (and every node below
+        # it) on as few dummy locations as possible, without overlaps; also
+        # indexes every node below this one by its nodeId, and caches the
+        # serialized tree
+        self.nodeIndex = dict()
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            self.nodeIndex[node.nodeId] = node
+            node.layoutAggregatedBlocks()
+            stack.extend(reversed(node.children))
+        self.serializedTree = self.serializeTree()
+
+    def layoutAggregatedBlocks(self):
         self.aggregatedBlockList.sort(key=lambda x: x.startTime)
+        if len(self.aggregatedBlockList) == 0:
+            return
+        # (end time, dummy location) of each dummy location's last block; a
+        # block goes on the location that frees up first (or the lowest
+        # numbered one, on a tie), unless none of them are free by the time it
+        # starts
         dummyLocation = 1
-        minAmongLocation = {'time': self.aggregatedBlockList[0].startTime + 1, 'location': dummyLocation}  # making sure to force into else in the for loop
-
-        def updateMinAmongLocation():
-            isFirstElement = True
-            mal = dict()
-            for dLocation in locationEndTime:
-                if isFirstElement or mal['time'] > locationEndTime[dLocation]:
-                    mal = {'time': locationEndTime[dLocation], 'location': dLocation}
-                    isFirstElement = False
-            return mal
-
+        locationEndTimes = []
         allDummyLocations = list()
         for ind, eachBlock in enumerate(self.aggregatedBlockList):
-            if eachBlock.isFinalized is False:  # since the root node takes all children nodes, we need this check
-                eachBlock.utilization.finalize(eachBlock.allLocations)
-                eachBlock.isFinalized = True
-
-            if minAmongLocation['time'] < eachBlock.startTime:
-                self.aggregatedUtil.setIntervalAtLocation({'index': int(eachBlock.startTime), 'counter': 0, 'util': ind+1}, minAmongLocation['location'])
-                self.aggregatedUtil.setIntervalAtLocation({'index': int(eachBlock.endTime), 'counter': 0, 'util': ind+1}, minAmongLocation['location'])
-                locationEndTime[minAmongLocation['location']] = eachBlock.endTime
-                minAmongLocation = updateMinAmongLocation()
+            if len(locationEndTimes) > 0 and locationEndTimes[0][0] < eachBlock.startTime:
+                location = heapq.heappop(locationEndTimes)[1]
             else:
-                self.aggregatedUtil.setIntervalAtLocation({'index': int(eachBlock.startTime), 'counter': 0, 'util': ind+1}, dummyLocation)
-                self.aggregatedUtil.setIntervalAtLocation({'index': int(eachBlock.endTime), 'counter': 0, 'util': ind+1}, dummyLocation)
-                locationEndTime[dummyLocation] = eachBlock.endTime
-                minAmongLocation = updateMinAmongLocation()
+                location = dummyLocation
                 allDummyLocations.append(dummyLocation)
                 dummyLocation = dummyLocation + 1
+            self.aggregatedUtil.setIntervalAtLocation({'index': int(eachBlock.startTime), 'counter': 0, 'util': ind+1}, location)
+            self.aggregatedUtil.setIntervalAtLocation({'index': int(eachBlock.endTime), 'counter': 0, 'util': ind+1}, location)
+            heapq.heappush(locationEndTimes, (eachBlock.endTime, location))
         self.aggregatedUtil.finalize(allDummyLocations)
 
-        for child in self.children:
-            child.finalizeTreeNode()
-
 
 def find_node_in_dependency_tree(currentNode, nodeId):
-    for eachChild in currentNode.children:
-        if eachChild.nodeId == nodeId:
-            return eachChild
-        else:
-            ret = find_node_in_dependency_tree(eachChild, nodeId)
-            if ret is not None:
-                return ret
+    nodeIndex = getattr(currentNode, 'nodeIndex', None)
+    if nodeIndex is not None:
+        return nodeIndex.get(nodeId, None)
+    # Trees that were finalized without an index
+    stack = list(reversed(currentNode.children))
+    while len(stack) > 0:
+        node = stack.pop()
+        if node.nodeId == nodeId:
+            return node
+        stack.extend(reversed(node.children))
     return None
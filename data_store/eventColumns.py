@@ -0,0 +1,155 @@
+from array import array
+import numpy as np
+
+# Compact, columnar stand-in for otf2-print text. Converting a trace once with
+# EventColumnsWriter means that later bundles can replay the same tokens that
+# otf2Tokenizer would have produced, straight out of NumPy arrays. The .npz
+# file holds:
+#
+# strings          string table (locations, regions, metric / attribute names, values)
+# eventType        uint8, 0 = ENTER, 1 = LEAVE
+# eventLocation    int32 index into strings
+# eventTimestamp   int64
+# eventRegion      int32 index into strings, -1 if the event had no Region
+# eventGuid        uint64 GUID
+# eventParentGuid  uint64 Parent GUID
+# eventGuidFlags   uint8, bit 0 set if the event has a GUID, bit 1 for a Parent GUID
+# attrEvent, attrName, attrValue
+#                  any other additional attributes: the event index they belong
+#                  to, plus string table indices for the name and value
+# metricEvent, metricLocation, metricTimestamp, metricName, metricValue
+#                  METRIC records: the number of events that preceded the
+#                  record in the original stream, the location / name string
+#                  table indices, the timestamp, and the value
+
+eventTypes = ['ENTER', 'LEAVE']
+hasGuid = 1
+hasParentGuid = 2
+maxGuid = 2 ** 64 - 1
+
+class EventColumnsWriter:
+    def __init__(self):
+        self.strings = {}
+        self.columns = {
+            'eventType': array('B'),
+            'eventLocation': array('i'),
+            'eventTimestamp': array('q'),
+            'eventRegion': array('i'),
+            'eventGuid': array('Q'),
+            'eventParentGuid': array('Q'),
+            'eventGuidFlags': array('B'),
+            'attrEvent': array('q'),
+            'attrName': array('i'),
+            'attrValue': array('i'),
+            'metricEvent': array('q'),
+            'metricLocation': array('i'),
+            'metricTimestamp': array('q'),
+            'metricName': array('i'),
+            'metricValue': array('d')
+        }
+        self.numEvents = 0
+        self.badAttrs = 0
+        self.skippedLines = 0
+
+    def stringId(self, value):
+        stringId = self.strings.get(value, None)
+        if stringId is None:
+            stringId = self.strings[value] = len(self.strings)
+        return stringId
+
+    def addToken(self, token):
+        # Accepts the tokens produced by otf2Tokenizer.tokenizeLine
+        columns = self.columns
+        if token is None:
+            self.skippedLines += 1
+        elif token[0] == 'ENTER' or token[0] == 'LEAVE':
+            columns['eventType'].append(eventTypes.index(token[0]))
+            columns['eventLocation'].append(self.stringId(token[1]))
+            columns['eventTimestamp'].append(token[2])
+            columns['eventRegion'].append(-1 if token[3] is None else self.stringId(token[3]))
+            columns['eventGuid'].append(0)
+            columns['eventParentGuid'].append(0)
+            columns['eventGuidFlags'].append(0)
+            self.numEvents += 1
+        elif token[0] == 'METRIC':
+            columns['metricEvent'].append(self.numEvents)
+            columns['metricLocation'].append(self.stringId(token[1]))
+            columns['metricTimestamp'].append(token[2])
+            columns['metricName'].append(self.stringId(token[3]))
+            columns['metricValue'].append(token[4])
+        elif token[0] == 'ATTRS':
+            if self.numEvents == 0:
+                # Attributes without an event are ignored by processRawTrace anyway
+                return
+            eventIndex = self.numEvents - 1
+            for attr in token[1]:
+                if attr is None:
+                    self.badAttrs += 1
+                    continue
+                name, value = attr
+                if (name == 'GUID' or name == 'Parent GUID') and value.isdecimal() and int(value) <= maxGuid and str(int(value)) == value:
+                    if name == 'GUID':
+                        columns['eventGuid'][eventIndex] = int(value)
+                        columns['eventGuidFlags'][eventIndex] |= hasGuid
+                    else:
+                        columns['eventParentGuid'][eventIndex] = int(value)
+                        columns['eventGuidFlags'][eventIndex] |= hasParentGuid
+                else:
+                    columns['attrEvent'].append(eventIndex)
+                    columns['attrName'].append(self.stringId(name))
+                    columns['attrValue'].append(self.stringId(value))
+
+    def save(self, path):
+        strings = np.array(list(self.strings.keys()), dtype=str) if len(self.strings) > 0 else np.zeros(0, dtype='<U1')
+        columns = {name: np.frombuffer(column, dtype=column.typecode) if len(column) > 0 else np.zeros(0, dtype=column.typecode) \
+                   for name, column in self.columns.items()}
+        with open(path, 'wb') as npzFile:
+            np.savez(npzFile, strings=strings, **columns)
+
+class EventColumnsFile:
+    # Drop-in replacement for the otf2-print line iterators that processOtf2
+    # accepts; instead of lines, it hands processRawTrace ready-made tokens
+    def __init__(self, name):
+        self.name = name
+
+    async def iterTokens(self):
+        with np.load(self.name, allow_pickle=False) as npzFile:
+            columns = {name: npzFile[name] for name in npzFile.files}
+        strings = columns['strings'].tolist()
+        eventType = columns['eventType'].tolist()
+        eventLocation = columns['eventLocation'].tolist()
+        eventTimestamp = columns['eventTimestamp'].tolist()
+        eventRegion = columns['eventRegion'].tolist()
+        eventGuid = columns['eventGuid'].tolist()
+        eventParentGuid = columns['eventParentGuid'].tolist()
+        eventGuidFlags = columns['eventGuidFlags'].tolist()
+
+        # Group the other attributes by the event that they belong to
+        attrsByEvent = {}
+        for eventIndex, name, value in zip(columns['attrEvent'].tolist(), columns['attrName'].tolist(), columns['attrValue'].tolist()):
+            attrsByEvent.setdefault(eventIndex, []).append((strings[name], strings[value]))
+
+        # Metrics are replayed right after the event that preceded them
+        metrics = list(zip(columns['metricEvent'].tolist(), columns['metricLocation'].tolist(), columns['metricTimestamp'].tolist(),
+                           columns['metricName'].tolist(), columns['metricValue'].tolist()))
+        metricIndex = 0
+
+        for eventIndex in range(len(eventType) + 1):
+            while metricIndex < len(metrics) and metrics[metricIndex][0] <= eventIndex:
+                _, location, timestamp, name, value = metrics[metricIndex]
+                yield ('METRIC', strings[location], timestamp, strings[name], value)
+                metricIndex += 1
+            if eventIndex == len(eventType):
+                break
+            region = eventRegion[eventIndex]
+            yield (eventTypes[eventType[eventIndex]], strings[eventLocation[eventIndex]], eventTimestamp[eventIndex],
+                   None if region < 0 else strings[region])
+            attrs = []
+            flags = eventGuidFlags[eventIndex]
+            if flags & hasGuid:
+                attrs.append(('GUID', str(eventGuid[eventIndex])))
+            if flags & hasParentGuid:
+                attrs.append(('Parent GUID', str(eventParentGuid[eventIndex])))
+            attrs.extend(attrsByEvent.get(eventIndex, []))
+            if len(attrs) > 0:
+                yield ('ATTRS', attrs)
@@ -0,0 +1,46 @@
+from bisect import bisect_right
+
+class GuidIndex:
+    # GUID -> the intervals that have that GUID, with their enter timestamps,
+    # for finding "the latest interval with this GUID that started by t".
+    #
+    # While connecting intervals, add() is called in the order that intervals
+    # are visited, and latestBefore() only sees intervals that were added so
+    # far; if a GUID's enter timestamps were added in order (the usual case,
+    # as intervals that share a GUID rarely overlap), this is a binary search.
+    # The index only lives for as long as connectIntervals; afterwards, the
+    # links are in the interval table's parent / child columns.
+    #
+    # GUIDs are ints when they fit in the interval table's guid column, or
+    # strings otherwise
+    def __init__(self):
+        self.members = {}
+
+    def add(self, guid, row, enter):
+        members = self.members.get(guid, None)
+        if members is None:
+            self.members[guid] = [[row], [enter], True]
+        else:
+            rows, enters, inOrder = members
+            if inOrder and enter < enters[-1]:
+                members[2] = False
+            rows.append(row)
+            enters.append(enter)
+
+    def __contains__(self, guid):
+        return guid in self.members
+
+    def latestBefore(self, guid, timestamp):
+        # Returns the row of the most recently added interval with this GUID
+        # that started at or before timestamp, or None
+        members = self.members.get(guid, None)
+        if members is None:
+            return None
+        rows, enters, inOrder = members
+        if inOrder:
+            i = bisect_right(enters, timestamp) - 1
+            return rows[i] if i >= 0 else None
+        for i in range(len(enters) - 1, -1, -1):
+            if enters[i] <= timestamp:
+                return rows[i]
+        return None
@@ -0,0 +1,116 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+import diskcache
+import numpy as np
+
+def estimateSize(value):
+    # Rough number of bytes that a cached result holds on to
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimateSize(k) + estimateSize(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimateSize(v) for v in value)
+    return sys.getsizeof(value)
+
+def freeze(value):
+    # Cached results are shared between requests; make sure that nobody
+    # modifies an array in place
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for v in value.values():
+            freeze(v)
+    return value
+
+class HistogramCache:
+    # Results of the SparseUtilizationList histogram calculations, keyed by
+    # datasetId + whatever the endpoint's parameters are. There are two tiers:
+    # an in-memory LRU that holds up to maxBytes, and (if diskBytes > 0) a
+    # diskcache inside each dataset's directory that survives restarts.
+    #
+    # Each dataset has a generation number that invalidate() bumps whenever
+    # its data changes; results that were computed for an older generation are
+    # never stored. The diskcaches are only touched while holding self.lock, so
+    # that invalidate() can't close one (or the dataset's directory can't be
+    # deleted) in the middle of a lookup
+    def __init__(self, dbDir, maxBytes=256 * 1024 * 1024, diskBytes=0):
+        self.dbDir = dbDir
+        self.maxBytes = maxBytes
+        self.diskBytes = diskBytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.currentBytes = 0
+        self.generations = {}
+        self.diskCaches = {}
+        # Datasets whose directories are being / have been deleted; they don't
+        # get a diskcache again unless they're reloaded
+        self.deleted = set()
+
+    def getDiskCache(self, datasetId):
+        # Call while holding self.lock
+        if self.diskBytes <= 0 or datasetId in self.deleted:
+            return None
+        diskCache = self.diskCaches.get(datasetId, None)
+        if diskCache is None:
+            idDir = os.path.join(self.dbDir, datasetId)
+            if not os.path.exists(idDir):
+                return None
+            diskCache = self.diskCaches[datasetId] = diskcache.Cache(os.path.join(idDir, 'histogramCache.diskCache'),
+                                                                     size_limit=self.diskBytes)
+        return diskCache
+
+    def get(self, datasetId, key, compute):
+        # Returns the cached result for key, or calls compute() to create it
+        memoryKey = (datasetId, key)
+        with self.lock:
+            generation = self.generations.get(datasetId, 0)
+            entry = self.entries.get(memoryKey, None)
+            if entry is not None:
+                self.entries.move_to_end(memoryKey)
+                return entry[0]
+            diskCache = self.getDiskCache(datasetId)
+            value = diskCache.get(key, None) if diskCache is not None else None
+        found = value is not None
+        if not found:
+            value = compute()
+        value = freeze(value)
+        with self.lock:
+            if self.generations.get(datasetId, 0) == generation:
+                if not found and diskCache is not None:
+                    diskCache[key] = value
+                self.store(memoryKey, value)
+        return value
+
+    def store(self, memoryKey, value):
+        # Call while holding self.lock
+        size = estimateSize(value)
+        if size > self.maxBytes:
+            return
+        old = self.entries.pop(memoryKey, None)
+        if old is not None:
+            self.currentBytes -= old[1]
+        self.entries[memoryKey] = (value, size)
+        self.currentBytes += size
+        while self.currentBytes > self.maxBytes:
+            _, (_, evictedSize) = self.entries.popitem(last=False)
+            self.currentBytes -= evictedSize
+
+    def invalidate(self, datasetId, deleted=False):
+        # Forget everything about a dataset that was (re)loaded or deleted
+        with self.lock:
+            self.generations[datasetId] = self.generations.get(datasetId, 0) + 1
+            if deleted:
+                self.deleted.add(datasetId)
+            else:
+                self.deleted.discard(datasetId)
+            for memoryKey in [k for k in self.entries if k[0] == datasetId]:
+                self.currentBytes -= self.entries.pop(memoryKey)[1]
+            diskCache = self.diskCaches.pop(datasetId, None) if deleted else self.getDiskCache(datasetId)
+            if diskCache is not None:
+                if not deleted:
+                    diskCache.clear()
+                diskCache.close()
+                self.diskCaches.pop(datasetId, None)
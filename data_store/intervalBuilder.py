@@ -0,0 +1,104 @@
+import copy
+import heapq
+
+# How many events per location we hold back to absorb small timestamp
+# inversions in the otf2-print stream before committing them to intervals
+reorderWindowSize = 64
+
+def createNewInterval(event, lastEvent, warnings):
+    newInterval = {'enter': {}, 'leave': {}, 'intervalId': None, 'parent': None, 'children': []}
+    # Copy all of the attributes from the OTF2 events into the interval object. If the values
+    # differ (or it's the timestamp), put them in nested enter / leave objects. Otherwise, put
+    # them directly in the interval object
+    for attr in set(event.keys()).union(lastEvent.keys()):
+        if attr not in event:
+            newInterval['enter'][attr] = lastEvent[attr]
+        elif attr not in lastEvent:
+            newInterval['leave'][attr] = event[attr]
+        elif attr != 'Timestamp' and attr != 'metrics' and event[attr] == lastEvent[attr]:
+            newInterval[attr] = event[attr]
+        else:
+            if attr == 'Location':
+                warnings.append('WARNING: ENTER and LEAVE have different locations')
+            newInterval['enter'][attr] = lastEvent[attr]
+            newInterval['leave'][attr] = event[attr]
+    return newInterval
+
+class IntervalBuilder:
+    # Turns one location's ENTER / LEAVE events into intervals as they stream
+    # in; only the stack of open ENTER events and a small reorder window are
+    # kept in memory
+    def __init__(self, windowSize=reorderWindowSize):
+        self.windowSize = windowSize
+        self.pendingEvents = []  # heap of (timestamp, arrival order, event)
+        self.arrivalCount = 0
+        self.lastTimestamp = None
+        self.lastEventStack = []
+        self.warnings = []
+        self.missingPrimitives = 0
+        self.mismatchedIntervals = 0
+        self.lateEvents = 0
+
+    def addEvent(self, event):
+        # Returns a list of any intervals that this event allowed us to finish
+        heapq.heappush(self.pendingEvents, (event['Timestamp'], self.arrivalCount, event))
+        self.arrivalCount += 1
+        if len(self.pendingEvents) > self.windowSize:
+            return self.processEvent(heapq.heappop(self.pendingEvents)[2])
+        return []
+
+    def finish(self):
+        # Flush the reorder window; returns any remaining intervals
+        intervalList = []
+        while len(self.pendingEvents) > 0:
+            intervalList.extend(self.processEvent(heapq.heappop(self.pendingEvents)[2]))
+        # Make sure there are no trailing ENTER events
+        if len(self.lastEventStack) > 0:
+            # TODO: this seems to be triggered by recent distributed runs;
+            # probably not a big deal as they're usually shudown_action events?
+            self.warnings.append('WARNING: omitting trailing ENTER event (%s)' % self.lastEventStack[-1].get('Primitive'))
+            self.lastEventStack = []
+        return intervalList
+
+    def processEvent(self, event):
+        if self.lastTimestamp is not None and event['Timestamp'] < self.lastTimestamp:
+            # This arrived later than the reorder window could absorb; the best
+            # we can do is to treat it as if it happened in arrival order
+            self.lateEvents += 1
+        else:
+            self.lastTimestamp = event['Timestamp']
+
+        currentInterval = None
+        if event['Event'] == 'ENTER':
+            # check if there is an enter event in the stack, push a dummy leave event
+            if len(self.lastEventStack) > 0:
+                dummyEvent = copy.deepcopy(self.lastEventStack[-1])
+                dummyEvent['Event'] = 'LEAVE'
+                dummyEvent['Timestamp'] = event['Timestamp'] - 1  # add a new dummy leave event in 1 time unit ago
+                if 'metrics' in event:
+                    dummyEvent['metrics'] = copy.deepcopy(event['metrics'])
+                currentInterval = createNewInterval(dummyEvent, self.lastEventStack[-1], self.warnings)
+            self.lastEventStack.append(event)
+        elif event['Event'] == 'LEAVE':
+            # Finish a interval
+            if len(self.lastEventStack) == 0:
+                # TODO: factorial data used to trigger this... why?
+                self.warnings.append('WARNING: omitting LEAVE event without a prior ENTER event (%s)' % event.get('Primitive'))
+                return []
+            lastEvent = self.lastEventStack.pop()
+            currentInterval = createNewInterval(event, lastEvent, self.warnings)
+            if len(self.lastEventStack) > 0:
+                self.lastEventStack[-1]['Timestamp'] = event['Timestamp'] + 1  # move the enter event to after 1 time unit
+
+        if currentInterval is None:
+            return []
+        # Count whether the primitive attribute is missing or differed between enter / leave
+        if 'Primitive' not in currentInterval:
+            if 'Primitive' not in currentInterval['enter'] or 'Primitive' not in currentInterval['leave']:
+                self.missingPrimitives += 1
+                currentInterval['Primitive'] = '(primitive name missing)'
+            else:
+                self.mismatchedIntervals += 1
+                # Use the enter event's primitive name
+                currentInterval['Primitive'] = currentInterval['enter']['Primitive']
+        return [currentInterval]
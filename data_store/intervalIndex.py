@@ -0,0 +1,98 @@
+import os
+import json
+from collections import namedtuple
+import numpy as np
+from .columnFiles import saveColumn, loadColumn
+
+# What iterOverlap() yields; same fields as intervaltree's Interval (data is
+# the interval's row in the interval table, as a string)
+IndexedInterval = namedtuple('IndexedInterval', ['begin', 'end', 'data'])
+
+# How many intervals iterOverlap() converts to python objects at a time
+iterChunkSize = 65536
+
+class IntervalIndex:
+    # Read-only index of every interval's [begin, end) span, for finding the
+    # intervals that overlap a query range. Like the IntervalTree that this
+    # replaces, end is the leave timestamp + 1, so that zero-length intervals
+    # still exist, and so that queries include intervals that end exactly at
+    # the query's beginning.
+    #
+    # Intervals are sorted by begin (then end, then row), and maxEnds[i] is the
+    # largest end of the first i + 1 intervals. Everything that overlaps
+    # [begin, end) sits between the first position where maxEnds > begin, and
+    # the last position where begins < end; both are binary searches, and only
+    # the intervals in between need to be checked.
+    #
+    # endOrder holds the positions sorted by end (then begin, then row), for
+    # traversals that need to see intervals in the order that they finished
+    def __init__(self):
+        self.begins = np.zeros(0, dtype=np.int64)
+        self.ends = np.zeros(0, dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.maxEnds = np.zeros(0, dtype=np.int64)
+        self.endOrder = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def build(cls, enters, leaves):
+        index = cls()
+        rows = np.arange(len(enters), dtype=np.int64)
+        begins = np.asarray(enters, dtype=np.int64)
+        ends = np.asarray(leaves, dtype=np.int64) + 1
+        order = np.lexsort((rows, ends, begins))
+        index.begins = begins[order]
+        index.ends = ends[order]
+        index.rows = rows[order]
+        index.maxEnds = np.maximum.accumulate(index.ends) if len(order) > 0 else np.zeros(0, dtype=np.int64)
+        index.endOrder = np.lexsort((index.rows, index.begins, index.ends))
+        return index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def overlapPositions(self, begin=None, end=None, endOrder=False):
+        # Positions (into begins / ends / rows) of the intervals that overlap
+        # [begin, end); either bound can be None for an open-ended query
+        if begin is None and end is None:
+            return np.asarray(self.endOrder) if endOrder else np.arange(len(self.rows), dtype=np.int64)
+        first = 0 if begin is None else int(np.searchsorted(self.maxEnds, begin, side='right'))
+        last = len(self.begins) if end is None else int(np.searchsorted(self.begins, end, side='left'))
+        if first >= last:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.arange(first, last, dtype=np.int64)
+        if begin is not None:
+            positions = positions[self.ends[first:last] > begin]
+        if endOrder:
+            positions = positions[np.lexsort((self.rows[positions], self.begins[positions], self.ends[positions]))]
+        return positions
+
+    def overlapRows(self, begin=None, end=None, endOrder=False):
+        # Interval table rows of the intervals that overlap [begin, end)
+        return self.rows[self.overlapPositions(begin, end, endOrder)]
+
+    def iterOverlap(self, begin=None, end=None, endOrder=False):
+        positions = self.overlapPositions(begin, end, endOrder)
+        for chunkStart in range(0, len(positions), iterChunkSize):
+            chunk = positions[chunkStart:chunkStart + iterChunkSize]
+            for ivBegin, ivEnd, row in zip(self.begins[chunk].tolist(), self.ends[chunk].tolist(), self.rows[chunk].tolist()):
+                yield IndexedInterval(ivBegin, ivEnd, str(row))
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest = {}
+        for name in ['begins', 'ends', 'rows', 'maxEnds', 'endOrder']:
+            fileName = name + '.npy'
+            saveColumn(path, fileName, getattr(self, name))
+            manifest[name] = fileName
+        with open(os.path.join(path, 'manifest.json'), 'w') as manifestFile:
+            json.dump(manifest, manifestFile)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'manifest.json'), 'r') as manifestFile:
+            manifest = json.load(manifestFile)
+        index = cls()
+        for name, fileName in manifest.items():
+            setattr(index, name, loadColumn(path, fileName))
+        return index
@@ -0,0 +1,400 @@
+import os
+import json
+import math
+from array import array
+import diskcache
+import numpy as np
+from .columnFiles import saveColumn, loadColumn
+
+# Per-interval columns, and their array typecodes while the table is being built
+rowColumnTypes = {
+    'enter': 'q',       # enter timestamp
+    'leave': 'q',       # leave timestamp
+    'location': 'i',    # index into strings, or -1
+    'primitive': 'i',   # index into strings, or -1
+    'guid': 'Q',
+    'parentGuid': 'Q',
+    'flags': 'B'        # see the flag bits below
+}
+# GUID / Parent GUID attributes usually apply to the whole interval, but when
+# ENTER and LEAVE disagree, they're stored per event; the guid / parentGuid
+# columns hold whichever one the interval has
+hasGuid = 1
+hasParentGuid = 2
+hasAttrs = 4
+hasEnterGuid = 8
+hasEnterParentGuid = 16
+maxGuid = 2 ** 64 - 1
+# How many side store records to group into each diskcache (SQLite)
+# transaction; writing records one at a time commits a transaction per
+# assignment
+writeBatchSize = 5000
+# How many interval dicts iterRecords() builds at a time
+readBatchSize = 1000
+# What summarizeRows() reports about each busy run
+runColumns = ['location', 'bin', 'begin', 'end', 'count', 'duration', 'primitive']
+
+def parseGuid(value):
+    # Only GUIDs that survive a round trip through an integer can live in the
+    # guid columns
+    if isinstance(value, str) and value.isdecimal() and str(int(value)) == value and int(value) <= maxGuid:
+        return int(value)
+    return None
+
+class IntervalTable:
+    # Columnar storage for intervals: one row per interval, where the row
+    # number is the intervalId. The attributes that every interval has live in
+    # memory-mapped columns; anything unusual goes to a diskcache side store,
+    # and full interval dicts are only rebuilt on request (self[intervalId]).
+    #
+    # While ingesting, intervals are append()ed to growable arrays; finalize()
+    # writes them to disk, and setLinks() fills in the parent / child columns
+    # (children are stored as CSR offsets into childIds)
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.attrs = diskcache.Index(os.path.join(path, 'attrs.diskCacheIndex'))
+        self.strings = []
+        self.stringIds = {}
+        self.metricNames = {'enter': [], 'leave': []}
+        self.length = 0
+        self.columns = None
+        self.metrics = None
+        self.pending = {name: array(typecode) for name, typecode in rowColumnTypes.items()}
+        self.pendingMetrics = {'enter': {}, 'leave': {}}
+        self.pendingAttrs = {}
+
+    def stringId(self, value):
+        stringId = self.stringIds.get(value, None)
+        if stringId is None:
+            stringId = self.stringIds[value] = len(self.strings)
+            self.strings.append(value)
+        return stringId
+
+    def flushAttrs(self):
+        with self.attrs.transact():
+            for key, value in self.pendingAttrs.items():
+                self.attrs[key] = value
+        self.pendingAttrs = {}
+
+    def append(self, intervalObj):
+        # Adds a new interval (as created by intervalBuilder), returning its row
+        row = self.length
+        residual = dict(intervalObj)
+        for key in ['intervalId', 'parent', 'children']:
+            residual.pop(key, None)
+        location = residual.pop('Location') if isinstance(residual.get('Location', None), str) else None
+        primitive = residual.pop('Primitive') if isinstance(residual.get('Primitive', None), str) else None
+        enter = dict(residual.pop('enter'))
+        leave = dict(residual.pop('leave'))
+        flags = 0
+        guid = parseGuid(residual.get('GUID', None))
+        if guid is not None:
+            del residual['GUID']
+            flags |= hasGuid
+        else:
+            guid = parseGuid(enter.get('GUID', None))
+            if guid is not None:
+                del enter['GUID']
+                flags |= hasEnterGuid
+        parentGuid = parseGuid(residual.get('Parent GUID', None))
+        if parentGuid is not None:
+            del residual['Parent GUID']
+            flags |= hasParentGuid
+        else:
+            parentGuid = parseGuid(enter.get('Parent GUID', None))
+            if parentGuid is not None:
+                del enter['Parent GUID']
+                flags |= hasEnterParentGuid
+        enterTimestamp = enter.pop('Timestamp')
+        leaveTimestamp = leave.pop('Timestamp')
+        self.appendMetrics('enter', enter.pop('metrics', {}))
+        self.appendMetrics('leave', leave.pop('metrics', {}))
+        if enter.get('Event', None) == 'ENTER':
+            del enter['Event']
+        if leave.get('Event', None) == 'LEAVE':
+            del leave['Event']
+        if len(enter) > 0:
+            residual['enter'] = enter
+        if len(leave) > 0:
+            residual['leave'] = leave
+        if len(residual) > 0:
+            flags |= hasAttrs
+            self.pendingAttrs[str(row)] = residual
+            if len(self.pendingAttrs) >= writeBatchSize:
+                self.flushAttrs()
+
+        pending = self.pending
+        pending['enter'].append(enterTimestamp)
+        pending['leave'].append(leaveTimestamp)
+        pending['location'].append(-1 if location is None else self.stringId(location))
+        pending['primitive'].append(-1 if primitive is None else self.stringId(primitive))
+        pending['guid'].append(0 if guid is None else guid)
+        pending['parentGuid'].append(0 if parentGuid is None else parentGuid)
+        pending['flags'].append(flags)
+        self.length += 1
+        return row
+
+    def appendMetrics(self, side, metrics):
+        # Each metric gets its own column per side; NaN means that the event
+        # didn't have a value for it
+        columns = self.pendingMetrics[side]
+        for name in metrics:
+            if name not in columns:
+                columns[name] = array('d', [float('nan')]) * self.length
+                self.metricNames[side].append(name)
+        for name, column in columns.items():
+            column.append(metrics.get(name, float('nan')))
+
+    def finalize(self):
+        # Write everything that was appended to disk, and switch to reading the
+        # memory-mapped columns
+        self.flushAttrs()
+        self.columns = {name: np.frombuffer(column, dtype=column.typecode) if len(column) > 0 else np.zeros(0, dtype=column.typecode) \
+                        for name, column in self.pending.items()}
+        self.metrics = {side: {name: np.frombuffer(column, dtype=np.float64) if len(column) > 0 else np.zeros(0, dtype=np.float64) \
+                               for name, column in columns.items()} \
+                        for side, columns in self.pendingMetrics.items()}
+        self.setLinks([], [])
+        self.pending = None
+        self.pendingMetrics = None
+        self.save(self.path)
+        self.columns = None
+        self.metrics = None
+        self.loadColumns(self.path)
+
+    def setLinks(self, childRows, parentRows):
+        # childRows[i]'s parent is parentRows[i]; each parent's children are
+        # stored in the order that their links appear
+        childRows = np.asarray(childRows, dtype=np.int64)
+        parentRows = np.asarray(parentRows, dtype=np.int64)
+        parent = np.full(self.length, -1, dtype=np.int64)
+        parent[childRows] = parentRows
+        order = np.argsort(parentRows, kind='stable')
+        childOffsets = np.zeros(self.length + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parentRows, minlength=self.length), out=childOffsets[1:])
+        self.columns['parent'] = parent
+        self.columns['childOffsets'] = childOffsets
+        self.columns['childIds'] = childRows[order]
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest = {'length': self.length, 'strings': self.strings, 'columns': {}, 'metrics': {'enter': {}, 'leave': {}}}
+        for name, column in self.columns.items():
+            fileName = name + '.npy'
+            saveColumn(path, fileName, column)
+            manifest['columns'][name] = fileName
+        for side, columns in self.metrics.items():
+            # Metric names aren't necessarily safe as file names
+            for i, name in enumerate(self.metricNames[side]):
+                fileName = '%s.metric%i.npy' % (side, i)
+                saveColumn(path, fileName, columns[name])
+                manifest['metrics'][side][name] = fileName
+        with open(os.path.join(path, 'manifest.json'), 'w') as manifestFile:
+            json.dump(manifest, manifestFile)
+        self.attrs.cache.close()
+
+    def loadColumns(self, path):
+        with open(os.path.join(path, 'manifest.json'), 'r') as manifestFile:
+            manifest = json.load(manifestFile)
+        self.length = manifest['length']
+        self.strings = manifest['strings']
+        self.stringIds = {value: stringId for stringId, value in enumerate(self.strings)}
+        self.columns = {name: loadColumn(path, fileName) for name, fileName in manifest['columns'].items()}
+        self.metricNames = {side: list(fileNames.keys()) for side, fileNames in manifest['metrics'].items()}
+        self.metrics = {side: {name: loadColumn(path, fileName) for name, fileName in fileNames.items()} \
+                        for side, fileNames in manifest['metrics'].items()}
+
+    @classmethod
+    def load(cls, path):
+        table = cls(path)
+        table.pending = None
+        table.pendingMetrics = None
+        table.loadColumns(path)
+        return table
+
+    def getRow(self, intervalId):
+        if not isinstance(intervalId, str) or not intervalId.isdecimal():
+            return None
+        row = int(intervalId)
+        return row if row < self.length and str(row) == intervalId else None
+
+    def getString(self, column, row):
+        stringId = self.columns[column][row]
+        return None if stringId < 0 else self.strings[stringId]
+
+    def getChildren(self, row):
+        childOffsets = self.columns['childOffsets']
+        return self.columns['childIds'][childOffsets[row]:childOffsets[row + 1]]
+
+    def selectRows(self, rows, location=None, primitive=None, guid=None, minDuration=None, maxDuration=None):
+        # Narrows rows (e.g. from the interval index) down to the intervals
+        # that match every filter that isn't None, using only the columns
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = self.columns
+        for column, value in [('location', location), ('primitive', primitive)]:
+            if value is not None and len(rows) > 0:
+                stringId = self.stringIds.get(value, None)
+                if stringId is None:
+                    return rows[:0]
+                rows = rows[columns[column][rows] == stringId]
+        if guid is not None and len(rows) > 0:
+            # GUIDs that didn't fit in the guid column can't equal an int
+            if guid < 0 or guid > maxGuid:
+                return rows[:0]
+            rows = rows[((columns['flags'][rows] & hasGuid) != 0) & (columns['guid'][rows] == np.uint64(guid))]
+        if (minDuration is not None or maxDuration is not None) and len(rows) > 0:
+            durations = columns['leave'][rows] - columns['enter'][rows]
+            keep = np.ones(len(rows), dtype=bool)
+            if minDuration is not None:
+                keep &= durations >= minDuration
+            if maxDuration is not None:
+                keep &= durations <= maxDuration
+            rows = rows[keep]
+        return rows
+
+    def summarizeRows(self, rows, begin, end, bins):
+        # Level of detail summary of rows (e.g. the intervals that overlap
+        # [begin, end)), for drawing a bins-pixel-wide Gantt chart. Intervals
+        # that are longer than a bin are returned as they are; the rest are
+        # merged, per location, into one busy run per bin (from the earliest
+        # enter to the latest leave of the intervals that enter in that bin),
+        # along with the primitive that spent the most time in the run.
+        # Locations / primitives are ids into self.strings (or -1)
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = self.columns
+        binWidth = (end - begin) / bins
+        durations = columns['leave'][rows] - columns['enter'][rows]
+        wide = durations > binWidth
+        summary = {'intervals': rows[wide], 'runs': {name: np.zeros(0, dtype=np.int64) for name in runColumns}}
+        rows = rows[~wide]
+        if len(rows) == 0:
+            return summary
+        durations = durations[~wide]
+        enters = columns['enter'][rows]
+        leaves = columns['leave'][rows]
+        locations = columns['location'][rows].astype(np.int64)
+        primitives = columns['primitive'][rows].astype(np.int64)
+        binIds = np.clip(np.floor((enters - begin) / binWidth).astype(np.int64), 0, bins - 1)
+
+        # Sort by run (location, then bin), and by primitive within each run
+        keys = (locations + 1) * bins + binIds
+        order = np.lexsort((primitives, keys))
+        keys = keys[order]
+        primitives = primitives[order]
+        durations = durations[order]
+        runStarts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        summary['runs'] = {
+            'location': keys[runStarts] // bins - 1,
+            'bin': keys[runStarts] % bins,
+            'begin': np.minimum.reduceat(enters[order], runStarts),
+            'end': np.maximum.reduceat(leaves[order], runStarts),
+            'count': np.diff(np.r_[runStarts, len(keys)]),
+            'duration': np.add.reduceat(durations, runStarts)
+        }
+
+        # Each run's representative primitive: the most total time, then the
+        # most intervals, then the lowest id
+        pairStarts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]) | (primitives[1:] != primitives[:-1])])
+        pairKeys = keys[pairStarts]
+        pairDurations = np.add.reduceat(durations, pairStarts)
+        pairCounts = np.diff(np.r_[pairStarts, len(keys)])
+        pairOrder = np.lexsort((primitives[pairStarts], -pairCounts, -pairDurations, pairKeys))
+        sortedPairKeys = pairKeys[pairOrder]
+        firstPairs = pairOrder[np.r_[True, sortedPairKeys[1:] != sortedPairKeys[:-1]]]
+        summary['runs']['primitive'] = primitives[pairStarts][firstPairs]
+        return summary
+
+    def getRecords(self, rows):
+        # Builds the full interval dicts for a batch of rows; this reads each
+        # column once for the whole batch, and all of the batch's side store
+        # records in one transaction
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = self.columns
+        rowList = rows.tolist()
+        enters = columns['enter'][rows].tolist()
+        leaves = columns['leave'][rows].tolist()
+        parents = columns['parent'][rows].tolist()
+        locations = columns['location'][rows].tolist()
+        primitives = columns['primitive'][rows].tolist()
+        guids = columns['guid'][rows].tolist()
+        parentGuids = columns['parentGuid'][rows].tolist()
+        flags = columns['flags'][rows].tolist()
+        childOffsets = columns['childOffsets']
+        childStarts = childOffsets[rows].tolist()
+        childEnds = childOffsets[rows + 1].tolist()
+        childIds = columns['childIds']
+        metrics = {side: [(name, column[rows].tolist()) for name, column in sideMetrics.items()] \
+                   for side, sideMetrics in self.metrics.items()}
+
+        residuals = {}
+        attrRows = [row for row, rowFlags in zip(rowList, flags) if rowFlags & hasAttrs]
+        if len(attrRows) > 0:
+            with self.attrs.transact():
+                for row in attrRows:
+                    residuals[row] = self.attrs[str(row)]
+
+        records = []
+        for i, row in enumerate(rowList):
+            intervalObj = {
+                'enter': {'Timestamp': enters[i], 'Event': 'ENTER',
+                          'metrics': {name: values[i] for name, values in metrics['enter'] if not math.isnan(values[i])}},
+                'leave': {'Timestamp': leaves[i], 'Event': 'LEAVE',
+                          'metrics': {name: values[i] for name, values in metrics['leave'] if not math.isnan(values[i])}},
+                'intervalId': str(row),
+                'parent': None if parents[i] < 0 else str(parents[i]),
+                'children': [str(child) for child in childIds[childStarts[i]:childEnds[i]].tolist()]
+            }
+            if locations[i] >= 0:
+                intervalObj['Location'] = self.strings[locations[i]]
+            if primitives[i] >= 0:
+                intervalObj['Primitive'] = self.strings[primitives[i]]
+            rowFlags = flags[i]
+            if rowFlags & hasGuid:
+                intervalObj['GUID'] = str(guids[i])
+            if rowFlags & hasParentGuid:
+                intervalObj['Parent GUID'] = str(parentGuids[i])
+            if rowFlags & hasEnterGuid:
+                intervalObj['enter']['GUID'] = str(guids[i])
+            if rowFlags & hasEnterParentGuid:
+                intervalObj['enter']['Parent GUID'] = str(parentGuids[i])
+            if rowFlags & hasAttrs:
+                for key, value in residuals[row].items():
+                    if key == 'enter' or key == 'leave':
+                        intervalObj[key].update(value)
+                    else:
+                        intervalObj[key] = value
+            records.append(intervalObj)
+        return records
+
+    def iterRecords(self, rows):
+        for batchStart in range(0, len(rows), readBatchSize):
+            yield from self.getRecords(rows[batchStart:batchStart + readBatchSize])
+
+    def __getitem__(self, intervalId):
+        row = self.getRow(intervalId)
+        if row is None:
+            raise KeyError(intervalId)
+        return self.getRecords([row])[0]
+
+    def get(self, intervalId, default=None):
+        if intervalId not in self:
+            return default
+        return self[intervalId]
+
+    def __contains__(self, intervalId):
+        return self.getRow(intervalId) is not None
+
+    def __len__(self):
+        return self.length
+
+    def keys(self):
+        return (str(row) for row in range(self.length))
+
+    def values(self):
+        return (self[intervalId] for intervalId in self.keys())
+
+    def items(self):
+        return ((intervalId, self[intervalId]) for intervalId in self.keys())
@@ -0,0 +1,65 @@
+import threading
+
+class LazyDataset(dict):
+    # A dataset's structures (info, primitives, sparseUtilizationList, etc.).
+    # Structures that exist on disk are registered with a function that loads
+    # them, and are only loaded the first time that they're accessed;
+    # otherwise, this behaves like a regular dict
+    def __init__(self, loaders=None):
+        super().__init__()
+        self.loaders = dict(loaders or {})
+        self.lock = threading.Lock()
+
+    def register(self, key, loader):
+        self.loaders[key] = loader
+
+    def load(self, key):
+        with self.lock:
+            # Another thread may have loaded it while we were waiting
+            if key in self.loaders:
+                super().__setitem__(key, self.loaders[key]())
+                del self.loaders[key]
+        return super().__getitem__(key)
+
+    def isLoaded(self, key):
+        return super().__contains__(key)
+
+    def loadedKeys(self):
+        return list(super().keys())
+
+    def __getitem__(self, key):
+        if key in self.loaders:
+            return self.load(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self.loaders.pop(key, None)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key in self.loaders:
+            del self.loaders[key]
+        else:
+            super().__delitem__(key)
+
+    def __contains__(self, key):
+        return key in self.loaders or super().__contains__(key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        # Loading a structure removes its loader, so these never overlap
+        return self.loadedKeys() + list(self.loaders.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
@@ -0,0 +1,95 @@
+# Tokenizer for otf2-print text output. Instead of running every regex against
+# every line, this dispatches on the record keyword and slices fields out with
+# plain string methods. Each tokenize* function returns None for lines that it
+# doesn't recognize, otherwise:
+#
+# ('ENTER' | 'LEAVE', location, timestamp, region)  (region may be None)
+# ('METRIC', location, timestamp, metricName, value)
+# ('ATTRS', [(name, value) | None, ...])  (None for unparseable attributes)
+
+numberChars = '0123456789.'
+
+def tokenizeLine(line):
+    first = line[:1]
+    if first == 'E' or first == 'L':
+        return tokenizeEventLine(line)
+    if first == 'M':
+        return tokenizeMetricLine(line)
+    if first == ' ' or first == '\t':
+        return tokenizeAddAttrLine(line)
+    return None
+
+def tokenizeEventLine(line):
+    fields = line.split(None, 3)
+    if len(fields) < 3 or (fields[0] != 'ENTER' and fields[0] != 'LEAVE') or \
+       not fields[1].isdecimal() or not fields[2].isdecimal():
+        return None
+    region = None
+    if len(fields) == 4:
+        rest = fields[3]
+        # If there's more than one Region attribute, the last one wins
+        start = rest.rfind('Region: "')
+        if start >= 0:
+            start += 9
+            stop = rest.find('"', start)
+            if stop >= 0:
+                region = rest[start:stop]
+    return (fields[0], fields[1], int(fields[2]), region)
+
+def tokenizeMetricLine(line):
+    fields = line.split(None, 3)
+    if len(fields) < 4 or fields[0] != 'METRIC' or not fields[1].isdecimal() or not fields[2].isdecimal():
+        return None
+    # Expecting something like 'Metric: 0, 1 Values: ("name" <0>; TYPE; value)'
+    head, sep, attrStr = fields[3].partition(': (')
+    if not sep or not head.startswith('Metric:'):
+        return None
+    if head.endswith('Values'):
+        head = head[7:-6]
+    elif head.endswith('Value'):
+        head = head[7:-5]
+    else:
+        return None
+    if head == '' or head.strip(' \t\n\r\f\v,0123456789') != '':
+        return None
+    attr = parseAttr(attrStr)
+    if attr is None:
+        return None
+    # Usually the value is just a number, but sometimes we can get input like
+    # "DOUBLE <2>; 1234.0000"... we want the last number
+    valueStr = attr[1]
+    if valueStr.strip(numberChars) != '':
+        stop = len(valueStr)
+        while stop > 0 and valueStr[stop - 1] not in numberChars:
+            stop -= 1
+        start = stop
+        while start > 0 and valueStr[start - 1] in numberChars:
+            start -= 1
+        valueStr = valueStr[start:stop]
+    if valueStr == '':
+        return None
+    return ('METRIC', fields[1], int(fields[2]), attr[0], float(valueStr))
+
+def tokenizeAddAttrLine(line):
+    start = line.find('ADDITIONAL ATTRIBUTES: ')
+    if start <= 0 or not line[:start].isspace():
+        return None
+    attrList = line[start + 23:].rstrip('\n').split('), (')
+    return ('ATTRS', [parseAttr(attrStr) for attrStr in attrList])
+
+def parseAttr(attrStr):
+    # Parses one '("name" <id>; TYPE; value)' chunk into (name, value)
+    if attrStr[:1] == '(':
+        attrStr = attrStr[1:]
+    if attrStr[:1] != '"':
+        return None
+    name, sep, rest = attrStr[1:].partition('" <')
+    if not sep or '"' in name:
+        return None
+    attrId, sep, rest = rest.partition('>; ')
+    if not sep or not attrId.isdecimal():
+        return None
+    attrType, sep, value = rest.partition('; ')
+    if not sep or ';' in attrType:
+        return None
+    return (name, value.partition(')')[0])
@@ -0,0 +1,94 @@
+import os
+import json
+from array import array
+import numpy as np
+from .columnFiles import saveColumn, loadColumn
+
+class ProcMetricColumns:
+    # Samples of the non-PAPI metrics (meminfo, status, io, etc.). During
+    # ingest, samples are appended to growable arrays; finalize() turns each
+    # metric into a pair of Timestamp / Value columns, sorted by timestamp
+    def __init__(self):
+        self.columns = {}
+        self.pending = {}
+
+    def append(self, metric, timestamp, value):
+        if metric not in self.pending:
+            self.pending[metric] = (array('q'), array('d'))
+        timestamps, values = self.pending[metric]
+        timestamps.append(timestamp)
+        values.append(value)
+
+    def finalize(self):
+        for metric, (timestamps, values) in self.pending.items():
+            timestamps = np.frombuffer(timestamps, dtype=np.int64)
+            values = np.frombuffer(values, dtype=np.float64)
+            if metric in self.columns:
+                timestamps = np.concatenate((self.columns[metric]['Timestamp'], timestamps))
+                values = np.concatenate((self.columns[metric]['Value'], values))
+            order = np.argsort(timestamps, kind='stable')
+            timestamps = timestamps[order]
+            values = values[order]
+            # When there are several samples with the same timestamp, the last
+            # one wins
+            keep = np.append(timestamps[1:] != timestamps[:-1], True)
+            self.columns[metric] = {'Timestamp': timestamps[keep], 'Value': values[keep]}
+        self.pending = {}
+
+    def __contains__(self, metric):
+        return metric in self.columns or metric in self.pending
+
+    def __getitem__(self, metric):
+        if metric in self.pending:
+            self.finalize()
+        return self.columns[metric]
+
+    def getRange(self, metric, begin=None, end=None, maxPoints=None):
+        # Timestamp / Value arrays of the metric's samples in [begin, end]. If
+        # there are more than maxPoints of them, the range is split into
+        # maxPoints // 2 equally long buckets, and only each bucket's lowest and
+        # highest samples are kept (in timestamp order), so that plotting the
+        # result still shows every peak and dip
+        columns = self[metric]
+        timestamps = columns['Timestamp']
+        first = 0 if begin is None else int(np.searchsorted(timestamps, begin, side='left'))
+        last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='right'))
+        timestamps = timestamps[first:last]
+        values = columns['Value'][first:last]
+        if maxPoints is None or len(timestamps) <= maxPoints:
+            return timestamps, values
+
+        bucketCount = max(1, maxPoints // 2)
+        edges = np.linspace(timestamps[0], timestamps[-1], bucketCount + 1)
+        buckets = np.clip(np.searchsorted(edges, timestamps, side='right') - 1, 0, bucketCount - 1)
+        lowest = np.lexsort((values, buckets))
+        highest = np.lexsort((-values, buckets))
+        bucketStarts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        keep = np.unique(np.concatenate((lowest[bucketStarts], highest[bucketStarts])))
+        return timestamps[keep], values[keep]
+
+    def keys(self):
+        return self.columns.keys() | self.pending.keys()
+
+    def save(self, path):
+        self.finalize()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        manifest = {}
+        for i, (metric, columns) in enumerate(self.columns.items()):
+            manifest[metric] = {}
+            for name, column in columns.items():
+                fileName = '%i.%s.npy' % (i, name)
+                saveColumn(path, fileName, column)
+                manifest[metric][name] = fileName
+        with open(os.path.join(path, 'manifest.json'), 'w') as manifestFile:
+            json.dump(manifest, manifestFile)
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        with open(os.path.join(path, 'manifest.json'), 'r') as manifestFile:
+            manifest = json.load(manifestFile)
+        for metric, fileNames in manifest.items():
+            store.columns[metric] = {name: loadColumn(path, fileName) for name, fileName in fileNames.items()}
+        return store
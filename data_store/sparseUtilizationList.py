@@ -1,50 +1,408 @@
 # Imports
-import copy
+import threading
 
 import numpy as np
 import json
 from profiling_tools._cCalcBin import ffi, lib
 
+class QueryBuffers(threading.local):
+    # Bin edges and kernel output buffers for calcUtilizationForLocation,
+    # reused from one call to the next as long as the bins / begin / end stay
+    # the same (e.g. for every location in a request). They're per thread,
+    # because the API serves requests from a thread pool
+    def __init__(self):
+        self.size = None
+        self.key = None
+
+    def prepare(self, bins, begin, end):
+        if self.size != bins + 1:
+            self.size = bins + 1
+            self.criticalPts = np.empty(bins + 1, dtype=np.int64)
+            self.histogramIndex = np.empty(bins + 1, dtype=np.int64)
+            self.histogramCounter = np.empty(bins + 1, dtype=np.int64)
+            self.histogramUtil = np.empty(bins + 1, dtype=np.double)
+            self.binWidths = np.empty(bins, dtype=np.int64)
+            self.criticalPtsPointer = ffi.cast("long long*", self.criticalPts.ctypes.data)
+            self.histogramIndexPointer = ffi.cast("long long*", self.histogramIndex.ctypes.data)
+            self.histogramCounterPointer = ffi.cast("long long*", self.histogramCounter.ctypes.data)
+            self.histogramUtilPointer = ffi.cast("double*", self.histogramUtil.ctypes.data)
+            self.key = None
+        if self.key != (bins, begin, end):
+            # The beginning of each bin, evenly divided over the range of time
+            # indices (truncated to integers), followed by the end
+            rangePerBin = (end-begin)/bins
+            self.criticalPts[:bins] = (np.arange(bins) * rangePerBin + begin).astype(np.int64)
+            self.criticalPts[bins] = end
+            np.subtract(self.criticalPts[1:], self.criticalPts[:-1], out=self.binWidths)
+            self.nonEmptyBins = self.binWidths != 0
+            self.key = (bins, begin, end)
+        return self
+
+queryBuffers = QueryBuffers()
+
+# Utilization pyramid settings (see buildPyramid): a grid gets at most one cell
+# per pyramidPointsPerCell critical points (rounded down to a power of two), as
+# anything finer would be slower than evaluating the critical points directly
+pyramidPointsPerCell = 8
+pyramidMinCells = 64
+pyramidMaxLocationCells = 2 ** 12
+pyramidMaxTotalCells = 2 ** 16
+# How many locations' grids to evaluate at once while building the total grid
+pyramidChunkSize = 256
+
+def pyramidCells(numPoints, maxCells):
+    cells = 2 ** int(np.log2(max(min(numPoints // pyramidPointsPerCell, maxCells), 1)))
+    return cells if cells >= pyramidMinCells else None
+
+def gridPositions(gridPts, pts):
+    # Where each of pts is in gridPts, or None if any of them falls between
+    # (or outside of) the grid points; grids are only ever read at their own
+    # points, so that they give the same answers as the critical points
+    positions = np.searchsorted(gridPts, pts, side='left')
+    if np.any(positions >= len(gridPts)) or not np.array_equal(gridPts[positions], pts):
+        return None
+    return positions
+
 class SparseUtilizationList():
     def __init__(self, isUpdate=True):
         self.locationDict = dict()
         self.cLocationDict = dict()
         self.isUpdateCounter = isUpdate
+        self.concatenated = None
+        self.primitiveSegments = None
+        self.pyramid = None
+        self.envelope = None
+
+    def __getstate__(self):
+        # The concatenated arrays are rebuilt on demand; don't pickle them
+        state = self.__dict__.copy()
+        state['concatenated'] = None
+        state['primitiveSegments'] = None
+        return state
 
     def getCLocation(self, loc):
         return self.cLocationDict[loc]
 
     def setCLocation(self, loc, val):
-        self.cLocationDict[loc] = copy.deepcopy(val)
+        self.cLocationDict[loc] = val
 
     def sortAtLoc(self, loc):
         self.locationDict[loc].sort(key=lambda x: x['index'])
 
+    # Turns each location's list of critical points into sorted index /
+    # counter / util arrays; afterwards, locationDict and cLocationDict share
+    # the same arrays. If the critical points have primitive names, each
+    # location also gets 'segments': the start / end arrays of its busy
+    # segments, per primitive (see calcUtilizationForPrimitive)
     def finalize(self, allLocations, isCumulative=False):
         for loc in allLocations:
-            if loc in self.locationDict:
-                self.sortAtLoc(loc)
-            self.locationDict[loc] = np.array(self.locationDict.get(loc, []))
+            criticalPts = self.locationDict.get(loc, [])
+            length = len(criticalPts)
+            index = np.fromiter((pt['index'] for pt in criticalPts), dtype=np.int64, count=length)
+            counter = np.fromiter((pt['counter'] for pt in criticalPts), dtype=np.int64, count=length)
+            # Stable, so that critical points with the same index keep their order
+            order = np.argsort(index, kind='stable')
+            index = index[order]
+            counter = counter[order]
 
-            length = len(self.locationDict[loc])
             if self.isUpdateCounter:
-                counter = 0
-                for i, criticalPt in enumerate(self.locationDict[loc]):
-                    counter += criticalPt['counter']
-                    criticalPt['counter'] = counter
-                    if i == 0:
-                        criticalPt['util'] = self.calcCurrentUtil(criticalPt['index'], None)
-                    else:
-                        criticalPt['util'] = self.calcCurrentUtil(criticalPt['index'], self.locationDict[loc][i-1])
-
-            locStruct = {'index': np.empty(length, dtype=np.int64), 'counter': np.empty(length, dtype=np.int64), 'util': np.zeros(length, dtype=np.double)}
-            for i in range(length):
-                locStruct['index'][i] = self.locationDict[loc][i]['index']
-                locStruct['counter'][i] = self.locationDict[loc][i]['counter']
-                locStruct['util'][i] = self.locationDict[loc][i]['util']
-                if isCumulative is True and i > 0:
-                    locStruct['util'][i] = locStruct['util'][i] + locStruct['util'][i-1]
+                counter, util = self.accumulateEdges(index, counter)
+            else:
+                util = np.fromiter((pt['util'] for pt in criticalPts), dtype=np.double, count=length)[order]
+            if isCumulative is True:
+                util = np.cumsum(util)
+
+            locStruct = {'index': index, 'counter': counter, 'util': util}
+            if length > 0 and 'primitive' in criticalPts[0]:
+                locStruct['segments'] = self.findSegments(criticalPts, order, index, counter)
+            self.locationDict[loc] = locStruct
             self.setCLocation(loc, locStruct)
+        self.concatenated = None
+        self.primitiveSegments = None
+        self.pyramid = None
+        self.envelope = None
+
+    def accumulateEdges(self, index, counter):
+        # counter is a running total of the (sorted) +1 / -1 edges, and util
+        # is the integral of counter up to each critical point (see
+        # calcCurrentUtil)
+        counter = np.cumsum(counter)
+        util = np.zeros(len(index), dtype=np.int64)
+        if len(index) > 1:
+            np.cumsum(np.diff(index) * counter[:-1], out=util[1:])
+        return counter, util.astype(np.double)
+
+    # Finalizes a single location straight from arrays of critical point
+    # timestamps and their +1 / -1 edges, instead of a list of dicts
+    def setLocationEdges(self, loc, index, counter):
+        order = np.argsort(index, kind='stable')
+        index = np.asarray(index, dtype=np.int64)[order]
+        counter, util = self.accumulateEdges(index, np.asarray(counter, dtype=np.int64)[order])
+        locStruct = {'index': index, 'counter': counter, 'util': util}
+        self.locationDict[loc] = locStruct
+        self.setCLocation(loc, locStruct)
+        self.concatenated = None
+        self.primitiveSegments = None
+        self.pyramid = None
+        self.envelope = None
+
+    def findSegments(self, criticalPts, order, index, counter):
+        # A segment runs from the previous critical point (or 0) up to each
+        # critical point where the location goes idle, and belongs to that
+        # critical point's primitive
+        ends = np.flatnonzero(counter == 0)
+        starts = np.zeros(len(ends), dtype=np.int64)
+        starts[ends > 0] = index[ends[ends > 0] - 1]
+        byPrimitive = {}
+        for i, k in enumerate(order[ends].tolist()):
+            byPrimitive.setdefault(criticalPts[k]['primitive'], []).append(i)
+        segments = {}
+        for primitive, rows in byPrimitive.items():
+            rows = np.array(rows, dtype=np.int64)
+            segments[primitive] = (starts[rows], index[ends[rows]])
+        return segments
+
+    # Every location's segments for one primitive (or 'all_primitives'), sorted
+    # by where they start; built on first use
+    def getPrimitiveSegments(self, primitive):
+        if getattr(self, 'primitiveSegments', None) is None:
+            self.primitiveSegments = {}
+        if primitive not in self.primitiveSegments:
+            startColumns = []
+            endColumns = []
+            for locStruct in self.locationDict.values():
+                segments = locStruct.get('segments', {})
+                for name, (starts, ends) in segments.items():
+                    if name == primitive or primitive == 'all_primitives':
+                        startColumns.append(starts)
+                        endColumns.append(ends)
+            starts = np.concatenate(startColumns) if len(startColumns) > 0 else np.zeros(0, dtype=np.int64)
+            ends = np.concatenate(endColumns) if len(endColumns) > 0 else np.zeros(0, dtype=np.int64)
+            order = np.argsort(starts, kind='stable')
+            self.primitiveSegments[primitive] = (starts[order], ends[order])
+        return self.primitiveSegments[primitive]
+
+    # Adds finalized locations from another SparseUtilizationList (e.g. one
+    # built for a different shard of locations)
+    def update(self, other):
+        self.locationDict.update(other.locationDict)
+        self.cLocationDict.update(other.cLocationDict)
+        self.concatenated = None
+        self.primitiveSegments = None
+        self.pyramid = None
+        self.envelope = None
+
+    # Every location's finalized arrays laid end to end, with where each
+    # location starts / ends, for the batched kernel; built on first use
+    def getConcatenatedLocations(self):
+        concatenated = getattr(self, 'concatenated', None)
+        if concatenated is None:
+            locations = list(self.locationDict.keys())
+            lengths = np.array([len(self.cLocationDict[loc]['index']) for loc in locations], dtype=np.int64)
+            ends = np.cumsum(lengths)
+            concatenated = {
+                'rows': {loc: i for i, loc in enumerate(locations)},
+                'starts': ends - lengths,
+                'ends': ends
+            }
+            for key, dtype in [('index', np.int64), ('counter', np.int64), ('util', np.double)]:
+                columns = [self.cLocationDict[loc][key] for loc in locations]
+                concatenated[key] = np.ascontiguousarray(np.concatenate(columns), dtype=dtype) if len(columns) > 0 else np.zeros(0, dtype=dtype)
+            self.concatenated = concatenated
+        return concatenated
+
+    # Pre-bins the utilization of each location (and of all locations combined)
+    # into a multi-resolution pyramid, so that coarse queries don't need to
+    # visit every critical point. Each grid holds the cumulative utilization at
+    # evenly spaced points over the whole domain; because it's cumulative, any
+    # coarser level of the pyramid is a strided view of it (grid[..., ::2**k]),
+    # so only the finest level is stored. Locations are grouped by the size of
+    # their grids; locations with too few critical points don't get one.
+    # Queries can only use a grid when every bin edge is one of its points
+    # (see pyramidPositions), e.g. the whole domain at any number of bins that
+    # divides the number of cells
+    def buildPyramid(self):
+        self.pyramid = None
+        if not self.isUpdateCounter:
+            return
+        locations = list(self.cLocationDict.keys())
+        lengths = [len(self.cLocationDict[loc]['index']) for loc in locations]
+        nonEmpty = [loc for loc, length in zip(locations, lengths) if length > 0]
+        if len(nonEmpty) == 0:
+            return
+        begin = int(min(self.cLocationDict[loc]['index'][0] for loc in nonEmpty))
+        end = int(max(self.cLocationDict[loc]['index'][-1] for loc in nonEmpty))
+
+        def evaluateGrid(cells, locs):
+            # Cumulative utilization at each grid point; the first grid point
+            # is the domain's beginning, where nothing has happened yet
+            grid = np.zeros((len(locs), cells + 1), dtype=np.double)
+            grid[:, 1:] = self.calcExactUtilizationMatrix(cells, begin, end, locs, False)
+            return grid
+
+        def gridPoints(cells):
+            return queryBuffers.prepare(cells, begin, end).criticalPts.copy()
+
+        pyramid = {'begin': begin, 'end': end, 'levels': {}, 'total': None}
+        groups = {}
+        for loc, length in zip(locations, lengths):
+            cells = pyramidCells(length, min(pyramidMaxLocationCells, end - begin))
+            if cells is not None:
+                groups.setdefault(cells, []).append(loc)
+        for cells, locs in groups.items():
+            pyramid['levels'][cells] = {
+                'gridPts': gridPoints(cells),
+                'rows': {loc: i for i, loc in enumerate(locs)},
+                'grid': evaluateGrid(cells, locs)
+            }
+        cells = pyramidCells(sum(lengths), min(pyramidMaxTotalCells, end - begin))
+        if cells is not None:
+            total = np.zeros(cells + 1, dtype=np.double)
+            for i in range(0, len(nonEmpty), pyramidChunkSize):
+                total += evaluateGrid(cells, nonEmpty[i:i + pyramidChunkSize]).sum(axis=0)
+            pyramid['total'] = {'gridPts': gridPoints(cells), 'grid': total}
+        self.pyramid = pyramid
+
+    # The metric equivalent of the pyramid (for lists where isUpdateCounter is
+    # False): the min / max / mean / std, across every location, of the
+    # metric's value at evenly spaced points over the whole domain. Unlike the
+    # pyramid, nothing is interpolated: a query can only use it when every bin
+    # ends on one of these points (see envelopePositions), e.g. the whole
+    # domain at any number of bins that divides the number of cells
+    def buildEnvelope(self):
+        self.envelope = None
+        if self.isUpdateCounter:
+            return
+        locations = list(self.cLocationDict.keys())
+        lengths = [len(self.cLocationDict[loc]['index']) for loc in locations]
+        nonEmpty = [loc for loc, length in zip(locations, lengths) if length > 0]
+        if len(nonEmpty) == 0:
+            return
+        begin = int(min(self.cLocationDict[loc]['index'][0] for loc in nonEmpty))
+        end = int(max(self.cLocationDict[loc]['index'][-1] for loc in nonEmpty))
+        cells = pyramidCells(sum(lengths), min(pyramidMaxTotalCells, end - begin))
+        if cells is None:
+            return
+
+        minimum = np.full(cells + 1, np.inf)
+        maximum = np.full(cells + 1, -np.inf)
+        # Running mean and sum of squared deviations, merged chunk by chunk
+        # (Chan et al.); sum(x^2) / n - mean^2 falls apart when the values are
+        # large compared to how much they vary
+        count = 0
+        mean = np.zeros(cells + 1, dtype=np.double)
+        m2 = np.zeros(cells + 1, dtype=np.double)
+        for i in range(0, len(locations), pyramidChunkSize):
+            locs = locations[i:i + pyramidChunkSize]
+            values = np.empty((len(locs), cells + 1), dtype=np.double)
+            # (the value at the end of a one-unit bin that ends at begin is the
+            # value at begin)
+            values[:, :1] = self.calcExactUtilizationMatrix(1, begin - 1, begin, locs, False)
+            values[:, 1:] = self.calcExactUtilizationMatrix(cells, begin, end, locs, False)
+            np.minimum(minimum, values.min(axis=0), out=minimum)
+            np.maximum(maximum, values.max(axis=0), out=maximum)
+            chunkMean = values.mean(axis=0)
+            chunkM2 = np.square(values - chunkMean).sum(axis=0)
+            delta = chunkMean - mean
+            merged = count + len(locs)
+            mean += delta * (len(locs) / merged)
+            m2 += chunkM2 + delta * delta * (count * len(locs) / merged)
+            count = merged
+        self.envelope = {
+            'begin': begin,
+            'end': end,
+            'gridPts': queryBuffers.prepare(cells, begin, end).criticalPts.copy(),
+            'min': minimum,
+            'max': maximum,
+            'average': mean,
+            'std': np.sqrt(m2 / count)
+        }
+
+    def envelopePositions(self, bins, begin, end):
+        # Which grid point holds each bin's value (the value at the end of the
+        # bin), or None if any bin ends between grid points. Before the domain,
+        # every location's value is 0 (position -1); after it, every location
+        # holds its last value (the last grid point)
+        gridPts = self.envelope['gridPts']
+        pts = queryBuffers.prepare(bins, begin, end).criticalPts[1:]
+        inside = (pts >= gridPts[0]) & (pts <= gridPts[-1])
+        insidePositions = gridPositions(gridPts, pts[inside])
+        if insidePositions is None:
+            return None
+        positions = np.where(pts < gridPts[0], -1, len(gridPts) - 1)
+        positions[inside] = insidePositions
+        return positions
+
+    def calcEnvelopeHistogram(self, positions):
+        envelope = self.envelope
+        beforeDomain = positions < 0
+        positions = np.maximum(positions, 0)
+        result = {}
+        for stat in ['min', 'max', 'average', 'std']:
+            values = envelope[stat][positions]
+            values[beforeDomain] = 0
+            result[stat] = values.tolist()
+        return result
+
+    def pyramidPositions(self, gridPts, bins, begin, end):
+        # Which grid point each bin edge is, or None if any bin edge falls
+        # between grid points
+        return gridPositions(gridPts, queryBuffers.prepare(bins, begin, end).criticalPts)
+
+    def calcPyramidHistograms(self, grid, positions, bins, begin, end):
+        # Average utilization in each bin, from one or more rows of a grid
+        buffers = queryBuffers.prepare(bins, begin, end)
+        util = grid[..., positions]
+        out = np.zeros(util.shape[:-1] + (bins,), dtype=np.double)
+        np.divide(np.diff(util, axis=-1), buffers.binWidths, out=out, where=buffers.nonEmptyBins)
+        return out
+
+    # Calculates a locations x bins matrix of utilization (or, if isInterval is
+    # False, of values at the end of each bin); rows follow the order of
+    # locations (default: every location in locationDict). Where the bins
+    # line up with a level of the pyramid, rows are read from it; the rest
+    # are evaluated exactly
+    def calcUtilizationMatrix(self, bins=100, begin=None, end=None, locations=None, isInterval=True):
+        if not isInterval or getattr(self, 'pyramid', None) is None:
+            return self.calcExactUtilizationMatrix(bins, begin, end, locations, isInterval)
+        if locations is None:
+            locations = list(self.locationDict.keys())
+        matrix = np.empty((len(locations), bins), dtype=np.double)
+        exactRows = np.ones(len(locations), dtype=bool)
+        for level in self.pyramid['levels'].values():
+            positions = self.pyramidPositions(level['gridPts'], bins, begin, end)
+            if positions is None:
+                continue
+            rows = [(i, level['rows'][loc]) for i, loc in enumerate(locations) if loc in level['rows']]
+            if len(rows) == 0:
+                continue
+            rows, gridRows = np.array(rows, dtype=np.int64).T
+            matrix[rows] = self.calcPyramidHistograms(level['grid'][gridRows], positions, bins, begin, end)
+            exactRows[rows] = False
+        if exactRows.any():
+            rows = np.flatnonzero(exactRows)
+            matrix[rows] = self.calcExactUtilizationMatrix(bins, begin, end, [locations[i] for i in rows])
+        return matrix
+
+    # Same as calcUtilizationMatrix, but always evaluated from the critical
+    # points in one native call
+    def calcExactUtilizationMatrix(self, bins=100, begin=None, end=None, locations=None, isInterval=True):
+        concatenated = self.getConcatenatedLocations()
+        if locations is None:
+            starts = concatenated['starts']
+            ends = concatenated['ends']
+        else:
+            rows = np.array([concatenated['rows'][loc] for loc in locations], dtype=np.int64)
+            starts = concatenated['starts'][rows]
+            ends = concatenated['ends'][rows]
+        matrix = np.empty((len(starts), bins), dtype=np.double)
+        buffers = queryBuffers.prepare(bins, begin, end)
+        lib.calcHistogramMatrix(ffi.cast("double*", matrix.ctypes.data), bins, buffers.criticalPtsPointer, 1 if isInterval else 0,
+                                ffi.cast("long long*", starts.ctypes.data), ffi.cast("long long*", ends.ctypes.data), len(starts),
+                                ffi.cast("long long*", concatenated['index'].ctypes.data),
+                                ffi.cast("long long*", concatenated['counter'].ctypes.data),
+                                ffi.cast("double*", concatenated['util'].ctypes.data))
+        return matrix
 
     def calcCurrentUtil(self, index, prior):
         if prior is None:
@@ -66,36 +424,31 @@ class SparseUtilizationList():
     def calcGanttHistogram(self, bins=100, begin=None, end=None):
         listOfLocations = []
 
-        for location in self.locationDict:
-            temp = self.calcUtilizationForLocation(bins, begin, end, location)
+        matrix = self.calcUtilizationMatrix(bins, begin, end)
+        for location, temp in zip(self.locationDict, matrix):
             listOfLocations.append({"location":location, "histogram":temp})
 
         return listOfLocations
 
     # Calculates utilization histogram for all intervals regardless of location
     def calcUtilizationHistogram(self, bins=100, begin=None, end=None, isInterval=True):
-        array = []
-        isFirst = True
-        for location in self.locationDict:
-            temp = self.calcUtilizationForLocation(bins, begin, end, location, isInterval)
-            if isFirst is True:
-                isFirst = False
-                array = temp
-            else:
-                for i in range(bins):
-                    array[i] = array[i] + temp[i]
-
-        return array
+        total = self.pyramid['total'] if isInterval and getattr(self, 'pyramid', None) is not None else None
+        positions = self.pyramidPositions(total['gridPts'], bins, begin, end) if total is not None else None
+        if positions is not None:
+            # The cost of this doesn't depend on the size of the trace
+            return self.calcPyramidHistograms(total['grid'], positions, bins, begin, end)
+        return self.calcUtilizationMatrix(bins, begin, end, None, isInterval).sum(axis=0)
 
     # Calculates metric histogram
     def calcMetricHistogram(self, bins=100, begin=None, end=None, location=None):
-        array = []
         if location is not None:
             return self.calcUtilizationForLocation(bins, begin, end, location, False)
-        for location in self.locationDict:
-            temp = self.calcUtilizationForLocation(bins, begin, end, location, False)
-            array.append(temp)
-        array = np.asarray(array)
+        positions = self.envelopePositions(bins, begin, end) if getattr(self, 'envelope', None) is not None else None
+        if positions is not None:
+            # The cost of this doesn't depend on the number of samples
+            return self.calcEnvelopeHistogram(positions)
+        # Every location's values in one native call
+        array = self.calcUtilizationMatrix(bins, begin, end, None, False)
         avgArray = np.mean(array, axis=0)
         minArray = np.amin(array, axis=0)
         maxArray = np.amax(array, axis=0)
@@ -108,51 +461,37 @@ class SparseUtilizationList():
 
     # Calculates utilization for one location in a Gantt chart
     # Location designates a particular CPU or Thread and denotes the y-axis on the Gantt Chart
-    def calcUtilizationForLocation(self, bins=100, begin=None, end=None, Location=None, isInterval=True):
-        rangePerBin = (end-begin)/bins
-
-        # caclulates the beginning of each each bin evenly divided over the range of
-        # time indicies and stores them as critical points
-        criticalPts = np.empty(bins + 1, dtype=np.int64)
-        critical_length = len(criticalPts)
-        critical_points = ffi.new("long long[]", critical_length)
-        for i in range(0, bins):
-            criticalPts[i] = (i * rangePerBin) + begin
-            critical_points[i] = int((i * rangePerBin) + begin)
-        criticalPts[len(criticalPts)-1] = end
-        critical_points[len(criticalPts)-1] = end
-
-        # searches
-        histogram = np.empty_like(criticalPts, dtype=object)
-        location = self.locationDict[Location]
-        length = len(location)
-        histogram_length = len(histogram)
-
-        histogram_index = ffi.new("long long[]", histogram_length)
-        histogram_counter = ffi.new("long long[]", histogram_length)
-        histogram_util = ffi.new("double[]", histogram_length)
-
+    # Returns a numpy array with one value per bin (written into out, if provided)
+    def calcUtilizationForLocation(self, bins=100, begin=None, end=None, Location=None, isInterval=True, out=None):
+        if out is None:
+            out = np.empty(bins, dtype=np.double)
         cLocationStruct = self.getCLocation(Location)
+        length = len(cLocationStruct['index'])
+        if length == 0:
+            # Nothing ever happened at this location
+            out.fill(0)
+            return out
+
+        buffers = queryBuffers.prepare(bins, begin, end)
         location_index = ffi.cast("long long*", cLocationStruct['index'].ctypes.data)
         location_counter = ffi.cast("long long*", cLocationStruct['counter'].ctypes.data)
         location_util = ffi.cast("double*", cLocationStruct['util'].ctypes.data)
 
-        lib.calcHistogram(histogram_counter, histogram_length, histogram_index, histogram_util, critical_points, critical_length, location_index, length-1, location_counter, location_util)
-        histogram[0] = {'integral': 0, 'index': histogram_index[0], 'util': histogram_util[0], 'counter': histogram_counter[0]}
-        prev = histogram[0]
-        prettyHistogram = []
-        for i in range(1, len(histogram)):
-            histogram[i] = {'index': histogram_index[i], 'util': histogram_util[i], 'counter': histogram_counter[i]}
-            current = histogram[i]
-            val = current['util']
-            if isInterval:
-                val = (current['util'] - prev['util']) / (current['index'] - prev['index'])
-            current['integral'] = val
-            prev = current
-            prettyHistogram.append(histogram[i]['integral'])
-        return prettyHistogram
-
-    # Calculates utilization for each primitive and returns util per duration
+        lib.calcHistogram(buffers.histogramCounterPointer, bins + 1, buffers.histogramIndexPointer, buffers.histogramUtilPointer,
+                          buffers.criticalPtsPointer, bins + 1, location_index, length-1, location_counter, location_util)
+        util = buffers.histogramUtil
+        if isInterval:
+            # Average utilization over each bin
+            np.subtract(util[1:], util[:-1], out=out)
+            np.divide(out, buffers.binWidths, out=out, where=buffers.nonEmptyBins)
+        else:
+            out[:] = util[1:]
+        return out
+
+    # Calculates utilization for each primitive and returns util per duration:
+    # row i (for i >= 1) holds how much time segments of each duration spent
+    # between begin + (i - 1) * rangePerBin and begin + i * rangePerBin (row 0
+    # stays empty, and the time after the last row isn't counted)
     def calcUtilizationForPrimitive(self, bins=100,
                                     begin=None,
                                     end=None,
@@ -163,39 +502,42 @@ class SparseUtilizationList():
         primitiveCountPerBin = np.zeros((bins, durationBins+1), dtype=np.double)
         rangePerBin = (end-begin)/bins
         rangePerDurationBin = (durationEnd-durationBegin)/durationBins
-        location_struct_index = dict()
-        location_struct_length = dict()
-        preCriticalPts = begin
-        for i in range(1, bins):
-            criticalPts = (i * rangePerBin) + begin
-
-            for location in self.locationDict:
-                if location not in location_struct_index:
-                    location_struct_index[location] = 0
-                if location not in location_struct_length:
-                    location_struct_length[location] = len(self.locationDict[location])
-
-                while location_struct_index[location] < location_struct_length[location]:
-                    locStruct = self.locationDict[location][location_struct_index[location]]
-                    # since its sorted per location, all end indexes are from the same interval of previous enter index
-                    if location_struct_index[location] > 0:
-                        startIndex = self.locationDict[location][location_struct_index[location]-1]['index']
-                    else:
-                        startIndex = 0
-                    if (locStruct['primitive'] == primitive or primitive == 'all_primitives') and locStruct['counter'] == 0:
-                        if startIndex < criticalPts:
-                            intervalChunkStart = max(preCriticalPts, startIndex)
-                            intervalChunkEnd = min(criticalPts, locStruct['index'])
-                            currentUtil = intervalChunkEnd - intervalChunkStart  # it should cover left/right/full overlap cases
-                            duration = locStruct['index'] - startIndex
-                            durationIndex = int((duration - durationBegin) // rangePerDurationBin)
-                            primitiveCountPerBin[i, durationIndex] = primitiveCountPerBin[i, durationIndex] + float(currentUtil)
-                            if primitiveCountPerBin[i, durationIndex] < 0:
-                                print("Error: negative Util found " + str(primitiveCountPerBin[i, durationIndex]))
-                                return []
-                        if locStruct['index'] > criticalPts:  # check this explicitly, you dont wanna increase the index number
-                            break
-                    location_struct_index[location] = location_struct_index[location] + 1
-
-            preCriticalPts = criticalPts
+        edges = np.arange(bins) * rangePerBin + begin
+        if bins < 2:
+            return primitiveCountPerBin.tolist()
+
+        # Only segments that overlap rows 1 .. bins - 1 count; they're sorted
+        # by start, so the ones that start too late are simply cut off
+        starts, ends = self.getPrimitiveSegments(primitive)
+        cutoff = np.searchsorted(starts, edges[-1], side='left')
+        overlapping = ends[:cutoff] > begin
+        starts = starts[:cutoff][overlapping]
+        ends = ends[:cutoff][overlapping]
+        if len(starts) == 0:
+            return primitiveCountPerBin.tolist()
+
+        durations = ends - starts
+        if rangePerDurationBin == 0:
+            durationIndex = np.zeros(len(durations), dtype=np.int64)
+        else:
+            durationIndex = np.floor_divide(durations - durationBegin, rangePerDurationBin).astype(np.int64)
+        # The first and last rows that each segment overlaps
+        firstRow = np.maximum(np.searchsorted(edges, starts, side='right'), 1)
+        lastRow = np.minimum(np.searchsorted(edges, ends, side='left'), bins - 1)
+
+        def overlap(rows):
+            return np.minimum(edges[rows], ends) - np.maximum(edges[rows - 1], starts)
+
+        # Partial overlaps at either end of each segment...
+        np.add.at(primitiveCountPerBin, (firstRow, durationIndex), overlap(firstRow))
+        multiRow = lastRow > firstRow
+        np.add.at(primitiveCountPerBin, (lastRow[multiRow], durationIndex[multiRow]), overlap(lastRow)[multiRow])
+        # ... and whole rows in between, counted with a difference array
+        covering = np.zeros((bins + 1, durationBins+1), dtype=np.int64)
+        np.add.at(covering, (firstRow[multiRow] + 1, durationIndex[multiRow]), 1)
+        np.add.at(covering, (lastRow[multiRow], durationIndex[multiRow]), -1)
+        covering = np.cumsum(covering[:bins], axis=0)
+        rowWidths = np.zeros(bins, dtype=np.double)
+        rowWidths[1:] = np.diff(edges)
+        primitiveCountPerBin += covering * rowWidths[:, np.newaxis]
         return primitiveCountPerBin.tolist()
@@ -0,0 +1,121 @@
+import os
+import json
+import numpy as np
+from .columnFiles import saveColumn, loadColumn
+from .sparseUtilizationList import SparseUtilizationList
+
+class SparseUtilizationStore(dict):
+    # A dataset's SparseUtilizationLists: {'intervals': list, 'metrics':
+    # {metric: list}, 'primitives': {primitive: list}, 'intervalHistograms':
+    # {primitive: list}}.
+    #
+    # On disk, every array of every list is packed into one file per dtype
+    # (pool.int64.npy, pool.float64.npy); manifest.json says where each array
+    # starts, and its shape. Each list's locations are stored end to end (see
+    # SparseUtilizationList.getConcatenatedLocations), so after memory-mapping
+    # the pools, each location's index / counter / util arrays are views, and
+    # nothing needs to be copied or unpickled
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        pools = {'int64': [], 'float64': []}
+        poolSizes = {'int64': 0, 'float64': 0}
+
+        def addArray(array):
+            dtype = 'float64' if np.asarray(array).dtype.kind == 'f' else 'int64'
+            array = np.ascontiguousarray(array, dtype=dtype)
+            ref = [dtype, poolSizes[dtype], list(array.shape)]
+            pools[dtype].append(array.ravel())
+            poolSizes[dtype] += array.size
+            return ref
+
+        def describe(sul):
+            concatenated = sul.getConcatenatedLocations()
+            description = {
+                'isUpdateCounter': sul.isUpdateCounter,
+                'locations': list(concatenated['rows'].keys())
+            }
+            for key in ['starts', 'ends', 'index', 'counter', 'util']:
+                description[key] = addArray(concatenated[key])
+            # Store the per-primitive segments (for calcUtilizationForPrimitive)
+            # already combined across locations
+            primitives = set()
+            for locStruct in sul.locationDict.values():
+                primitives.update(locStruct.get('segments', {}).keys())
+            if len(primitives) > 0:
+                description['segments'] = {}
+                for primitive in sorted(primitives) + ['all_primitives']:
+                    starts, ends = sul.getPrimitiveSegments(primitive)
+                    description['segments'][primitive] = [addArray(starts), addArray(ends)]
+            pyramid = getattr(sul, 'pyramid', None)
+            if pyramid is not None:
+                description['pyramid'] = {
+                    'begin': pyramid['begin'],
+                    'end': pyramid['end'],
+                    'levels': [[cells, list(level['rows'].keys()), addArray(level['gridPts']), addArray(level['grid'])] \
+                               for cells, level in pyramid['levels'].items()],
+                    'total': None if pyramid['total'] is None else \
+                             [addArray(pyramid['total']['gridPts']), addArray(pyramid['total']['grid'])]
+                }
+            envelope = getattr(sul, 'envelope', None)
+            if envelope is not None:
+                description['envelope'] = {'begin': envelope['begin'], 'end': envelope['end']}
+                for key in ['gridPts', 'min', 'max', 'average', 'std']:
+                    description['envelope'][key] = addArray(envelope[key])
+            return description
+
+        manifest = {'lists': {}, 'groups': {}}
+        for key, value in self.items():
+            if isinstance(value, SparseUtilizationList):
+                manifest['lists'][key] = describe(value)
+            else:
+                manifest['groups'][key] = {name: describe(sul) for name, sul in value.items()}
+        for dtype, arrays in pools.items():
+            saveColumn(path, 'pool.%s.npy' % dtype, np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0, dtype=dtype))
+        with open(os.path.join(path, 'manifest.json'), 'w') as manifestFile:
+            json.dump(manifest, manifestFile)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'manifest.json'), 'r') as manifestFile:
+            manifest = json.load(manifestFile)
+        pools = {dtype: loadColumn(path, 'pool.%s.npy' % dtype) for dtype in ['int64', 'float64']}
+
+        def getArray(ref):
+            dtype, offset, shape = ref
+            return pools[dtype][offset:offset + int(np.prod(shape))].reshape(shape)
+
+        def restore(description):
+            sul = SparseUtilizationList(description['isUpdateCounter'])
+            concatenated = {key: getArray(description[key]) for key in ['starts', 'ends', 'index', 'counter', 'util']}
+            concatenated['rows'] = {}
+            for row, (loc, start, end) in enumerate(zip(description['locations'], concatenated['starts'].tolist(), concatenated['ends'].tolist())):
+                locStruct = {key: concatenated[key][start:end] for key in ['index', 'counter', 'util']}
+                sul.locationDict[loc] = locStruct
+                sul.setCLocation(loc, locStruct)
+                concatenated['rows'][loc] = row
+            sul.concatenated = concatenated
+            if 'segments' in description:
+                sul.primitiveSegments = {primitive: (getArray(starts), getArray(ends)) \
+                                         for primitive, (starts, ends) in description['segments'].items()}
+            if 'pyramid' in description:
+                pyramid = description['pyramid']
+                sul.pyramid = {
+                    'begin': pyramid['begin'],
+                    'end': pyramid['end'],
+                    'levels': {cells: {'rows': {loc: i for i, loc in enumerate(locations)}, 'gridPts': getArray(gridPts), 'grid': getArray(grid)} \
+                               for cells, locations, gridPts, grid in pyramid['levels']},
+                    'total': None if pyramid['total'] is None else \
+                             {'gridPts': getArray(pyramid['total'][0]), 'grid': getArray(pyramid['total'][1])}
+                }
+            if 'envelope' in description:
+                sul.envelope = {key: getArray(value) if key not in ['begin', 'end'] else value \
+                                for key, value in description['envelope'].items()}
+            return sul
+
+        store = cls()
+        for key, description in manifest['lists'].items():
+            store[key] = restore(description)
+        for key, descriptions in manifest['groups'].items():
+            store[key] = {name: restore(description) for name, description in descriptions.items()}
+        return store
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import argparse
+import subprocess
+from data_store.otf2Tokenizer import tokenizeLine
+from data_store.eventColumns import EventColumnsWriter
+
+parser = argparse.ArgumentParser( \
+    description=('Convert an OTF2 trace into a compact columnar event file (.npz) '
+                 'that bundle.py --otf2 can ingest without re-parsing otf2-print text'))
+parser.add_argument('input', type=str, metavar='path',
+                    help=('Input otf2 trace (e.g. OTF2_archive/APEX.otf2), or a text '
+                          'file with otf2-print output'))
+parser.add_argument('output', type=str, metavar='path',
+                    help='Where to write the columnar event file (e.g. APEX.npz)')
+
+def main():
+    args = parser.parse_args()
+    if args.input.endswith('.otf2'):
+        otfPipe = subprocess.Popen(['otf2-print', args.input], stdout=subprocess.PIPE)
+        lines = (bytesChunk.decode() for bytesChunk in otfPipe.stdout)
+    else:
+        lines = open(args.input, 'r')
+    writer = EventColumnsWriter()
+    for line in lines:
+        writer.addToken(tokenizeLine(line))
+    writer.save(args.output)
+    print('Wrote %i events to %s' % (writer.numEvents, args.output))
+    if writer.badAttrs > 0:
+        print('WARNING: omitted %i unparseable additional attributes' % writer.badAttrs)
+
+if __name__ == '__main__':
+    main()
@@ -48,6 +48,60 @@ void calcHistogram(long long *histogram_counter, int histogram_size,
 	}
 }
 
+/*
+ * Fills a num_locations x bins matrix in one call. Each location's critical
+ * points are location_index[location_starts[l]] .. location_index[location_ends[l] - 1]
+ * (and the same for location_counter / location_util). Each row holds the
+ * average utilization in each bin if is_interval is set, otherwise the
+ * utilization at the end of each bin (critical_points has bins + 1 entries).
+ * Locations are independent, so if this is compiled with -fopenmp, they are
+ * spread across threads.
+ */
+void calcHistogramMatrix(double *histogram_matrix, int bins,
+		long long *critical_points, int is_interval,
+		long long *location_starts, long long *location_ends, int num_locations,
+		long long *location_index,
+		long long *location_counter,
+		double *location_util) {
+	int l;
+
+	#pragma omp parallel for schedule(dynamic)
+	for(l=0;l<num_locations;l++){
+		long long *index = location_index + location_starts[l];
+		long long *counter = location_counter + location_starts[l];
+		double *util = location_util + location_starts[l];
+		int size = (int)(location_ends[l] - location_starts[l]);
+		double *row = histogram_matrix + (long long)l * bins;
+		int i;
+		int nextRecordIndex = 0;
+		double prevUtil = 0.0;
+		double currentUtil = 0.0;
+
+		if(size == 0) {
+			for(i=0;i<bins;i++) row[i] = 0;
+			continue;
+		}
+		for(i=0;i<=bins;i++){
+			long long pt = critical_points[i];
+			if(pt < index[0]) {
+				currentUtil = 0;
+			} else {
+				nextRecordIndex = binary_srch(index, nextRecordIndex, size - 1, pt);
+				currentUtil = (((pt - index[nextRecordIndex]) * counter[nextRecordIndex]) + util[nextRecordIndex]);
+			}
+			if(i > 0) {
+				if(is_interval) {
+					long long width = pt - critical_points[i-1];
+					row[i-1] = width != 0 ? (currentUtil - prevUtil) / width : 0;
+				} else {
+					row[i-1] = currentUtil;
+				}
+			}
+			prevUtil = currentUtil;
+		}
+	}
+}
+
 /*
 int main() {
 	int v[10], i;
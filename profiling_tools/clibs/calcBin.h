@@ -6,3 +6,9 @@ void calcHistogram(long long *histogram_counter, int histogram_size,
 		long long *location_index, int location_size,
 		long long *location_counter,
 		double *location_util);
+void calcHistogramMatrix(double *histogram_matrix, int bins,
+		long long *critical_points, int is_interval,
+		long long *location_starts, long long *location_ends, int num_locations,
+		long long *location_index,
+		long long *location_counter,
+		double *location_util);
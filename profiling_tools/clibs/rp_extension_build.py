@@ -10,6 +10,12 @@ ffibuilder.cdef("""
 		long long *location_index, int location_size,
 		long long *location_counter,
 		double *location_util);
+    void calcHistogramMatrix(double *histogram_matrix, int bins,
+		long long *critical_points, int is_interval,
+		long long *location_starts, long long *location_ends, int num_locations,
+		long long *location_index,
+		long long *location_counter,
+		double *location_util);
 
        """)
 
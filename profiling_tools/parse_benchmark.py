@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+# Make the data_store package importable when running this from anywhere
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from data_store.otf2Tokenizer import tokenizeLine
+
+parser = argparse.ArgumentParser(description='Measure how many otf2-print lines per second we can parse.')
+parser.add_argument('inputs', metavar='path', nargs='+',
+                    help=('otf2-print text dumps, or OTF2 archives (e.g. OTF2_archive/APEX.otf2) '
+                          'that will be run through otf2-print first'))
+parser.add_argument('-n', '--number-trials', dest='n_trials', type=int, default=3,
+                    help='Number of passes over each input; the fastest is reported. Default 3.')
+parser.add_argument('-m', '--max-lines', dest='max_lines', type=int, default=None,
+                    help='Only benchmark the first N lines of each input.')
+parser.add_argument('-r', '--regex', dest='regex', action='store_true',
+                    help='Also benchmark the regex-based parser that the tokenizer replaced, for comparison.')
+parser.add_argument('-o', '--output', dest='output', default=None,
+                    help=('JSON file to append results to, so that parse throughput can be '
+                          'tracked from one release to the next.'))
+
+# The regexes that processRawTrace used to run on every line
+eventLineParser = re.compile(r'^((?:ENTER)|(?:LEAVE))\s+(\d+)\s+(\d+)\s+(.*)$')
+regionParser = re.compile(r'(Region): "([^"]*)"')
+addAttrLineParser = re.compile(r'^\s+ADDITIONAL ATTRIBUTES: (.*)$')
+addAttrSplitter = re.compile(r'\), \(')
+addAttrParser = re.compile(r'\(?"([^"]*)" <\d+>; [^;]*; ([^\)]*)')
+metricLineParser = re.compile(r'^METRIC\s+(\d+)\s+(\d+)\s+Metric:[\s\d,]+Values?: \("([^"]*)" <\d+>; [^;]*; ([^\)]*)')
+
+def regexParseLine(line):
+    eventLineMatch = eventLineParser.match(line)
+    addAttrLineMatch = addAttrLineParser.match(line)
+    metricLineMatch = metricLineParser.match(line)
+    if metricLineMatch is not None:
+        value = float(re.findall('[0-9.]+', metricLineMatch.group(4))[-1])
+        return ('METRIC', metricLineMatch.group(1), int(metricLineMatch.group(2)), metricLineMatch.group(3), value)
+    if eventLineMatch is not None:
+        region = None
+        for attrMatch in regionParser.finditer(eventLineMatch.group(4)):
+            region = attrMatch.group(2)
+        return (eventLineMatch.group(1), eventLineMatch.group(2), int(eventLineMatch.group(3)), region)
+    if addAttrLineMatch is not None:
+        attrs = []
+        for attrStr in addAttrSplitter.split(addAttrLineMatch.group(1)):
+            attr = addAttrParser.match(attrStr)
+            attrs.append(None if attr is None else (attr.group(1), attr.group(2)))
+        return ('ATTRS', attrs)
+    return None
+
+def readLines(path, maxLines):
+    # Pull everything into memory first, so that we only time parsing
+    if path.endswith('.otf2'):
+        otfPipe = subprocess.Popen(['otf2-print', path], stdout=subprocess.PIPE)
+        stream = (bytesChunk.decode() for bytesChunk in otfPipe.stdout)
+    else:
+        stream = open(path, 'r')
+    lines = []
+    for line in stream:
+        if maxLines is not None and len(lines) >= maxLines:
+            break
+        lines.append(line)
+    return lines
+
+def timeParser(parseLine, lines, nTrials):
+    best = float('inf')
+    for _ in range(nTrials):
+        start = time.perf_counter()
+        for line in lines:
+            parseLine(line)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    args = parser.parse_args()
+    results = []
+    for path in args.inputs:
+        lines = readLines(path, args.max_lines)
+        numBytes = sum(len(line) for line in lines)
+        parsers = [('tokenizer', tokenizeLine)]
+        if args.regex:
+            parsers.append(('regex', regexParseLine))
+        for name, parseLine in parsers:
+            seconds = timeParser(parseLine, lines, args.n_trials)
+            result = {
+                'input': path,
+                'parser': name,
+                'lines': len(lines),
+                'seconds': seconds,
+                'linesPerSecond': len(lines) / seconds if seconds > 0 else float('inf'),
+                'megabytesPerSecond': numBytes / 1e6 / seconds if seconds > 0 else float('inf')
+            }
+            results.append(result)
+            print('%s [%s]: %i lines in %.3fs; %.0f lines/s, %.1f MB/s' % \
+                  (path, name, result['lines'], seconds, result['linesPerSecond'], result['megabytesPerSecond']))
+
+    if args.output is not None:
+        history = []
+        if os.path.exists(args.output):
+            with open(args.output, 'r') as historyFile:
+                history = json.load(historyFile)
+        try:
+            revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                               cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            revision = None
+        history.append({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'revision': revision,
+            'python': platform.python_version(),
+            'results': results
+        })
+        with open(args.output, 'w') as historyFile:
+            json.dump(history, historyFile, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from data_store.sparseUtilizationList import SparseUtilizationList
+
+# The envelope only answers queries whose bins end on its grid points, where
+# min / max have to match calcExactUtilizationMatrix exactly; the mean and
+# std are summed in a different order, so they get a relative tolerance
+# (loose enough for values around 1e12, far too tight for the cancellation
+# in sum(x^2) / n - mean^2)
+statTolerance = {'min': 0, 'max': 0, 'average': 1e-12, 'std': 1e-6}
+
+def buildMetricList(numLocations=300, emptyLocations=5, samplesPerLocation=50, offset=1e12, spread=100, coverDomain=False, seed=0):
+    # More locations than pyramidChunkSize, so the envelope merges chunks. With
+    # coverDomain, every location has a sample at the very beginning (so that
+    # no location's value is 0 anywhere in the domain)
+    rng = np.random.default_rng(seed)
+    sul = SparseUtilizationList(False)
+    locations = ['loc%d' % i for i in range(numLocations)]
+    for loc in locations[:numLocations - emptyLocations]:
+        timestamps = np.unique(rng.integers(0, 1000000, samplesPerLocation))
+        if coverDomain:
+            timestamps = np.union1d([0], timestamps)
+        for timestamp, value in zip(timestamps.tolist(), (offset + rng.normal(0, spread, len(timestamps))).tolist()):
+            sul.setIntervalAtLocation({'index': timestamp, 'counter': 0, 'util': value}, loc)
+    sul.finalize(locations)
+    sul.buildEnvelope()
+    assert sul.envelope is not None
+    return sul
+
+def exactStats(sul, bins, begin, end):
+    matrix = sul.calcExactUtilizationMatrix(bins, begin, end, None, False)
+    return {'min': matrix.min(axis=0), 'max': matrix.max(axis=0), 'average': matrix.mean(axis=0), 'std': matrix.std(axis=0)}
+
+def assertMatchesExact(result, expected):
+    for stat, rtol in statTolerance.items():
+        np.testing.assert_allclose(result[stat], expected[stat], rtol=rtol, atol=0, err_msg=stat)
+
+@pytest.fixture(scope='module')
+def sul():
+    return buildMetricList()
+
+def testAlignedQueriesUseEnvelope(sul):
+    envelope = sul.envelope
+    cells = len(envelope['gridPts']) - 1
+    for bins in [cells, cells // 2, cells // 16]:
+        positions = sul.envelopePositions(bins, envelope['begin'], envelope['end'])
+        if bins == cells:
+            assert positions is not None
+        if positions is not None:
+            result = sul.calcEnvelopeHistogram(positions)
+            assertMatchesExact(result, exactStats(sul, bins, envelope['begin'], envelope['end']))
+
+@pytest.mark.parametrize('bins', [3, 100, 1000])
+def testMetricHistogramMatchesExact(sul, bins):
+    # Whatever calcMetricHistogram decides to use, including bins that fall
+    # partly or entirely outside of the domain
+    begin = sul.envelope['begin']
+    end = sul.envelope['end']
+    width = end - begin
+    for queryBegin, queryEnd in [(begin, end), (begin + width // 7, begin + width // 3),
+                                 (begin - width, end + width), (end + 1, end + width)]:
+        assertMatchesExact(sul.calcMetricHistogram(bins, queryBegin, queryEnd), exactStats(sul, bins, queryBegin, queryEnd))
+
+def testEnvelopeStdAtLargeOffsets():
+    # Every value is within a few hundred of 1e12
+    sul = buildMetricList(emptyLocations=0, coverDomain=True)
+    envelope = sul.envelope
+    cells = len(envelope['gridPts']) - 1
+    expected = exactStats(sul, cells, envelope['begin'], envelope['end'])['std']
+    np.testing.assert_allclose(envelope['std'][1:], expected, rtol=statTolerance['std'], atol=0)
@@ -0,0 +1,52 @@
+import os
+import shutil
+
+import numpy as np
+
+from data_store.histogramCache import HistogramCache
+
+def deleteDataset(cache, dbDir, datasetId):
+    # What DataStore.__delitem__ does
+    cache.invalidate(datasetId, deleted=True)
+    shutil.rmtree(os.path.join(dbDir, datasetId))
+
+def testDiskTier(tmp_path):
+    dbDir = str(tmp_path)
+    os.makedirs(os.path.join(dbDir, 'a'))
+    cache = HistogramCache(dbDir, diskBytes=1024 * 1024)
+    assert cache.get('a', ('util', 10), lambda: np.arange(10.0)).tolist() == list(range(10))
+    # A restart only has the disk tier left
+    cache = HistogramCache(dbDir, diskBytes=1024 * 1024)
+    assert cache.get('a', ('util', 10), lambda: None).tolist() == list(range(10))
+
+def testDeleteDuringRequest(tmp_path):
+    dbDir = str(tmp_path)
+    os.makedirs(os.path.join(dbDir, 'a'))
+    cache = HistogramCache(dbDir, diskBytes=1024 * 1024)
+    cache.get('a', ('util', 10), lambda: np.arange(10.0))
+
+    def computeWhileDeleting():
+        deleteDataset(cache, dbDir, 'a')
+        return np.zeros(5)
+
+    # Neither the stale result nor a later lookup reopens the diskcache in
+    # the deleted directory
+    assert cache.get('a', ('util', 5), computeWhileDeleting).tolist() == [0] * 5
+    assert cache.get('a', ('util', 5), lambda: np.ones(5)).tolist() == [1] * 5
+    assert not os.path.exists(os.path.join(dbDir, 'a'))
+
+    # A request that comes in after the cache has been invalidated, but
+    # before the directory is gone
+    os.makedirs(os.path.join(dbDir, 'b'))
+    cache.get('b', ('util', 5), lambda: np.ones(5))
+    cache.invalidate('b', deleted=True)
+    assert cache.get('b', ('util', 5), lambda: np.zeros(5)).tolist() == [0] * 5
+    shutil.rmtree(os.path.join(dbDir, 'b'))
+    assert cache.get('b', ('util', 5), lambda: np.zeros(5)).tolist() == [0] * 5
+    assert not os.path.exists(os.path.join(dbDir, 'b'))
+
+    # Reloading the dataset turns its diskcache back on
+    os.makedirs(os.path.join(dbDir, 'a'))
+    cache.invalidate('a')
+    cache.get('a', ('util', 5), lambda: np.ones(5))
+    assert os.path.exists(os.path.join(dbDir, 'a', 'histogramCache.diskCache'))
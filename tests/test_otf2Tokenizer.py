@@ -0,0 +1,52 @@
+import pytest
+
+from data_store.otf2Tokenizer import tokenizeLine
+from profiling_tools.parse_benchmark import regexParseLine
+
+# otf2-print output (as the lines come out of the file, with their newlines),
+# plus the odd cases that the old regexes had to handle
+sampleLines = [
+    '=== OTF2-PRINT ===\n',
+    '\n',
+    'Event                               Location            Timestamp  Attributes\n',
+    '--------------------------------------------------------------------------------\n',
+    'ENTER                         0                16144  Region: "hpx::eval" <3>\n',
+    'LEAVE                         1                16785  Region: "/phylanx/baz$5$6" <3>\n',
+    'ENTER                         6                16806  Region: "APEX MAIN" <3>\n',
+    'ENTER                         2                16498  Region: "" <3>\n',
+    'ENTER                         2                16498  Region: "first" <3>, Region: "second" <4>\n',
+    'LEAVE                         3                17000  Something: "else" <1>\n',
+    'ENTER                         3                17000  \n',
+    'ENTER 3 17000 Region: "single spaced" <1>\n',
+    'ENTER                         x                17000  Region: "bad location" <1>\n',
+    'LEAVE                         3                1.5  Region: "bad timestamp" <1>\n',
+    'ENTERED                       3                17000  Region: "not an event" <1>\n',
+    'METRIC                    5                16901  Metric: 0, 1 Value: ("PAPI_TOT_CYC" <0>; UINT64; 536177)\n',
+    'METRIC                    0                20032  Metric: 0, 1 Values: ("meminfo:MemFree" <0>; DOUBLE <2>; 788.723351)\n',
+    'METRIC                    0                20048  Metric: 0, 1 Values: ("status:Threads" <0>; DOUBLE <2>; 2.000000)\n',
+    'METRIC                    0                20048  Metric: 0 Values: ("status:Threads" <0>; DOUBLE; 3)\n',
+    'METRIC                    0                20048  Metric: 0, 1 Values: ("units" <0>; DOUBLE; 12.5 MB)\n',
+    'METRIC                    0                20048  Metric: 0, 1 Values: ("no number" <0>; DOUBLE; none)\n',
+    'METRIC                    0                20048  Metric: x Values: ("bad metric id" <0>; DOUBLE; 3)\n',
+    'METRIC                    0                20048  Metric: 0, 1 Samples: ("bad keyword" <0>; DOUBLE; 3)\n',
+    'METRIC                    0                20048  Metric: 0, 1 Values: (unquoted <0>; DOUBLE; 3)\n',
+    'MPI_SEND 7 897511  whatever\n',
+    '                    ADDITIONAL ATTRIBUTES: ("GUID" <0>; UINT64; 1000), ("Parent GUID" <1>; UINT64; 1230)\n',
+    '                    ADDITIONAL ATTRIBUTES: ("GUID" <0>; UINT64; 1867)\n',
+    '\tADDITIONAL ATTRIBUTES: ("GUID" <0>; UINT64; 1867)\n',
+    '                    ADDITIONAL ATTRIBUTES: ("GUID" <0>; UINT64; 1000), (broken), ("Primitive" <2>; STRING; "/phylanx/foo$1$2")\n',
+    '                    ADDITIONAL ATTRIBUTES: ("Name" <0>; STRING; )\n',
+    '                    ADDITIONAL ATTRIBUTES: \n',
+    'ADDITIONAL ATTRIBUTES: ("GUID" <0>; UINT64; 1000)\n',
+    '                    SOMETHING ELSE: ("GUID" <0>; UINT64; 1000)\n'
+]
+
+@pytest.mark.parametrize('line', sampleLines)
+def testMatchesRegexParser(line):
+    try:
+        expected = regexParseLine(line)
+    except IndexError:
+        # The old parser crashed on metric values without any digits; the
+        # tokenizer skips those lines instead
+        expected = None
+    assert tokenizeLine(line) == expected
@@ -0,0 +1,65 @@
+import os
+import json
+import struct
+import importlib.util
+
+import numpy as np
+import pytest
+from fastapi import Header, HTTPException, Query
+
+# Importing the api package would parse the command line and open the
+# database (see api/__init__.py), so load packing.py on its own
+spec = importlib.util.spec_from_file_location('packing', os.path.join(os.path.dirname(__file__), '..', 'api', 'packing.py'))
+packing = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(packing)
+
+def unpack(buffer):
+    # Decodes a packed response by following the layout described at the top
+    # of api/packing.py, not by reusing anything from pack()
+    assert buffer[:4] == packing.packedMagic
+    version, headerLength = struct.unpack('<II', buffer[4:12])
+    assert version == packing.packedVersion
+    header = json.loads(buffer[12:12 + headerLength].decode('utf-8'))
+    bodyStart = (12 + headerLength + 7) // 8 * 8
+    assert buffer[12 + headerLength:bodyStart] == b'\x00' * (bodyStart - 12 - headerLength)
+    arrays = {}
+    for description in header['arrays']:
+        assert (bodyStart + description['offset']) % 8 == 0
+        dtype = np.dtype(packing.packedDtypes[description['dtype']])
+        count = int(np.prod(description['shape']))
+        assert description['byteLength'] == count * dtype.itemsize
+        arrays[description['name']] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                                    offset=bodyStart + description['offset']).reshape(description['shape'])
+    return header, arrays
+
+@pytest.mark.parametrize('padding', range(8))
+def testRoundTrip(padding):
+    # Every header length mod 8, so the padding after the header takes every
+    # possible size
+    metadata = {'begin': 0, 'end': 100, 'name': 'x' * padding}
+    arrays = {
+        'data': np.linspace(0, 1, 5),
+        'counts': np.arange(3, dtype=np.int64),
+        'guid': np.array([2 ** 64 - 1], dtype=np.uint64),
+        'location': np.array([-1, 0, 1], dtype=np.int32),
+        'flags': np.array([1, 2, 3], dtype=np.uint8),
+        'matrix': np.arange(6, dtype=np.float64).reshape(2, 3),
+        'empty': np.zeros(0, dtype=np.int64)
+    }
+    header, decoded = unpack(packing.pack(arrays, metadata, ['a', 'b']))
+    assert header['metadata'] == metadata
+    assert header['strings'] == ['a', 'b']
+    assert list(decoded.keys()) == list(arrays.keys())
+    for name, values in arrays.items():
+        assert decoded[name].dtype == values.dtype
+        np.testing.assert_array_equal(decoded[name], values)
+
+def testWantsPacked():
+    assert packing.wantsPacked('packed', None)
+    assert not packing.wantsPacked('json', 'application/x-traveler-packed')
+    assert packing.wantsPacked(None, 'application/json, application/x-traveler-packed')
+    assert not packing.wantsPacked('', None)
+    # What direct (non-HTTP) calls to the endpoints pass along
+    assert not packing.wantsPacked(Query(None, alias='format'), Header(None))
+    with pytest.raises(HTTPException):
+        packing.wantsPacked('xml', None)
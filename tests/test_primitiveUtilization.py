@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from data_store.sparseUtilizationList import SparseUtilizationList
+
+def buildPrimitiveList(numLocations=6, intervalsPerLocation=300, seed=0):
+    # Overlapping intervals of two primitives on each location; returns the
+    # list and each location's critical points, in the order that they were
+    # added
+    rng = np.random.default_rng(seed)
+    sul = SparseUtilizationList()
+    criticalPts = {}
+    for loc in [str(i) for i in range(numLocations)]:
+        enters = np.sort(rng.integers(0, 100000, intervalsPerLocation)).tolist()
+        leaves = (np.array(enters) + rng.integers(0, 500, intervalsPerLocation)).tolist()
+        primitives = rng.choice(['a', 'b'], intervalsPerLocation).tolist()
+        criticalPts[loc] = []
+        for enter, leave, primitive in zip(enters, leaves, primitives):
+            for pt in [{'index': enter, 'counter': 1, 'util': 0, 'primitive': primitive},
+                       {'index': leave, 'counter': -1, 'util': 0, 'primitive': primitive}]:
+                sul.setIntervalAtLocation(pt, loc)
+                criticalPts[loc].append(pt)
+    sul.finalize(list(criticalPts.keys()))
+    return sul, criticalPts
+
+def loopUtilizationForPrimitive(criticalPts, bins, begin, end, primitive, durationBegin, durationEnd, durationBins):
+    # One segment at a time: a segment runs from the previous critical point
+    # (or 0) up to each critical point where its location goes idle, and
+    # belongs to that critical point's primitive. Row i (for i >= 1) gets the
+    # part of the segment between begin + (i - 1) * rangePerBin and
+    # begin + i * rangePerBin, clipped to the segment
+    result = np.zeros((bins, durationBins + 1), dtype=np.double)
+    rangePerBin = (end - begin) / bins
+    rangePerDurationBin = (durationEnd - durationBegin) / durationBins
+    for points in criticalPts.values():
+        counter = 0
+        previous = 0
+        for pt in sorted(points, key=lambda pt: pt['index']):
+            counter += pt['counter']
+            if counter == 0 and (pt['primitive'] == primitive or primitive == 'all_primitives'):
+                segmentStart = previous
+                segmentEnd = pt['index']
+                durationIndex = int((segmentEnd - segmentStart - durationBegin) // rangePerDurationBin)
+                for i in range(1, bins):
+                    overlap = min(begin + i * rangePerBin, segmentEnd) - max(begin + (i - 1) * rangePerBin, segmentStart)
+                    if overlap > 0:
+                        result[i, durationIndex] += overlap
+            previous = pt['index']
+    return result
+
+@pytest.fixture(scope='module')
+def primitiveList():
+    return buildPrimitiveList()
+
+@pytest.mark.parametrize('primitive', ['a', 'all_primitives'])
+@pytest.mark.parametrize('bins, begin, end', [
+    (100, 0, 102000),      # the whole domain
+    (37, 25013, 61000),    # zoomed in: segments that start before begin get clipped
+    (50, 99000, 150000),   # partly past the end of the domain
+    (10, 200000, 300000),  # nothing at all
+    (1, 0, 102000)         # only row 0, which stays empty
+])
+def testMatchesSegmentLoop(primitiveList, primitive, bins, begin, end):
+    sul, criticalPts = primitiveList
+    durationBins = 10
+    result = np.array(sul.calcUtilizationForPrimitive(bins, begin, end, primitive, 0, 500, durationBins))
+    expected = loopUtilizationForPrimitive(criticalPts, bins, begin, end, primitive, 0, 500, durationBins)
+    assert result.shape == expected.shape
+    np.testing.assert_allclose(result, expected, rtol=1e-12, atol=1e-9)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from data_store.sparseUtilizationList import SparseUtilizationList
+
+# Grids are only read at their own points, so the pyramid has to agree with
+# calcExactUtilizationMatrix up to rounding (the cumulative utilization is
+# differenced, instead of being summed bin by bin)
+rtol = 1e-9
+
+def buildIntervalList(numLocations=20, intervalsPerLocation=400, seed=0):
+    rng = np.random.default_rng(seed)
+    sul = SparseUtilizationList()
+    locations = [str(i) for i in range(numLocations)]
+    for loc in locations:
+        enters = np.sort(rng.integers(0, 1000000, intervalsPerLocation))
+        leaves = enters + rng.integers(0, 5000, intervalsPerLocation)
+        for enter, leave in zip(enters.tolist(), leaves.tolist()):
+            sul.setIntervalAtLocation({'index': enter, 'counter': 1, 'util': 0}, loc)
+            sul.setIntervalAtLocation({'index': leave, 'counter': -1, 'util': 0}, loc)
+    sul.finalize(locations)
+    sul.buildPyramid()
+    assert sul.pyramid is not None and sul.pyramid['total'] is not None and len(sul.pyramid['levels']) > 0
+    return sul
+
+def assertMatchesExact(result, expected):
+    np.testing.assert_allclose(result, expected, rtol=rtol, atol=rtol * np.abs(expected).max())
+
+@pytest.fixture(scope='module')
+def sul():
+    return buildIntervalList()
+
+def testAlignedQueriesUsePyramid(sul):
+    begin = sul.pyramid['begin']
+    end = sul.pyramid['end']
+    grids = [sul.pyramid['total']] + list(sul.pyramid['levels'].values())
+    for grid in grids:
+        cells = len(grid['gridPts']) - 1
+        assert sul.pyramidPositions(grid['gridPts'], cells, begin, end) is not None
+    totalCells = len(sul.pyramid['total']['gridPts']) - 1
+    for bins in [totalCells, totalCells // 4, 64]:
+        expected = sul.calcExactUtilizationMatrix(bins, begin, end)
+        assertMatchesExact(sul.calcUtilizationHistogram(bins, begin, end), expected.sum(axis=0))
+        assertMatchesExact(sul.calcUtilizationMatrix(bins, begin, end), expected)
+
+@pytest.mark.parametrize('bins', [7, 100, 1000])
+def testUtilizationMatchesExact(sul, bins):
+    # Whatever the pyramid decides to use, including ranges that only partly
+    # overlap the domain
+    begin = sul.pyramid['begin']
+    end = sul.pyramid['end']
+    width = end - begin
+    for queryBegin, queryEnd in [(begin, end), (begin + width // 7, begin + width // 3), (begin - width, end + width)]:
+        expected = sul.calcExactUtilizationMatrix(bins, queryBegin, queryEnd)
+        assertMatchesExact(sul.calcUtilizationHistogram(bins, queryBegin, queryEnd), expected.sum(axis=0))
+        assertMatchesExact(sul.calcUtilizationMatrix(bins, queryBegin, queryEnd), expected)